@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline benchmark for the schedule ingest and notification daemons
+"""
+Measures how kapbot's background daemons keep up as the feed and user base
+grow, without MySQL or Telegram.
+
+A synthetic schedules2.json is generated with FT/PT, UCD/MUR and study room
+classes, streamed through the same FeedFetcher, parser and ingest code the
+crawler uses, and loaded into a throwaway SQLite store. A synthetic user
+population then subscribes to those classes and one full notification cycle
+is run against a stand-in bot.
+
+Usage:
+python3 benchmark.py --classrooms 200 --classes 5000 --users 20000
+python3 benchmark.py --output results.json --baseline previous.json
+"""
+
+import argparse
+import configparser
+import datetime
+import importlib
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Imported by load_kapbot() once its config points at the benchmark's own store
+kapbot = None
+
+STUDENT_TYPES = ("FT", "PT")
+UNIVERSITY_TYPES = ("UCD", "MUR")
+UNIT_PREFIXES = {"UCD": ("COMP", "MATH", "STAT", "ACC", "FIN"), "MUR": ("ICT", "BUS", "MAS", "BSC", "FIN")}
+
+def generate_units(unitCount, rng):
+    """Return unitCount (UniversityType, spaced unit name) pairs split between the universities."""
+    units = []
+    for i in range(unitCount):
+        uniName = UNIVERSITY_TYPES[i % len(UNIVERSITY_TYPES)]
+        prefix = rng.choice(UNIT_PREFIXES[uniName])
+        if uniName == "MUR":
+            units.append((uniName, prefix + " " + str(100 + i) + rng.choice("AB")))
+        else:
+            units.append((uniName, prefix + " " + str(10000 + i)))
+
+    return units
+
+def generate_feed(classrooms, classes, units, days=1, startDate=None, studyRoomRatio=0.1, dataIssueRatio=0.05, seed=0):
+    """Build a schedules2.json style list with `classes` classes per day spread over `classrooms` rooms."""
+    rng = random.Random(seed)
+    startDate = startDate or datetime.date.today()
+
+    feed = [{"classroom": "Room " + str(i + 1).zfill(3), "days": []} for i in range(classrooms)]
+    for dayOffset in range(days):
+        date = (startDate + datetime.timedelta(days=dayOffset)).isoformat()
+        dayClasses = [[] for _ in range(classrooms)]
+
+        for i in range(classes):
+            startTime = "%02d:%s" % (rng.randint(8, 21), rng.choice(("00", "30")))
+            duration = rng.choice(("1.5 hours", "2 hours", "3 hours"))
+
+            if rng.random() < studyRoomRatio:
+                dayClasses[i % classrooms].append({"ClassName": "Study Room", "Duration": duration,
+                    "startTime": startTime, "eventName": "Study Room"})
+                continue
+
+            uniName, unitName = rng.choice(units)
+            className = rng.choice(STUDENT_TYPES) + " " + uniName + " " + unitName
+
+            if uniName == "MUR":
+                # Group restricted classes, with the odd event naming a different unit
+                eventUnit = unitName if rng.random() >= dataIssueRatio else rng.choice(units)[1]
+                eventName = eventUnit + " - Group " + rng.choice("ABC")
+            else:
+                eventName = unitName
+
+            dayClasses[i % classrooms].append({"ClassName": className, "Duration": duration,
+                "startTime": startTime, "eventName": eventName})
+
+        for item, itemClasses in zip(feed, dayClasses):
+            item["days"].append({"date": date, "classes": itemClasses})
+
+    return feed
+
+def mutate_feed(feed, changeRatio, seed=0):
+    """Return a copy of feed with roughly changeRatio of the classes moved, dropped or renamed."""
+    rng = random.Random(seed)
+    mutated = json.loads(json.dumps(feed))
+    for item in mutated:
+        for day in item["days"]:
+            keptClasses = []
+            for className in day["classes"]:
+                if rng.random() < changeRatio:
+                    change = rng.randint(0, 2)
+                    if change == 0:
+                        continue
+                    elif change == 1:
+                        className["startTime"] = "%02d:15" % rng.randint(8, 21)
+                    else:
+                        className["Duration"] = "4 hours"
+                keptClasses.append(className)
+            day["classes"] = keptClasses
+
+    return mutated
+
+def generate_subscriptions(users, subscriptionsPerUser, units, seed=0):
+    """Return NotificationSubscription JOIN RegisteredUsers rows for a synthetic user population."""
+    rng = random.Random(seed)
+    subscriptions = []
+    for telegramId in range(100000000, 100000000 + users):
+        studentType = rng.choice(STUDENT_TYPES)
+        uniName = rng.choice(UNIVERSITY_TYPES)
+        uniUnits = [unitName for unitUni, unitName in units if unitUni == uniName]
+
+        for unitName in rng.sample(uniUnits, min(subscriptionsPerUser, len(uniUnits))):
+            subscriptions.append((telegramId, studentType, uniName, unitName.replace(' ', ''), None))
+
+    return subscriptions
+
+def load_kapbot(workDir):
+    """Import kapbot with the sample config, switched to a SQLite store in workDir."""
+    global kapbot
+    benchConfig = configparser.ConfigParser()
+    benchConfig.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config-sample.ini'))
+    benchConfig['Storage'] = {'backend': 'sqlite', 'path': os.path.join(workDir, 'kapbot.db')}
+
+    configPath = os.path.join(workDir, 'config.ini')
+    with open(configPath, 'w') as configFile:
+        benchConfig.write(configFile)
+
+    os.environ['KAPBOT_CONFIG'] = configPath
+    kapbot = importlib.import_module('kapbot')
+    kapbot.storage.migrate()
+
+    return kapbot
+
+def seed_subscriptions(storage, subscriptions):
+    """Write the synthetic users and their subscriptions to the store in one transaction."""
+    users = dict((sub[0], (sub[0], sub[2], sub[1])) for sub in subscriptions)
+    with storage.transaction() as cursor:
+        cursor.executemany(storage.sql("INSERT INTO RegisteredUsers (TelegramID, UniversityType, StudentType) VALUES (%s, %s, %s)"),
+            list(users.values()))
+        cursor.executemany(storage.sql("INSERT INTO NotificationSubscription (TelegramID, ClassCode) VALUES (%s, %s)"),
+            [(sub[0], sub[3]) for sub in subscriptions])
+
+def reset_notifications(storage):
+    with storage.transaction() as cursor:
+        cursor.execute("UPDATE NotificationSubscription SET LastNotifiedDate = NULL")
+        cursor.execute("DELETE FROM NotificationOutbox")
+
+class StandInBot(object):
+    """Accepts send_message calls like telegram.Bot, optionally taking `latency` seconds each."""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.sent = 0
+
+    def send_message(self, chat_id, text, parse_mode=None):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.sent += 1
+
+def measure(func, repeat, setup=None):
+    """Run func `repeat` times for timing, then once more under tracemalloc for its peak memory.
+
+    `setup` runs untimed before every run of func.
+    """
+    durations = []
+    result = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        runStart = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - runStart)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        peakBytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return result, {
+        'seconds': min(durations),
+        'secondsMedian': statistics.median(durations),
+        'peakMemoryMB': round(peakBytes / (1024 * 1024), 2),
+    }
+
+def run_ingest(feedPath):
+    """Stream the feed file into ScrappedData the way ScheduleCrawler does for a full reload."""
+    with kapbot.FeedFetcher('file://' + feedPath).open() as feedStream:
+        return kapbot.storage.replace_schedule(kapbot.parse_schedule(kapbot.iter_json_array(feedStream)))
+
+def run_incremental(oldSnapshot, newFeedPath):
+    """Diff a changed feed against the previous snapshot and apply the delta, like an incremental refresh."""
+    with kapbot.FeedFetcher('file://' + newFeedPath).open() as feedStream:
+        newSnapshot, delta = kapbot.diff_schedule(oldSnapshot, kapbot.parse_schedule(kapbot.iter_json_array(feedStream)))
+
+    kapbot.storage.apply_schedule_delta(delta)
+
+    return delta
+
+def run_notifier_cycle(dispatcher):
+    """Rebuild the notification queue and send everything due today, like one sendNotifications pass."""
+    reset_notifications(kapbot.storage)
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    scheduler = kapbot.notificationScheduler
+
+    rebuildStart = time.perf_counter()
+    scheduler.rebuild(today)
+    dueNotifications = scheduler.pop_due(today + datetime.timedelta(days=1))
+    rebuildDuration = time.perf_counter() - rebuildStart
+
+    outbox = kapbot.notificationOutbox
+    messageCount = len(outbox.queue(dueNotifications, today))
+
+    deliveredCount = 0
+    more = True
+    while more:
+        outboxRows, more = outbox.take(today)
+        deliveredIds = dispatcher.send_all(outbox.messages(outboxRows, today))
+        outbox.settle(outboxRows, deliveredIds, today)
+        deliveredCount += len(deliveredIds)
+
+    return len(dueNotifications), messageCount, deliveredCount, rebuildDuration
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    """Print how each timing and memory figure moved against a previous results file."""
+    for phase, metrics in results['results'].items():
+        for metric, value in metrics.items():
+            previous = baseline.get('results', {}).get(phase, {}).get(metric)
+            if not isinstance(value, (int, float)) or not previous:
+                continue
+            print('%-12s %-22s %12.4f -> %12.4f (%+.1f%%)' % (phase, metric, previous, value,
+                (value - previous) / previous * 100))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark kapbot's schedule ingest and notification cycle offline.")
+    parser.add_argument('--classrooms', type=int, default=100, help='classrooms in the synthetic feed')
+    parser.add_argument('--classes', type=int, default=2000, help='classes per day across all classrooms')
+    parser.add_argument('--days', type=int, default=7, help='days of schedule in the feed, starting today')
+    parser.add_argument('--units', type=int, default=300, help='distinct unit codes')
+    parser.add_argument('--users', type=int, default=5000, help='registered users')
+    parser.add_argument('--subscriptions', type=int, default=4, help='subscriptions per user')
+    parser.add_argument('--change-ratio', type=float, default=0.05, help='share of classes changed for the incremental refresh')
+    parser.add_argument('--send-latency', type=float, default=0, help='seconds each stand-in send_message takes')
+    parser.add_argument('--workers', type=int, default=8, help='notification dispatcher workers')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per phase, the fastest is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--write-feed', metavar='PATH', help='also save the generated schedules2.json here')
+    parser.add_argument('--output', metavar='PATH', default='benchmark-results.json', help='where to save the results')
+    parser.add_argument('--baseline', metavar='PATH', help='previous results to compare against')
+    parser.add_argument('--verbose', action='store_true', help="show kapbot's own log output")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    units = generate_units(args.units, rng)
+    feed = generate_feed(args.classrooms, args.classes, units, days=args.days, seed=args.seed)
+    changedFeed = mutate_feed(feed, args.change_ratio, seed=args.seed + 1)
+    subscriptions = generate_subscriptions(args.users, args.subscriptions, units, seed=args.seed)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workDir:
+        load_kapbot(workDir)
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+        seed_subscriptions(kapbot.storage, subscriptions)
+        dispatcher = kapbot.NotificationDispatcher(StandInBot(args.send_latency), workers=args.workers,
+            globalRate=1e9, perChatInterval=0)
+
+        feedPath = os.path.join(workDir, 'schedules2.json')
+        changedFeedPath = os.path.join(workDir, 'schedules2-changed.json')
+        for path, data in ((feedPath, feed), (changedFeedPath, changedFeed)):
+            with open(path, 'w') as feedFile:
+                json.dump(data, feedFile)
+        if args.write_feed:
+            with open(args.write_feed, 'w') as feedFile:
+                json.dump(feed, feedFile)
+
+        #Full reload
+        rowCount, ingestMetrics = measure(lambda: run_ingest(feedPath), args.repeat)
+        ingestMetrics.update(rows=rowCount, rowsPerSec=round(rowCount / ingestMetrics['seconds']),
+            feedBytes=os.path.getsize(feedPath))
+        results['ingest'] = ingestMetrics
+
+        #Incremental refresh, starting from the full feed each run
+        with kapbot.FeedFetcher('file://' + feedPath).open() as feedStream:
+            oldSnapshot = kapbot.schedule_snapshot(kapbot.parse_schedule(kapbot.iter_json_array(feedStream)))
+
+        delta, incrementalMetrics = measure(lambda: run_incremental(oldSnapshot, changedFeedPath), args.repeat,
+            setup=lambda: run_ingest(feedPath))
+        incrementalMetrics.update(inserted=len(delta.inserted), changed=len(delta.changed), removed=len(delta.removed))
+        results['incremental'] = incrementalMetrics
+
+        #Notification cycle over today's schedule
+        run_ingest(feedPath)
+        kapbot.load_schedule_index()
+
+        (dueCount, messageCount, deliveredCount, rebuildDuration), notifierMetrics = measure(
+            lambda: run_notifier_cycle(dispatcher), args.repeat)
+        notifierMetrics.update(subscriptions=len(subscriptions), dueEntries=dueCount, messages=messageCount,
+            delivered=deliveredCount, rebuildSeconds=rebuildDuration,
+            messagesPerSec=round(deliveredCount / notifierMetrics['seconds']))
+        results['notifier'] = notifierMetrics
+
+    report = {
+        'version': git_version(),
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': dict((name, value) for name, value in vars(args).items()
+            if name not in ('output', 'baseline', 'write_feed', 'verbose')),
+        'results': results,
+    }
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        report['maxRSSMB'] = round(maxRSS / (1024 * 1024 if sys.platform == 'darwin' else 1024), 2)
+
+    with open(args.output, 'w') as outputFile:
+        json.dump(report, outputFile, indent=2)
+
+    print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            compare(report, json.load(baselineFile))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Point kapbot at a throwaway SQLite store before the tests import it."""
+
+import os
+import tempfile
+import types
+
+import pytest
+
+testDir = tempfile.mkdtemp(prefix='kapbot-tests-')
+configPath = os.path.join(testDir, 'config.ini')
+with open(configPath, 'w') as configFile:
+    configFile.write('[Storage]\nbackend = sqlite\npath = ' + os.path.join(testDir, 'kapbot.db') + '\n\n'
+        '[Leader]\nenabled = no\n')
+os.environ['KAPBOT_CONFIG'] = configPath
+
+import kapbot
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """A migrated SQLite store of the test's own, installed as kapbot.storage."""
+    testStorage = kapbot.SQLiteStorage(str(tmp_path / 'kapbot.db'))
+    testStorage.migrate()
+    monkeypatch.setattr(kapbot, 'storage', testStorage)
+    # Schedules loaded from it are dropped again after the test
+    monkeypatch.setattr(kapbot, 'scheduleIndex', kapbot.scheduleIndex)
+    return testStorage
+
+class FakeMessage(object):
+    """The parts of a telegram Message the conversation handlers use, replies are kept in `replies`."""
+
+    def __init__(self, telegramId, text):
+        self.from_user = types.SimpleNamespace(id=telegramId)
+        self.chat_id = telegramId
+        self.text = text
+        self.replies = []
+
+    def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+@pytest.fixture
+def send(storage, monkeypatch):
+    """Call a conversation handler with a message from user 1, returns (next state, replies)."""
+    monkeypatch.setattr(kapbot, 'userCache', kapbot.UserCache(100, 3600))
+    # No codes known, so none are checked against the schedule unless a test adds some
+    monkeypatch.setattr(kapbot, 'classCodeIndex', kapbot.ClassCodeIndex())
+
+    def send(handler, text, user_data=None):
+        message = FakeMessage(1, text)
+        update = types.SimpleNamespace(message=message, effective_message=message)
+        # Skip the chat action decorator, nothing is sent to Telegram
+        state = handler.__wrapped__(None, update, user_data={} if user_data is None else user_data)
+        return state, message.replies
+
+    return send
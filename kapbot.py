@@ -16,46 +16,1471 @@ Press Ctrl-C on the command line or send a signal to the process to stop the
 bot.
 """
 
-from functools import wraps
-from telegram import ReplyKeyboardMarkup, ChatAction, ParseMode, ReplyKeyboardRemove
+from functools import wraps, partial, lru_cache
+from contextlib import contextmanager
+from telegram import ReplyKeyboardMarkup, ChatAction, ParseMode, ReplyKeyboardRemove, Update
+from telegram.error import TelegramError, NetworkError, TimedOut, RetryAfter
+from telegram import Bot
+from telegram.utils.request import Request
+from telegram.utils.helpers import escape_markdown
 from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, RegexHandler,
                           ConversationHandler)
 import threading
+import asyncio
+import abc
+import concurrent.futures
+import ssl
+import queue
 import time, datetime
 import logging
-import mysql.connector
+import sqlite3
 import json
-import urllib
+import codecs
+import itertools
+import heapq
+import bisect
+import difflib
+import re
+import hashlib
+import gzip
+import os
+import random
+import http.client
+import http.server
+import hmac
+import signal
+import socket
+import sys
+import argparse
+import email.utils
+import urllib.parse
+from collections import namedtuple, deque, OrderedDict
+from types import MappingProxyType
 import configparser
 
+try:
+    import mysql.connector
+except ImportError:
+    # Only needed by the MySQL storage backend
+    mysql = None
+
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 
 logger = logging.getLogger(__name__)
 
-# Get config file
+# Get config file, KAPBOT_CONFIG points at another one such as the sample for benchmarks
 config = configparser.ConfigParser()
-config.read('config.ini')
-
-# Connect to database
-kapbotdb = mysql.connector.connect(
-    host = config['mysqlDB']['host'],
-    user = config['mysqlDB']['user'],
-    passwd = config['mysqlDB']['passwd'],
-    database = config['mysqlDB']['database']
+config.read(os.environ.get('KAPBOT_CONFIG', 'config.ini'))
+
+# Default histogram buckets in seconds, from a fast cache hit to a slow Telegram round trip
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def format_metric_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+def format_metric_labels(labelNames, labelValues):
+    if not labelNames:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labelValues)
+    return '{' + ','.join(name + '="' + value + '"' for name, value in zip(labelNames, escaped)) + '}'
+
+class Metric(object):
+    """Base for the Prometheus metric types, one value per combination of label values."""
+
+    kind = 'untyped'
+
+    def __init__(self, name, description, labelNames=()):
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labelNames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def samples(self):
+        """Yield (sample name, label names, label values, value) tuples."""
+        with self.lock:
+            items = list(self.values.items())
+        for labelValues, value in items:
+            yield self.name, self.labelNames, labelValues, value
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.description, '# TYPE ' + self.name + ' ' + self.kind]
+        for sampleName, labelNames, labelValues, value in self.samples():
+            lines.append(sampleName + format_metric_labels(labelNames, labelValues) + ' ' + format_metric_value(value))
+        return '\n'.join(lines) + '\n'
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labelValues, amount=1):
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+class Gauge(Metric):
+    """Gauge set directly, or read from `callback` at scrape time.
+
+    The callback returns a number, or a dict of label value tuples to numbers.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, labelNames=(), callback=None):
+        Metric.__init__(self, name, description, labelNames)
+        self.callback = callback
+
+    def set(self, value, *labelValues):
+        with self.lock:
+            self.values[labelValues] = value
+
+    def samples(self):
+        if self.callback is None:
+            for sample in Metric.samples(self):
+                yield sample
+            return
+
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labelValues, value in values.items():
+            yield self.name, self.labelNames, labelValues, value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelNames=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, description, labelNames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelValues):
+        bucketIndex = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labelValues)
+            if state is None:
+                # Per bucket counts (last one is +Inf) and the running sum
+                state = self.values[labelValues] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bucketIndex] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, *labelValues):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labelValues)
+
+    def samples(self):
+        with self.lock:
+            items = [(labelValues, list(state[0]), state[1]) for labelValues, state in self.values.items()]
+
+        bucketLabels = self.labelNames + ('le',)
+        for labelValues, bucketCounts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), bucketCounts):
+                cumulative += count
+                yield self.name + '_bucket', bucketLabels, labelValues + (format_metric_value(bound),), cumulative
+            yield self.name + '_sum', self.labelNames, labelValues, total
+            yield self.name + '_count', self.labelNames, labelValues, cumulative
+
+class MetricsRegistry(object):
+    """Holds every metric and renders them in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labelNames=()):
+        return self.register(Counter(name, description, labelNames))
+
+    def gauge(self, name, description, labelNames=(), callback=None):
+        return self.register(Gauge(name, description, labelNames, callback))
+
+    def histogram(self, name, description, labelNames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, description, labelNames, buckets))
+
+    def render(self):
+        rendered = []
+        for metric in self.metrics:
+            try:
+                rendered.append(metric.render())
+            except Exception as e:
+                # A broken gauge callback should not take the whole endpoint down
+                logger.warning('Could not collect metric %s: %s', metric.name, e)
+        return ''.join(rendered)
+
+metrics = MetricsRegistry()
+handlerDuration = metrics.histogram('kapbot_handler_duration_seconds', 'Time spent in each update handler callback.', ('handler',))
+handlerErrors = metrics.counter('kapbot_handler_errors_total', 'Update handler callbacks that raised.', ('handler',))
+sqlDuration = metrics.histogram('kapbot_sql_duration_seconds', 'Time spent running each kind of SQL statement.', ('statement',))
+sqlErrors = metrics.counter('kapbot_sql_errors_total', 'SQL statements that raised.', ('statement',))
+telegramDuration = metrics.histogram('kapbot_telegram_request_duration_seconds', 'Bot API request round trip time.', ('method',))
+telegramErrors = metrics.counter('kapbot_telegram_request_errors_total', 'Bot API requests that failed.', ('method', 'error'))
+ingestDuration = metrics.histogram('kapbot_ingest_duration_seconds', 'Time taken to write a schedule feed to the database.', ('mode',),
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+ingestRows = metrics.counter('kapbot_ingest_rows_total', 'Schedule rows written to the database.', ('mode',))
+scheduleRefreshes = metrics.counter('kapbot_schedule_refreshes_total', 'Schedule crawler runs by outcome.', ('result',))
+scheduleEntries = metrics.gauge('kapbot_schedule_entries', "Entries in today's schedule index.")
+notificationRebuildDuration = metrics.histogram('kapbot_notification_rebuild_duration_seconds', 'Time taken to rebuild the notification queue.')
+notificationsTotal = metrics.counter('kapbot_notifications_total',
+    'Due notifications by outcome, skipped ones were duplicates or already sent.', ('result',))
+notificationDelay = metrics.histogram('kapbot_notification_delay_seconds',
+    'Delay between a notification falling due (leadMinutes before class start) and its delivery.',
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+notificationLead = metrics.histogram('kapbot_notification_lead_seconds',
+    'Time left before class start when a notification was delivered, lower than leadMinutes means it arrived late.',
+    buckets=(60, 300, 600, 900, 1800, 2700, 3300, 3540, 3600, 5400))
+dispatchTotal = metrics.counter('kapbot_notification_dispatch_total',
+    'Bot API sends by the notification dispatcher by outcome, flood_wait counts RetryAfter responses.', ('result',))
+chatActionsTotal = metrics.counter('kapbot_chat_actions_total',
+    'Chat actions by outcome, skipped ones were for handlers that finished first or already shown.', ('result',))
+
+@lru_cache(maxsize=256)
+def statement_label(operation):
+    """Short label for an SQL statement, its verb and first table such as 'SELECT NotificationSubscription'."""
+    verb = operation.split(None, 1)[0].upper() if operation.strip() else ''
+    tableMatch = re.search(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+`?(\w+)', operation, re.IGNORECASE)
+    return verb + ' ' + tableMatch.group(1) if tableMatch else verb
+
+class MeteredConnection(object):
+    """Database connection wrapper whose cursors time every statement."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return MeteredCursor(self.conn.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+class MeteredCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, operation, params=None):
+        return self._timed(self.cursor.execute, operation, params)
+
+    def executemany(self, operation, seqParams):
+        return self._timed(self.cursor.executemany, operation, seqParams)
+
+    def _timed(self, func, operation, params):
+        label = statement_label(operation)
+        started = time.perf_counter()
+        try:
+            return func(operation) if params is None else func(operation, params)
+        except Exception:
+            sqlErrors.inc(label)
+            raise
+        finally:
+            sqlDuration.observe(time.perf_counter() - started, label)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+class MeteredRequest(Request):
+    """python-telegram-bot Request that times each Bot API call."""
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            return Request.post(self, url, data, timeout=timeout)
+        except Exception as e:
+            telegramErrors.inc(method, type(e).__name__)
+            raise
+        finally:
+            telegramDuration.observe(time.perf_counter() - started, method)
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the metrics registry at /metrics."""
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Metrics %s - %s', self.address_string(), format % args)
+
+def start_metrics_server(listen, port):
+    metricsServer = http.server.ThreadingHTTPServer((listen, port), MetricsRequestHandler)
+    metricsServer.daemon_threads = True
+    metricsThread = threading.Thread(target=metricsServer.serve_forever)
+    metricsThread.daemon = True
+    metricsThread.start()
+    logger.info('Serving metrics on http://%s:%d/metrics', listen, metricsServer.server_address[1])
+
+    return metricsServer
+
+def timed_callback(callback):
+    """Wrap an update handler callback to record its latency and errors."""
+    handlerName = callback.__name__
+
+    @wraps(callback)
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return callback(*args, **kwargs)
+        except Exception:
+            handlerErrors.inc(handlerName)
+            raise
+        finally:
+            handlerDuration.observe(time.perf_counter() - started, handlerName)
+
+    return timed
+
+def instrument_handlers(dispatcher):
+    """Time every registered handler callback, including those inside conversations."""
+    seen = set()
+
+    def instrument(handlers):
+        for handler in handlers:
+            if id(handler) in seen:
+                continue
+            seen.add(id(handler))
+
+            if isinstance(handler, ConversationHandler):
+                instrument(handler.entry_points)
+                for stateHandlers in handler.states.values():
+                    instrument(stateHandlers)
+                instrument(handler.fallbacks)
+            else:
+                handler.callback = timed_callback(handler.callback)
+
+    for group in dispatcher.handlers.values():
+        instrument(group)
+
+class ConnectionPool(object):
+    """Fixed size pool of MySQL connections shared by handlers and daemons.
+
+    Connections are opened lazily, checked out per thread (nested checkouts
+    from the same thread reuse the held connection) and pinged on checkout so
+    that connections dropped by the server's wait_timeout are reopened.
+    """
+
+    def __init__(self, size, timeout, **connectArgs):
+        self.size = size
+        self.timeout = timeout
+        self.connectArgs = connectArgs
+        self.local = threading.local()
+
+        # Empty slots are None and get connected on first checkout
+        self.idle = queue.LifoQueue(maxsize=size)
+        for _ in range(size):
+            self.idle.put(None)
+
+        # Pool wait metrics
+        self.statsLock = threading.Lock()
+        self.checkouts = 0
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+        self.timeouts = 0
+        self.reconnects = 0
+
+    @contextmanager
+    def connection(self):
+        heldConn = getattr(self.local, 'conn', None)
+
+        # Same thread asking again, hand back the connection it already has
+        if heldConn is not None:
+            yield heldConn
+            return
+
+        conn = self._checkout()
+        self.local.conn = conn
+        try:
+            yield conn
+        except Exception:
+            conn = self._reset(conn)
+            raise
+        else:
+            # End any open read snapshot so the next borrower sees fresh data
+            if conn.in_transaction:
+                conn = self._reset(conn)
+        finally:
+            self.local.conn = None
+            self.idle.put(conn)
+
+    def _checkout(self):
+        waitStart = time.monotonic()
+        try:
+            conn = self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self.statsLock:
+                self.timeouts += 1
+            raise mysql.connector.errors.PoolError("No database connection available after " + str(self.timeout) + "s")
+
+        waited = time.monotonic() - waitStart
+        with self.statsLock:
+            self.checkouts += 1
+            self.waitTotal += waited
+            self.waitMax = max(self.waitMax, waited)
+
+        if waited > 1:
+            logger.warning('Waited %.2fs for a database connection', waited)
+
+        try:
+            if conn is None:
+                conn = MeteredConnection(self._connect())
+            elif not conn.is_connected():
+                conn.reconnect(attempts=3, delay=1)
+                with self.statsLock:
+                    self.reconnects += 1
+        except Exception:
+            # Give the slot back so the pool does not shrink
+            self.idle.put(None)
+            raise
+
+        return conn
+
+    def _connect(self):
+        return mysql.connector.connect(**self.connectArgs)
+
+    def _reset(self, conn):
+        # Roll back, or drop the connection entirely if it is unusable
+        try:
+            conn.rollback()
+            return conn
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            return None
+
+    def stats(self):
+        with self.statsLock:
+            return {
+                'size': self.size,
+                'idle': self.idle.qsize(),
+                'checkouts': self.checkouts,
+                'waitTotal': self.waitTotal,
+                'waitMax': self.waitMax,
+                'waitAvg': self.waitTotal / self.checkouts if self.checkouts else 0.0,
+                'timeouts': self.timeouts,
+                'reconnects': self.reconnects,
+            }
+
+def sql_datetime(value):
+    """Format a datetime the way both backends store and compare DATETIME columns."""
+    return value.isoformat(' ', 'seconds')
+
+class SQLStorage(abc.ABC):
+    """Queries on the bot's tables shared by the SQL backends.
+
+    Statements are written for MySQL with %s placeholders and go through
+    sql(), which a backend overrides to adapt them to its own dialect.
+    Subclasses implement the abstract methods below and list their schema
+    migrations.
+    """
+
+    # (version, description, steps) applied in order by migrate(), a step is
+    # a statement or a function called with (storage, cursor)
+    migrations = ()
+
+    # Threads that may use the store at once, sizes the asyncio runtime's executor
+    concurrency = 1
+
+    # Appended to the claim SELECT to lock the rows until commit
+    lockRowsSQL = ""
+
+    # The database server's clock in seconds since the epoch, so lease expiry
+    # does not depend on each replica's own clock
+    clockSQL = ""
+
+    # Most (TelegramID, ClassCode) keys bound in one statement
+    keyBatchSize = 400
+
+    def sql(self, statement):
+        return statement
+
+    def key_list(self, keyCount):
+        return ", ".join(["(%s, %s)"] * keyCount)
+
+    @abc.abstractmethod
+    def transaction(self):
+        """Context manager yielding a cursor, commits when the block finishes and rolls back if it raises."""
+
+    @abc.abstractmethod
+    def query(self, statement, params=()):
+        """Run a read-only statement and return all rows."""
+
+    @abc.abstractmethod
+    def schema_lock(self):
+        """Context manager yielding a cursor while holding a lock that keeps other instances from migrating at the same time."""
+
+    @abc.abstractmethod
+    def explain(self, statement, params=()):
+        """Return (table, full scan, plan detail) for each step of a statement's query plan."""
+
+    def stats(self):
+        return {}
+
+    #Schema
+    def schema_version(self, cursor):
+        cursor.execute("CREATE TABLE IF NOT EXISTS SchemaVersion (Version INT NOT NULL PRIMARY KEY, "
+            "Description VARCHAR(255) NOT NULL, AppliedAt VARCHAR(32) NOT NULL)")
+        cursor.execute("SELECT MAX(Version) FROM SchemaVersion")
+        return cursor.fetchone()[0] or 0
+
+    def migrate(self):
+        """Apply the migrations newer than the version recorded in SchemaVersion, oldest first."""
+        with self.schema_lock() as cursor:
+            currentVersion = self.schema_version(cursor)
+            for version, description, steps in self.migrations:
+                if version <= currentVersion:
+                    continue
+
+                logger.info('Applying schema migration %d: %s', version, description)
+                for step in steps:
+                    if callable(step):
+                        step(self, cursor)
+                    else:
+                        cursor.execute(step)
+
+                cursor.execute(self.sql("INSERT INTO SchemaVersion (Version, Description, AppliedAt) VALUES (%s, %s, %s)"),
+                    (version, description, datetime.datetime.now().isoformat(' ', 'seconds')))
+                self.migration_applied(cursor)
+
+    def migration_applied(self, cursor):
+        """Called after each migration, lets a backend commit it before the next one starts."""
+
+    def hot_queries(self):
+        """(name, statement, sample params, tables that may be scanned) for each query on a hot path."""
+        today = datetime.date.today().isoformat()
+        keyWhereSQL = self.schedule_key_where()
+        return [
+            ('load user', self.loadUserSQL, (0,), ()),
+            # Reads every subscription not yet notified today by design
+            ('pending subscriptions', self.pendingSubscriptionsSQL, (today,), ('NotificationSubscription', 'RegisteredUsers')),
+            ('claim notifications', self.claim_select_sql(1), (today, 0, ''), ()),
+            ('due outbox', self.dueOutboxSQL, (today, 1), ()),
+            ('next outbox attempt', self.nextOutboxAttemptSQL, (), ()),
+            ('remove subscription', self.removeSubscriptionSQL, (0, ''), ()),
+            ('remove all subscriptions', self.removeAllSubscriptionsSQL, (0,), ()),
+            ('load schedule', self.load_schedule_sql(), (today,), ()),
+            ('study rooms', self.load_schedule_sql() + " AND ClassCode = %s", (today, 'Study Room'), ()),
+            ('schedule delta', "DELETE FROM ScrappedData WHERE " + keyWhereSQL, ('', None, '', '00:00', today), ()),
+        ]
+
+    #Users
+    loadUserSQL = """SELECT RegisteredUsers.TelegramID, RegisteredUsers.UniversityType, RegisteredUsers.StudentType, NotificationSubscription.ClassCode
+        FROM RegisteredUsers
+        LEFT JOIN NotificationSubscription ON NotificationSubscription.TelegramID = RegisteredUsers.TelegramID
+        WHERE RegisteredUsers.TelegramID = %s"""
+    removeSubscriptionSQL = "DELETE FROM NotificationSubscription WHERE TelegramID = %s AND ClassCode = %s"
+    removeAllSubscriptionsSQL = "DELETE FROM NotificationSubscription WHERE TelegramID = %s"
+
+    def load_user(self, telegramId):
+        """Return (TelegramID, UniversityType, StudentType, ClassCode) rows, ClassCode is None without subscriptions."""
+        return self.query(self.loadUserSQL, (telegramId,))
+
+    def add_user(self, telegramId, universityType, studentType):
+        with self.transaction() as cursor:
+            cursor.execute(self.sql("INSERT INTO RegisteredUsers (TelegramID, UniversityType, StudentType) VALUES (%s, %s, %s)"),
+                (telegramId, universityType, studentType))
+
+    def set_student_type(self, telegramId, studentType):
+        with self.transaction() as cursor:
+            cursor.execute(self.sql("UPDATE RegisteredUsers SET StudentType = %s WHERE TelegramID = %s"), (studentType, telegramId))
+
+    def delete_user(self, telegramId):
+        """Delete a user's subscriptions, then their account."""
+        with self.transaction() as cursor:
+            cursor.execute(self.sql("DELETE FROM NotificationSubscription WHERE TelegramID = %s"), (telegramId,))
+            cursor.execute(self.sql("DELETE FROM RegisteredUsers WHERE TelegramID = %s"), (telegramId,))
+
+    def add_subscriptions(self, telegramId, classCodes):
+        """Subscribe a user to several classes in one statement, classes already subscribed are skipped."""
+        if not classCodes:
+            return
+        with self.transaction() as cursor:
+            cursor.execute(self.sql("INSERT IGNORE INTO NotificationSubscription (TelegramID, ClassCode) VALUES "
+                + ", ".join(["(%s, %s)"] * len(classCodes))),
+                [x for classCode in classCodes for x in (telegramId, normalize_class_code(classCode))])
+
+    def remove_subscriptions(self, telegramId, classCode=None):
+        """Remove one subscription, or all of a user's subscriptions when classCode is None. Returns how many were removed."""
+        with self.transaction() as cursor:
+            if classCode is None:
+                cursor.execute(self.sql(self.removeAllSubscriptionsSQL), (telegramId,))
+            else:
+                cursor.execute(self.sql(self.removeSubscriptionSQL), (telegramId, classCode))
+            return cursor.rowcount
+
+    #Notifications
+    pendingSubscriptionsSQL = """SELECT RegisteredUsers.TelegramID, RegisteredUsers.StudentType, RegisteredUsers.UniversityType, NotificationSubscription.ClassCode, NotificationSubscription.LastNotifiedDate
+        FROM NotificationSubscription
+        JOIN RegisteredUsers ON RegisteredUsers.TelegramID = NotificationSubscription.TelegramID
+        WHERE NotificationSubscription.LastNotifiedDate IS NULL OR NotificationSubscription.LastNotifiedDate < %s"""
+
+    def pending_subscriptions(self, today):
+        """Return (TelegramID, StudentType, UniversityType, ClassCode, LastNotifiedDate) rows not yet notified today."""
+        return self.query(self.pendingSubscriptionsSQL, (today.isoformat(),))
+
+    def claim_select_sql(self, keyCount):
+        return ("SELECT TelegramID, ClassCode FROM NotificationSubscription "
+            "WHERE (LastNotifiedDate IS NULL OR LastNotifiedDate < %s) "
+            "AND (TelegramID, ClassCode) IN (" + self.key_list(keyCount) + ")")
+
+    def enqueue_notifications(self, notifications, now):
+        """Claim (TelegramID, ClassCode, text, class start) notifications and write them to the outbox, due at `now`.
+
+        Claiming stamps LastNotifiedDate with today's date, so only keys not yet
+        notified today are claimed, and only those are written to
+        NotificationOutbox. Both happen in one transaction, so a notification
+        is either still pending in the subscription table or waiting in the
+        outbox, never lost in between. Returns the set of claimed keys.
+        """
+        claimedKeys = set()
+        if not notifications:
+            return claimedKeys
+
+        today = now.date()
+        subscriptionKeys = [(x[0], x[1]) for x in notifications]
+        with self.transaction() as cursor:
+            for i in range(0, len(subscriptionKeys), self.keyBatchSize):
+                keyBatch = subscriptionKeys[i:i + self.keyBatchSize]
+                keyValues = (today.isoformat(),) + tuple(value for key in keyBatch for value in key)
+
+                cursor.execute(self.sql(self.claim_select_sql(len(keyBatch)) + self.lockRowsSQL), keyValues)
+                claimedKeys.update((row[0], row[1]) for row in cursor.fetchall())
+
+                cursor.execute(self.sql("UPDATE NotificationSubscription SET LastNotifiedDate = %s "
+                    "WHERE (LastNotifiedDate IS NULL OR LastNotifiedDate < %s) "
+                    "AND (TelegramID, ClassCode) IN (" + self.key_list(len(keyBatch)) + ")"), (today.isoformat(),) + keyValues)
+
+            outboxRows = [(x[0], x[1], today.isoformat(), x[2], sql_datetime(x[3]), sql_datetime(now))
+                for x in notifications if (x[0], x[1]) in claimedKeys]
+            if outboxRows:
+                cursor.executemany(self.sql("INSERT IGNORE INTO NotificationOutbox "
+                    "(TelegramID, ClassCode, NotifyDate, MessageText, ClassStart, NextAttemptAt) "
+                    "VALUES (%s, %s, %s, %s, %s, %s)"), outboxRows)
+
+        return claimedKeys
+
+    #Outbox
+    dueOutboxSQL = """SELECT OutboxID, TelegramID, ClassCode, MessageText, ClassStart, Attempts
+        FROM NotificationOutbox
+        WHERE Status = 'pending' AND NextAttemptAt <= %s
+        ORDER BY NextAttemptAt
+        LIMIT %s"""
+    nextOutboxAttemptSQL = "SELECT MIN(NextAttemptAt) FROM NotificationOutbox WHERE Status = 'pending'"
+
+    def due_outbox(self, now, limit):
+        """Return up to `limit` (OutboxID, TelegramID, ClassCode, MessageText, ClassStart, Attempts) rows due by `now`."""
+        return self.query(self.dueOutboxSQL, (sql_datetime(now), limit))
+
+    def next_outbox_attempt(self):
+        """Return when the earliest pending outbox row is due, None if there are none."""
+        return self.query(self.nextOutboxAttemptSQL)[0][0]
+
+    def settle_outbox(self, sentIds, retries, failedIds, now):
+        """Mark outbox rows sent, reschedule (OutboxID, next attempt) retries and give up on failedIds, in one transaction."""
+        with self.transaction() as cursor:
+            if sentIds:
+                cursor.executemany(self.sql("UPDATE NotificationOutbox SET Status = 'sent', Attempts = Attempts + 1, SentAt = %s "
+                    "WHERE OutboxID = %s"), [(sql_datetime(now), outboxId) for outboxId in sentIds])
+            if retries:
+                cursor.executemany(self.sql("UPDATE NotificationOutbox SET Attempts = Attempts + 1, NextAttemptAt = %s "
+                    "WHERE OutboxID = %s"), [(sql_datetime(retryAt), outboxId) for outboxId, retryAt in retries])
+            if failedIds:
+                cursor.executemany(self.sql("UPDATE NotificationOutbox SET Status = 'failed', Attempts = Attempts + 1 "
+                    "WHERE OutboxID = %s"), [(outboxId,) for outboxId in failedIds])
+
+    #Leases
+    def acquire_lease(self, name, holder, ttl):
+        """Take or renew lease `name` for `ttl` seconds if it is free, expired or already `holder`'s. Returns True if held."""
+        with self.transaction() as cursor:
+            cursor.execute(self.sql("INSERT IGNORE INTO DaemonLease (Name, Holder, ExpiresAt) VALUES (%s, '', 0)"), (name,))
+            cursor.execute(self.sql("UPDATE DaemonLease SET Holder = %s, ExpiresAt = " + self.clockSQL + " + %s "
+                "WHERE Name = %s AND (Holder = %s OR ExpiresAt < " + self.clockSQL + ")"), (holder, ttl, name, holder))
+            cursor.execute(self.sql("SELECT Holder FROM DaemonLease WHERE Name = %s"), (name,))
+            return cursor.fetchone()[0] == holder
+
+    def release_lease(self, name, holder):
+        """Expire lease `name` now if `holder` has it, so another replica can take over straight away."""
+        with self.transaction() as cursor:
+            cursor.execute(self.sql("UPDATE DaemonLease SET ExpiresAt = 0 WHERE Name = %s AND Holder = %s"), (name, holder))
+
+    def record_run(self, name):
+        """Stamp daemon `name` as having just run, on the database server's clock."""
+        with self.transaction() as cursor:
+            cursor.execute(self.sql("INSERT IGNORE INTO DaemonRun (Name, LastRunAt) VALUES (%s, 0)"), (name,))
+            cursor.execute(self.sql("UPDATE DaemonRun SET LastRunAt = " + self.clockSQL + " WHERE Name = %s"), (name,))
+
+    def seconds_since_run(self, name):
+        """Seconds since any replica last ran daemon `name`, None if none ever has."""
+        runRows = self.query("SELECT " + self.clockSQL + " - LastRunAt FROM DaemonRun WHERE Name = %s", (name,))
+        return runRows[0][0] if runRows else None
+
+    def prune_outbox(self, before):
+        """Delete outbox rows for days before `before`."""
+        with self.transaction() as cursor:
+            cursor.execute(self.sql("DELETE FROM NotificationOutbox WHERE NotifyDate < %s"), (before.isoformat(),))
+
+    #Schedule
+    def load_schedule_sql(self):
+        return "SELECT " + ", ".join(SCHEDULE_COLUMNS) + " FROM ScrappedData WHERE Date = %s"
+
+    def schedule_key_where(self):
+        # Null-safe comparison as study rooms have no StudentType
+        return " AND ".join(SCHEDULE_COLUMNS[i] + " <=> %s" for i in SCHEDULE_KEY_INDEXES)
+
+    def load_schedule(self, date):
+        """Return the ScrappedData rows for one day, with Date as a date and StartTime as a timedelta."""
+        return self.query(self.load_schedule_sql(), (date.isoformat(),))
+
+    def class_codes(self):
+        """Return the distinct (UniversityType, ClassCode) pairs in ScrappedData."""
+        return self.query("SELECT DISTINCT UniversityType, ClassCode FROM ScrappedData")
+
+    def replace_schedule(self, scheduleRows):
+        """Replace everything in ScrappedData with `scheduleRows`, readers see either the old or new schedule.
+
+        `scheduleRows` may be a generator, rows are written in batches as they
+        arrive.
+        """
+        ingestStart = time.monotonic()
+        rowCount = self._write_schedule(iter(scheduleRows))
+
+        ingestSeconds = time.monotonic() - ingestStart
+        ingestDuration.observe(ingestSeconds, 'full')
+        ingestRows.inc('full', amount=rowCount)
+        logger.info('Ingested %d schedule rows in %.2fs (%.0f rows/sec)', rowCount, ingestSeconds,
+            rowCount / ingestSeconds if ingestSeconds > 0 else 0)
+
+        return rowCount
+
+    @abc.abstractmethod
+    def _write_schedule(self, scheduleRows):
+        """Replace ScrappedData with the rows from the `scheduleRows` iterator atomically, returns the row count."""
+
+    def _insert_schedule_rows(self, cursor, table, scheduleRows):
+        insertDataSQL = self.sql("INSERT INTO " + table + " (" + ", ".join(SCHEDULE_COLUMNS) + ") VALUES ("
+            + ", ".join(["%s"] * len(SCHEDULE_COLUMNS)) + ")")
+        rowCount = 0
+        while True:
+            batch = list(itertools.islice(scheduleRows, INGEST_BATCH_SIZE))
+            if not batch:
+                break
+            cursor.executemany(insertDataSQL, batch)
+            rowCount += len(batch)
+
+        return rowCount
+
+    def apply_schedule_delta(self, delta):
+        """Write only the rows in `delta` to ScrappedData in a single transaction."""
+        deltaStart = time.monotonic()
+        valueColumns = [SCHEDULE_COLUMNS[i] for i in SCHEDULE_VALUE_INDEXES]
+        keyWhereSQL = self.schedule_key_where()
+
+        with self.transaction() as cursor:
+            if delta.removed:
+                deleteDataSQL = "DELETE FROM ScrappedData WHERE " + keyWhereSQL
+                cursor.executemany(self.sql(deleteDataSQL), delta.removed)
+
+            if delta.changed:
+                updateDataSQL = ("UPDATE ScrappedData SET " + ", ".join(column + " = %s" for column in valueColumns)
+                    + " WHERE " + keyWhereSQL)
+                cursor.executemany(self.sql(updateDataSQL), [tuple(row[i] for i in SCHEDULE_VALUE_INDEXES + SCHEDULE_KEY_INDEXES)
+                    for row in delta.changed])
+
+            if delta.inserted:
+                self._insert_schedule_rows(cursor, "ScrappedData", iter(delta.inserted))
+
+        ingestDuration.observe(time.monotonic() - deltaStart, 'incremental')
+        ingestRows.inc('incremental', amount=len(delta.inserted) + len(delta.changed) + len(delta.removed))
+        logger.info('Schedule delta applied: %d inserted, %d changed, %d removed',
+            len(delta.inserted), len(delta.changed), len(delta.removed))
+
+def mysql_add_notified_date(storage, cursor):
+    """Replace the DailyNotifCount counter with a LastNotifiedDate stamp, if an older version has not already.
+
+    Subscriptions already notified today keep their state. DailyNotifCount is
+    left in place but no longer used, so an older version can still be rolled
+    back to.
+    """
+    cursor.execute("SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() "
+        "AND TABLE_NAME = 'NotificationSubscription' AND COLUMN_NAME = 'LastNotifiedDate'")
+    if cursor.rowcount > 0:
+        return
+
+    cursor.execute("ALTER TABLE NotificationSubscription ADD COLUMN LastNotifiedDate DATE NULL")
+    cursor.execute("UPDATE NotificationSubscription SET LastNotifiedDate = CURDATE() WHERE DailyNotifCount > 0")
+
+def mysql_log_dropped_rows(storage, cursor):
+    cursor.execute("SELECT (SELECT COUNT(*) FROM RegisteredUsersLegacy) - (SELECT COUNT(*) FROM RegisteredUsers), "
+        "(SELECT COUNT(*) FROM NotificationSubscriptionLegacy) - (SELECT COUNT(*) FROM NotificationSubscription)")
+    droppedUsers, droppedSubscriptions = cursor.fetchone()
+    if droppedUsers or droppedSubscriptions:
+        logger.warning('Dropped %d duplicate users and %d duplicate or orphaned subscriptions while adding keys',
+            droppedUsers, droppedSubscriptions)
+
+MYSQL_MIGRATIONS = (
+    (1, "Create the tables", (
+        """CREATE TABLE IF NOT EXISTS RegisteredUsers (
+            TelegramID BIGINT NOT NULL,
+            UniversityType VARCHAR(3) NOT NULL,
+            StudentType VARCHAR(2) NOT NULL DEFAULT 'ND'
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+        """CREATE TABLE IF NOT EXISTS NotificationSubscription (
+            TelegramID BIGINT NOT NULL,
+            ClassCode VARCHAR(64) NOT NULL,
+            DailyNotifCount INT NOT NULL DEFAULT 0
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+        """CREATE TABLE IF NOT EXISTS ScrappedData (
+            StudentType VARCHAR(2) NULL,
+            UniversityType VARCHAR(3) NULL,
+            ClassCode VARCHAR(64) NOT NULL,
+            ClassLoc VARCHAR(128) NOT NULL,
+            StartTime TIME NOT NULL,
+            Date DATE NOT NULL,
+            Duration VARCHAR(32) NULL,
+            PGroupName VARCHAR(128) NULL,
+            dataIssueExists TINYINT(1) NULL,
+            dataIssue VARCHAR(512) NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+    )),
+    (2, "Track notifications with NotificationSubscription.LastNotifiedDate", (
+        mysql_add_notified_date,
+    )),
+    # Tables created by hand may have no keys at all, so both are rebuilt and
+    # swapped in, dropping duplicate users and duplicate or orphaned subscriptions
+    (3, "Add primary keys, a cascading foreign key and schedule indexes", (
+        """CREATE TABLE RegisteredUsersKeyed (
+            TelegramID BIGINT NOT NULL,
+            UniversityType VARCHAR(3) NOT NULL,
+            StudentType VARCHAR(2) NOT NULL DEFAULT 'ND',
+            PRIMARY KEY (TelegramID)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+        "INSERT IGNORE INTO RegisteredUsersKeyed (TelegramID, UniversityType, StudentType) "
+            "SELECT TelegramID, UniversityType, StudentType FROM RegisteredUsers",
+        "RENAME TABLE RegisteredUsers TO RegisteredUsersLegacy, RegisteredUsersKeyed TO RegisteredUsers",
+        """CREATE TABLE NotificationSubscriptionKeyed (
+            TelegramID BIGINT NOT NULL,
+            ClassCode VARCHAR(64) NOT NULL,
+            DailyNotifCount INT NOT NULL DEFAULT 0,
+            LastNotifiedDate DATE NULL,
+            PRIMARY KEY (TelegramID, ClassCode),
+            KEY NotificationSubscriptionNotified (LastNotifiedDate),
+            CONSTRAINT NotificationSubscriptionUser FOREIGN KEY (TelegramID)
+                REFERENCES RegisteredUsers (TelegramID) ON DELETE CASCADE
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+        "INSERT IGNORE INTO NotificationSubscriptionKeyed (TelegramID, ClassCode, DailyNotifCount, LastNotifiedDate) "
+            "SELECT NotificationSubscription.TelegramID, NotificationSubscription.ClassCode, "
+            "NotificationSubscription.DailyNotifCount, NotificationSubscription.LastNotifiedDate "
+            "FROM NotificationSubscription JOIN RegisteredUsers ON RegisteredUsers.TelegramID = NotificationSubscription.TelegramID",
+        "RENAME TABLE NotificationSubscription TO NotificationSubscriptionLegacy, NotificationSubscriptionKeyed TO NotificationSubscription",
+        mysql_log_dropped_rows,
+        "DROP TABLE NotificationSubscriptionLegacy, RegisteredUsersLegacy",
+        # Loading today's schedule and matching delta rows, then lookups by class
+        "ALTER TABLE ScrappedData ADD INDEX ScrappedDataDate (Date, ClassCode, StudentType), "
+            "ADD INDEX ScrappedDataClassCode (ClassCode, Date)",
+        # The next ingest copies its staging table from ScrappedData, indexes included
+        "DROP TABLE IF EXISTS ScrappedDataStaging",
+    )),
+    (4, "Add the notification outbox", (
+        """CREATE TABLE NotificationOutbox (
+            OutboxID BIGINT NOT NULL AUTO_INCREMENT,
+            TelegramID BIGINT NOT NULL,
+            ClassCode VARCHAR(64) NOT NULL,
+            NotifyDate DATE NOT NULL,
+            MessageText TEXT NOT NULL,
+            ClassStart DATETIME NOT NULL,
+            Status VARCHAR(8) NOT NULL DEFAULT 'pending',
+            Attempts INT NOT NULL DEFAULT 0,
+            NextAttemptAt DATETIME NOT NULL,
+            SentAt DATETIME NULL,
+            PRIMARY KEY (OutboxID),
+            UNIQUE KEY NotificationOutboxKey (TelegramID, ClassCode, NotifyDate),
+            KEY NotificationOutboxDue (Status, NextAttemptAt),
+            KEY NotificationOutboxDate (NotifyDate),
+            CONSTRAINT NotificationOutboxUser FOREIGN KEY (TelegramID)
+                REFERENCES RegisteredUsers (TelegramID) ON DELETE CASCADE
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+    )),
+    (5, "Add daemon leases for leader election", (
+        """CREATE TABLE DaemonLease (
+            Name VARCHAR(32) NOT NULL,
+            Holder VARCHAR(128) NOT NULL,
+            ExpiresAt DOUBLE NOT NULL,
+            PRIMARY KEY (Name)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+    )),
+    (6, "Store class codes in upper case", (
+        # Codes that only differ in case are the same class, keep one subscription per user
+        "UPDATE IGNORE NotificationSubscription SET ClassCode = UPPER(ClassCode) WHERE BINARY ClassCode <> UPPER(ClassCode)",
+        "DELETE FROM NotificationSubscription WHERE BINARY ClassCode <> UPPER(ClassCode)",
+        "UPDATE IGNORE NotificationOutbox SET ClassCode = UPPER(ClassCode) WHERE BINARY ClassCode <> UPPER(ClassCode)",
+        "UPDATE IGNORE ScrappedData SET ClassCode = UPPER(ClassCode) WHERE BINARY ClassCode <> UPPER(ClassCode) AND ClassCode <> 'Study Room'",
+    )),
+    (7, "Record when daemons last ran", (
+        """CREATE TABLE DaemonRun (
+            Name VARCHAR(32) NOT NULL,
+            LastRunAt DOUBLE NOT NULL,
+            PRIMARY KEY (Name)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4""",
+    )),
 )
 
+class MySQLStorage(SQLStorage):
+    """The original MySQL/MariaDB store, shared through a ConnectionPool."""
+
+    lockRowsSQL = " FOR UPDATE"
+    clockSQL = "UNIX_TIMESTAMP(NOW(3))"
+    migrations = MYSQL_MIGRATIONS
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.concurrency = pool.size
+
+    @contextmanager
+    def transaction(self):
+        # The pool rolls back if the block raises
+        with self.pool.connection() as conn:
+            yield conn.cursor(buffered=True)
+            conn.commit()
+
+    def query(self, statement, params=()):
+        with self.pool.connection() as conn:
+            queryCursor = conn.cursor(buffered=True)
+            queryCursor.execute(statement, params)
+            return queryCursor.fetchall()
+
+    @contextmanager
+    def schema_lock(self):
+        # DDL commits implicitly in MySQL, so a named lock guards the whole run instead of a transaction
+        with self.pool.connection() as conn:
+            migrateCursor = conn.cursor(buffered=True)
+            migrateCursor.execute("SELECT GET_LOCK('kapbot_schema', 300)")
+            # 0 on timeout, NULL on error, either way another instance may be migrating
+            if migrateCursor.fetchone()[0] != 1:
+                raise RuntimeError('Could not take the schema migration lock within 300 seconds')
+            try:
+                yield migrateCursor
+                conn.commit()
+            finally:
+                migrateCursor.execute("SELECT RELEASE_LOCK('kapbot_schema')")
+
+    def migration_applied(self, cursor):
+        cursor.execute("COMMIT")
+
+    def explain(self, statement, params=()):
+        with self.pool.connection() as conn:
+            explainCursor = conn.cursor(buffered=True)
+            explainCursor.execute("EXPLAIN " + statement, params)
+            columns = explainCursor.column_names
+            plan = [dict(zip(columns, row)) for row in explainCursor.fetchall()]
+
+        # A table with no usable index is read in full, one whose index the
+        # optimizer skipped because the table is still tiny is not flagged
+        return [(step['table'], step['type'] == 'ALL' and not step['possible_keys'],
+            'type=%s key=%s rows=%s' % (step['type'], step['key'], step['rows'])) for step in plan if step['table']]
+
+    def _write_schedule(self, scheduleRows):
+        # Load a staging table and swap it in, MySQL performs the RENAME atomically for both tables
+        with self.pool.connection() as conn:
+            ingestCursor = conn.cursor()
+            ingestCursor.execute("DROP TABLE IF EXISTS ScrappedDataStaging")
+            ingestCursor.execute("CREATE TABLE ScrappedDataStaging LIKE ScrappedData")
+
+            rowCount = self._insert_schedule_rows(ingestCursor, "ScrappedDataStaging", scheduleRows)
+            conn.commit()
+
+            # Swap tables, then throw away the previous schedule
+            ingestCursor.execute("RENAME TABLE ScrappedData TO ScrappedDataOld, ScrappedDataStaging TO ScrappedData")
+            ingestCursor.execute("DROP TABLE ScrappedDataOld")
+
+        return rowCount
+
+    def stats(self):
+        return self.pool.stats()
+
+SQLITE_MIGRATIONS = (
+    (1, "Create the tables", (
+        """CREATE TABLE IF NOT EXISTS RegisteredUsers (
+            TelegramID INTEGER PRIMARY KEY,
+            UniversityType TEXT NOT NULL,
+            StudentType TEXT NOT NULL DEFAULT 'ND'
+        )""",
+        """CREATE TABLE IF NOT EXISTS NotificationSubscription (
+            TelegramID INTEGER NOT NULL,
+            ClassCode TEXT NOT NULL,
+            LastNotifiedDate TEXT,
+            PRIMARY KEY (TelegramID, ClassCode)
+        )""",
+        """CREATE TABLE IF NOT EXISTS ScrappedData (
+            StudentType TEXT,
+            UniversityType TEXT,
+            ClassCode TEXT,
+            ClassLoc TEXT,
+            StartTime TEXT,
+            Date TEXT,
+            Duration TEXT,
+            PGroupName TEXT,
+            dataIssueExists INTEGER,
+            dataIssue TEXT
+        )""",
+    )),
+    # SQLite cannot add a foreign key to an existing table, so it is rebuilt
+    (2, "Add a cascading foreign key and schedule indexes", (
+        """CREATE TABLE NotificationSubscriptionKeyed (
+            TelegramID INTEGER NOT NULL REFERENCES RegisteredUsers (TelegramID) ON DELETE CASCADE,
+            ClassCode TEXT NOT NULL,
+            LastNotifiedDate TEXT,
+            PRIMARY KEY (TelegramID, ClassCode)
+        ) WITHOUT ROWID""",
+        "INSERT OR IGNORE INTO NotificationSubscriptionKeyed (TelegramID, ClassCode, LastNotifiedDate) "
+            "SELECT TelegramID, ClassCode, LastNotifiedDate FROM NotificationSubscription "
+            "WHERE TelegramID IN (SELECT TelegramID FROM RegisteredUsers)",
+        "DROP TABLE NotificationSubscription",
+        "ALTER TABLE NotificationSubscriptionKeyed RENAME TO NotificationSubscription",
+        "CREATE INDEX NotificationSubscriptionNotified ON NotificationSubscription (LastNotifiedDate)",
+        # Loading today's schedule and matching delta rows, then lookups by class
+        "CREATE INDEX ScrappedDataDate ON ScrappedData (Date, ClassCode, StudentType)",
+        "CREATE INDEX ScrappedDataClassCode ON ScrappedData (ClassCode, Date)",
+    )),
+    (3, "Add the notification outbox", (
+        """CREATE TABLE NotificationOutbox (
+            OutboxID INTEGER PRIMARY KEY,
+            TelegramID INTEGER NOT NULL REFERENCES RegisteredUsers (TelegramID) ON DELETE CASCADE,
+            ClassCode TEXT NOT NULL,
+            NotifyDate TEXT NOT NULL,
+            MessageText TEXT NOT NULL,
+            ClassStart TEXT NOT NULL,
+            Status TEXT NOT NULL DEFAULT 'pending',
+            Attempts INTEGER NOT NULL DEFAULT 0,
+            NextAttemptAt TEXT NOT NULL,
+            SentAt TEXT
+        )""",
+        "CREATE UNIQUE INDEX NotificationOutboxKey ON NotificationOutbox (TelegramID, ClassCode, NotifyDate)",
+        "CREATE INDEX NotificationOutboxDue ON NotificationOutbox (Status, NextAttemptAt)",
+        "CREATE INDEX NotificationOutboxDate ON NotificationOutbox (NotifyDate)",
+    )),
+    (4, "Add daemon leases for leader election", (
+        """CREATE TABLE DaemonLease (
+            Name TEXT NOT NULL PRIMARY KEY,
+            Holder TEXT NOT NULL,
+            ExpiresAt REAL NOT NULL
+        )""",
+    )),
+    (5, "Store class codes in upper case", (
+        # Codes that only differ in case are the same class, keep one subscription per user
+        "UPDATE OR IGNORE NotificationSubscription SET ClassCode = UPPER(ClassCode) WHERE ClassCode <> UPPER(ClassCode)",
+        "DELETE FROM NotificationSubscription WHERE ClassCode <> UPPER(ClassCode)",
+        "UPDATE OR IGNORE NotificationOutbox SET ClassCode = UPPER(ClassCode) WHERE ClassCode <> UPPER(ClassCode)",
+        "UPDATE ScrappedData SET ClassCode = UPPER(ClassCode) WHERE ClassCode <> UPPER(ClassCode) AND ClassCode <> 'Study Room'",
+    )),
+    (6, "Record when daemons last ran", (
+        """CREATE TABLE DaemonRun (
+            Name TEXT NOT NULL PRIMARY KEY,
+            LastRunAt REAL NOT NULL
+        )""",
+    )),
+)
+
+class SQLiteStorage(SQLStorage):
+    """Embedded store in a single SQLite file, for single node deployments, benchmarks and tests.
+
+    Each thread gets its own connection. The database runs in WAL mode so
+    readers never block on the writer, and statements are kept in sqlite3's
+    per connection statement cache so they are only prepared once.
+    """
+
+    clockSQL = "((julianday('now') - 2440587.5) * 86400.0)"
+    migrations = SQLITE_MIGRATIONS
+
+    def __init__(self, path, timeout=30, concurrency=4):
+        self.path = path
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.local = threading.local()
+        self.connectionLock = threading.Lock()
+        self.connections = 0
+
+    def sql(self, statement):
+        return sqlite_statement(statement)
+
+    def key_list(self, keyCount):
+        return "VALUES " + SQLStorage.key_list(self, keyCount)
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Autocommit mode, transaction() issues BEGIN and COMMIT itself
+            rawConn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, cached_statements=256)
+            rawConn.execute("PRAGMA journal_mode = WAL")
+            rawConn.execute("PRAGMA synchronous = NORMAL")
+            rawConn.execute("PRAGMA foreign_keys = ON")
+            conn = self.local.conn = MeteredConnection(rawConn)
+            with self.connectionLock:
+                self.connections += 1
+
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        # Take the write lock up front so claims cannot interleave
+        cursor = self.connection().cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+
+    def query(self, statement, params=()):
+        queryCursor = self.connection().cursor()
+        queryCursor.execute(self.sql(statement), params)
+        return queryCursor.fetchall()
+
+    @contextmanager
+    def schema_lock(self):
+        # DDL is transactional in SQLite, the whole run commits or rolls back as one
+        with self.transaction() as cursor:
+            yield cursor
+
+    def explain(self, statement, params=()):
+        explainCursor = self.connection().cursor()
+        explainCursor.execute("EXPLAIN QUERY PLAN " + self.sql(statement), params)
+
+        planRows = explainCursor.fetchall()
+        explainCursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        tables = {row[0] for row in explainCursor.fetchall()}
+
+        # Plan rows read like 'SEARCH ScrappedData USING INDEX ...' or 'SCAN RegisteredUsers',
+        # scans of a key list or subquery rather than a table are skipped
+        plan = []
+        for row in planRows:
+            detailWords = row[-1].split()
+            if detailWords[0] in ('SCAN', 'SEARCH') and len(detailWords) > 1:
+                table = detailWords[2] if detailWords[1] == 'TABLE' else detailWords[1]
+                if table in tables:
+                    plan.append((table, detailWords[0] == 'SCAN', row[-1]))
+
+        return plan
+
+    def load_schedule(self, date):
+        return [row[:4] + (sqlite_time(row[4]), datetime.date.fromisoformat(row[5])) + row[6:]
+            for row in SQLStorage.load_schedule(self, date)]
+
+    def due_outbox(self, now, limit):
+        return [row[:4] + (datetime.datetime.fromisoformat(row[4]),) + row[5:]
+            for row in SQLStorage.due_outbox(self, now, limit)]
+
+    def next_outbox_attempt(self):
+        nextAttempt = SQLStorage.next_outbox_attempt(self)
+        return datetime.datetime.fromisoformat(nextAttempt) if nextAttempt is not None else None
+
+    def _write_schedule(self, scheduleRows):
+        # Readers keep their WAL snapshot of the old schedule until COMMIT
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM ScrappedData")
+            return self._insert_schedule_rows(cursor, "ScrappedData", scheduleRows)
+
+    def stats(self):
+        with self.connectionLock:
+            return {'connections': self.connections}
+
+@lru_cache(maxsize=512)
+def sqlite_statement(statement):
+    """Translate a MySQL statement written for SQLStorage to SQLite."""
+    return statement.replace("%s", "?").replace(" <=> ", " IS ").replace("INSERT IGNORE ", "INSERT OR IGNORE ")
+
+def sqlite_time(value):
+    """Parse an 'HH:MM[:SS]' StartTime into the timedelta MySQL returns for TIME columns."""
+    timeParts = [int(part) for part in value.split(':')]
+    return datetime.timedelta(hours=timeParts[0], minutes=timeParts[1], seconds=timeParts[2] if len(timeParts) > 2 else 0)
+
+def open_storage():
+    """Create the storage backend chosen by `backend` under [Storage]."""
+    backend = config.get('Storage', 'backend', fallback='mysql')
+    if backend == 'sqlite':
+        return SQLiteStorage(config.get('Storage', 'path', fallback='kapbot.db'),
+            timeout=config.getfloat('Storage', 'timeout', fallback=30))
+
+    if backend == 'mysql':
+        if mysql is None:
+            raise ImportError('mysql-connector-python is needed for the mysql storage backend')
+
+        # Database connection pool, connections are opened on first use
+        return MySQLStorage(ConnectionPool(
+            config['mysqlDB'].getint('poolSize', 5),
+            config['mysqlDB'].getfloat('poolTimeout', 30),
+            host = config['mysqlDB']['host'],
+            user = config['mysqlDB']['user'],
+            passwd = config['mysqlDB']['passwd'],
+            database = config['mysqlDB']['database']
+        ))
+
+    raise ValueError('Unknown storage backend: ' + backend)
+
+storage = open_storage()
+
+def check_query_plans(storage):
+    """Explain each hot query and return (name, table, plan detail) for every unexpected full table scan."""
+    fullScans = []
+    for name, statement, params, scannedTables in storage.hot_queries():
+        for table, fullScan, detail in storage.explain(statement, params):
+            logger.debug('Query plan for %s: %s %s', name, table, detail)
+            if fullScan and table not in scannedTables:
+                fullScans.append((name, table, detail))
+
+    return fullScans
+
+class ResponseCache(object):
+    """Caches rendered replies until invalidate() is called or they are `ttl` seconds old."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render):
+        """Return the cached reply for `key`, calling `render` to build it on a miss."""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+
+        value = render()
+        with self.lock:
+            # Do not keep a reply rendered from data invalidated meanwhile
+            if generation == self.generation:
+                self.entries[key] = (now, value)
+
+        return value
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+# Rendered replies shared by every user, cleared after each ingest
+responseCache = ResponseCache(config.getfloat('Cache', 'responseTTL', fallback=600))
+
+UserProfile = namedtuple('UserProfile', ['TelegramID', 'UniversityType', 'StudentType', 'subscriptions'])
+
+class UserCache(object):
+    """Bounded LRU cache of user profiles and their subscribed class codes.
+
+    Handlers that change a user's data write the change through to the cache
+    after committing it. A cached None means the user has no account. Entries
+    expire after `ttl` seconds in case another process changed the database.
+    """
+
+    def __init__(self, maxSize, ttl):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, telegramId):
+        """Return (True, profile or None) if cached, otherwise (False, None)."""
+        with self.lock:
+            entry = self.entries.get(telegramId)
+            if entry is None or time.monotonic() - entry[0] >= self.ttl:
+                self.misses += 1
+                return False, None
+
+            self.entries.move_to_end(telegramId)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, telegramId, profile):
+        with self.lock:
+            self.entries[telegramId] = (time.monotonic(), profile)
+            self.entries.move_to_end(telegramId)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def update(self, telegramId, **changes):
+        """Apply field changes to a cached profile, does nothing if the user is not cached."""
+        with self.lock:
+            entry = self.entries.get(telegramId)
+            if entry is not None and entry[1] is not None:
+                self.entries[telegramId] = (entry[0], entry[1]._replace(**changes))
+
+    def add_subscriptions(self, telegramId, classCodes):
+        with self.lock:
+            entry = self.entries.get(telegramId)
+            if entry is not None and entry[1] is not None:
+                added = tuple(x for x in classCodes if x not in entry[1].subscriptions)
+                self.entries[telegramId] = (entry[0], entry[1]._replace(subscriptions=entry[1].subscriptions + added))
+
+    def remove_subscription(self, telegramId, classCode=None):
+        """Drop one subscription from a cached profile, or all of them if `classCode` is None."""
+        with self.lock:
+            entry = self.entries.get(telegramId)
+            if entry is not None and entry[1] is not None:
+                subscriptions = tuple(x for x in entry[1].subscriptions if classCode is not None and x != classCode)
+                self.entries[telegramId] = (entry[0], entry[1]._replace(subscriptions=subscriptions))
+
+    def discard(self, telegramId):
+        with self.lock:
+            self.entries.pop(telegramId, None)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+# Profiles of recently active users
+userCache = UserCache(config.getint('Cache', 'userCacheSize', fallback=10000),
+    config.getfloat('Cache', 'userCacheTTL', fallback=3600))
+
+def load_user(telegramId):
+    """Return the UserProfile of a user, or None if they have no account."""
+    cached, profile = userCache.lookup(telegramId)
+    if cached:
+        return profile
+
+    userResult = storage.load_user(telegramId)
+
+    profile = None
+    if userResult:
+        subscriptions = tuple(x[3] for x in userResult if x[3] is not None)
+        profile = UserProfile(userResult[0][0], userResult[0][1], userResult[0][2], subscriptions)
+
+    userCache.put(telegramId, profile)
+    return profile
+
+class ChatActionSender(object):
+    """Sends chat actions on background threads so handlers never wait for them.
+
+    An action started for a handler is only sent if the handler is still
+    running `threshold` seconds later, a quick reply needs no indicator.
+    Telegram shows an action for about 5 seconds, so the same action is sent
+    to a chat at most once per `window` seconds.
+    """
+
+    def __init__(self, threshold, window, workers):
+        self.threshold = threshold
+        self.window = window
+        self.workers = workers
+        self.condition = threading.Condition()
+        # Heap of (due time, sequence, bot, chat id, action, handle)
+        self.pending = []
+        self.sequence = itertools.count()
+        self.lastSent = {}
+        self.pruneAt = 0
+        self.executor = None
+        self.thread = None
+
+    def begin(self, bot, chatId, action):
+        """Start an action for a handler, returns a handle to pass to end() when it finishes."""
+        if self.threshold <= 0:
+            self.send(bot, chatId, action)
+            return None
+
+        # A handle is a one element list, set to True once the handler is done
+        handle = [False]
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='chat-actions', daemon=True)
+                self.thread.start()
+            heapq.heappush(self.pending, (time.monotonic() + self.threshold, next(self.sequence), bot, chatId, action, handle))
+            self.condition.notify()
+
+        return handle
+
+    def end(self, handle):
+        if handle is not None:
+            handle[0] = True
+
+    def send(self, bot, chatId, action):
+        """Send an action now without waiting for the request, unless the chat is already showing it."""
+        now = time.monotonic()
+        with self.condition:
+            if now >= self.pruneAt:
+                self.lastSent = {k: v for k, v in self.lastSent.items() if now - v[0] < self.window}
+                self.pruneAt = now + self.window
+
+            lastSent = self.lastSent.get(chatId)
+            if lastSent is not None and lastSent[1] == action and now - lastSent[0] < self.window:
+                chatActionsTotal.inc('deduplicated')
+                return
+
+            self.lastSent[chatId] = (now, action)
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                    thread_name_prefix='chat-action')
+
+        self.executor.submit(self.deliver, bot, chatId, action)
+
+    def deliver(self, bot, chatId, action):
+        try:
+            bot.send_chat_action(chat_id=chatId, action=action)
+            chatActionsTotal.inc('sent')
+        except TelegramError as e:
+            chatActionsTotal.inc('failed')
+            logger.debug('Could not send %s to %s: %s', action, chatId, e)
+            with self.condition:
+                self.lastSent.pop(chatId, None)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+
+                delay = self.pending[0][0] - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                _, _, bot, chatId, action, handle = heapq.heappop(self.pending)
+
+            if handle[0]:
+                chatActionsTotal.inc('skipped')
+            else:
+                self.send(bot, chatId, action)
+
+chatActions = ChatActionSender(config.getfloat('ChatActions', 'threshold', fallback=0.5),
+    config.getfloat('ChatActions', 'window', fallback=5),
+    config.getint('ChatActions', 'workers', fallback=2))
+
 # Define typing action
 def send_action(action):
-    """Sends `action` while processing func command."""
+    """Shows `action` in the chat if func command is still processing after the threshold."""
 
     def decorator(func):
         @wraps(func)
         def command_func(*args, **kwargs):
             bot, update = args
-            bot.send_chat_action(chat_id=update.effective_message.chat_id, action=action)
-            return func(bot, update, **kwargs)
+            handle = chatActions.begin(bot, update.effective_message.chat_id, action)
+            try:
+                return func(bot, update, **kwargs)
+            finally:
+                chatActions.end(handle)
         return command_func
     
     return decorator
@@ -67,11 +1492,8 @@ CHOOSING, START_ONBOARDING, UNI_SELECTION, STUDENTTYPE_SELECTION, EDITING_CLASSE
 @send_typing_action
 def start(bot, update):
     # Determine if DB has information on user
-    userExists = False
-    userInfoCursor = kapbotdb.cursor(buffered=True)
-    userInfoCursor.execute("SELECT TelegramID FROM RegisteredUsers WHERE TelegramID = " + str(update.message.from_user.id))
-    if userInfoCursor.rowcount == 1:
-        userExists = True
+    userProfile = load_user(update.message.from_user.id)
+    userExists = userProfile is not None
 
     # Direct to onboarding if user is new
     if userExists == False:
@@ -87,13 +1509,7 @@ def start(bot, update):
         update.message.reply_text("Welcome back to KaplanScheduleBot! 🤖🤖🤖")
 
         #Check if all data complete
-        userInfoCheckCursor = kapbotdb.cursor(buffered=True)
-        queryStudentType = "SELECT * FROM RegisteredUsers WHERE TelegramID = " + str(update.message.from_user.id)
-        userInfoCheckCursor.execute(queryStudentType)
-        
-        userResult = userInfoCheckCursor.fetchone()
-
-        if userResult[2] == "ND":
+        if userProfile.StudentType == "ND":
             update.message.reply_text("⚠️ The bot is still lacking some information about you.")
             update.message.reply_text(
                 "Are you a full-time or part-time student?", 
@@ -102,14 +1518,8 @@ def start(bot, update):
             return STUDENTTYPE_POSTOB_SELECTION
         else:
             stringedClasslist = ""
-            classSubsCursor = kapbotdb.cursor(buffered=True)
-            querySubscriptions = "SELECT ClassCode FROM NotificationSubscription WHERE TelegramID = " + str(update.message.from_user.id)
-            classSubsCursor.execute(querySubscriptions)
-
-            subsResult = classSubsCursor.fetchall()
-
-            for x in subsResult:
-                stringedClasslist = stringedClasslist + "\n" + x[0]
+            for x in userProfile.subscriptions:
+                stringedClasslist = stringedClasslist + "\n" + x
 
             if len(stringedClasslist) == 0:
                 update.message.reply_text("You have not configured me to provide you any class notifications")
@@ -143,11 +1553,38 @@ def onboarding_choice(bot, update, user_data):
 @send_typing_action
 def list_study_rooms(bot, update):
     text = update.message.text
-    studyRoomCursor = kapbotdb.cursor(buffered=True)
-    studyRoomSQL = "SELECT * FROM ScrappedData WHERE ClassCode = 'Study Room'"
-    studyRoomCursor.execute(studyRoomSQL)
 
-    studyRoomResult = studyRoomCursor.fetchall()
+    # Same answer for everyone until the schedule changes
+    studyRoomString = responseCache.get(('studyrooms', datetime.date.today()), render_study_rooms)
+    update.message.reply_text(studyRoomString, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
+
+    if text == "Find-a-study-room":
+        update.message.reply_text("How can I help you today? 😼", 
+        reply_markup=ReplyKeyboardMarkup([['Find-a-study-room'],['Configure classes', 'Account options'],['Bot info']],
+        resize_keyboard=True))
+
+        return RETURNING_SELECTION
+    
+    else:
+        return ConversationHandler.END
+
+@send_typing_action
+def query_class(bot, update, args):
+    classCodes = [normalize_class_code(x) for x in split_class_codes(" ".join(args))]
+    if not classCodes:
+        update.message.reply_text("Send /queryclass followed by one or more unit codes, for example /queryclass ICT380B BBSLSCM28")
+        return
+
+    # Answers come straight from the lookup table built with today's schedule
+    index = current_schedule()
+    classStrings = [index.classReplies.get(x) or "*" + escape_markdown(x) + "*\nNot scheduled today"
+        for x in list(dict.fromkeys(classCodes))[:maxClassesPerMessage]]
+
+    update.message.reply_text("\n\n".join(classStrings) + "\n\n_Data last updated " + str(index.date) + "_",
+        parse_mode=ParseMode.MARKDOWN)
+
+def render_study_rooms():
+    studyRoomResult = current_schedule().studyRooms
 
     date = datetime.datetime.now().strftime("%d-%m-%Y")
 
@@ -157,25 +1594,14 @@ def list_study_rooms(bot, update):
     for x in studyRoomResult:
         studyRoomCounter += 1
 
-        studyRoomString = studyRoomString + "*" + x[3] + "* " + x[6] + "\n"
+        studyRoomString = studyRoomString + "*" + x.ClassLoc + "* " + x.Duration + "\n"
 
-        date = x[5]
+        date = x.Date
 
     if studyRoomCounter == 0:
-        update.message.reply_text("⚠️ There are no study rooms available today", parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
-    else:
-        studyRoomString = studyRoomString + "\n_Data last updated " + str(date) + "_"
-        update.message.reply_text(studyRoomString, parse_mode=ParseMode.MARKDOWN, reply_markup=ReplyKeyboardRemove())
+        return "⚠️ There are no study rooms available today"
 
-    if text == "Find-a-study-room":
-        update.message.reply_text("How can I help you today? 😼", 
-        reply_markup=ReplyKeyboardMarkup([['Find-a-study-room'],['Configure classes', 'Account options'],['Bot info']],
-        resize_keyboard=True))
-
-        return RETURNING_SELECTION
-    
-    else:
-        return ConversationHandler.END
+    return studyRoomString + "\n_Data last updated " + str(date) + "_"
 
 @send_typing_action
 def save_uni_choice(bot, update, user_data):
@@ -189,11 +1615,9 @@ def save_uni_choice(bot, update, user_data):
         universityShortName = "UCD"
 
     # Save user options into DB
-    addNewUserCursor = kapbotdb.cursor(buffered=True)
-    newUserSQL = "INSERT INTO RegisteredUsers (TelegramID, UniversityType, StudentType) VALUES (%s, %s, %s)"
-    newUserVal = (update.message.from_user.id, universityShortName, "ND")
-    addNewUserCursor.execute(newUserSQL, newUserVal)
-    kapbotdb.commit()
+    storage.add_user(update.message.from_user.id, universityShortName, "ND")
+
+    userCache.put(update.message.from_user.id, UserProfile(update.message.from_user.id, universityShortName, "ND", ()))
 
     # Ask the next onboarding question
     update.message.reply_text("Are you a full-time or part-time student?",
@@ -247,7 +1671,7 @@ def bot_info_director(bot, update, user_data):
     chatid = update.message.from_user.id
 
     if text == "Some assurance about privacy":
-        bot.send_chat_action(chat_id=chatid, action=ChatAction.TYPING)
+        chatActions.send(bot, chatid, ChatAction.TYPING)
         update.message.reply_text("This bot respects your privacy and _collects a minimal amount_ of data required for it to function.\n\n"
         "Breakdown of information stored on by the bot:\n1. *Telegram ID* - Recorded to provide a customised experience for your Telegram account, "
         "and to know where to send notifications when the time comes. Note that your Telegram ID differs from your username. In short, it is an ID number "
@@ -257,12 +1681,13 @@ def bot_info_director(bot, update, user_data):
         "Singapore, this bot is not responsible for data accuracy or reliability and availability of this service is not guaranteed._", 
         parse_mode=ParseMode.MARKDOWN)
     elif text == "Why":
-        bot.send_chat_action(chat_id=chatid, action=ChatAction.UPLOAD_PHOTO)
+        chatActions.send(bot, chatid, ChatAction.UPLOAD_PHOTO)
         bot.send_photo(chat_id=chatid, photo=open('such_wow.jpg', 'rb'))
     elif text == "Limitations":
-        bot.send_chat_action(chat_id=chatid, action=ChatAction.TYPING)
+        chatActions.send(bot, chatid, ChatAction.TYPING)
         update.message.reply_text("*Limitations of this bot:*\n1. Currently, switching universities requires you to delete and recreate your account.\n"
-        "2. This bot does not check the class code you entered for validity, please ensure that you enter your class code correctly. Examples below:\n"
+        "2. This bot checks class codes against the class schedule it has seen so far, a class that has not been scheduled yet has to be saved anyway. "
+        "Please ensure that you enter your class code correctly. Examples below:\n"
         "*Murdoch University* - BRD203A\n*Univ. College Dublin* - BBSLSCM28", 
         parse_mode=ParseMode.MARKDOWN)
     elif text == "< Back":
@@ -272,7 +1697,7 @@ def bot_info_director(bot, update, user_data):
 
         return RETURNING_SELECTION
 
-    bot.send_chat_action(chat_id=chatid, action=ChatAction.TYPING)
+    chatActions.send(bot, chatid, ChatAction.TYPING)
     update.message.reply_text(
         "What would you like me to tell you?", 
         reply_markup=ReplyKeyboardMarkup([['Some assurance about privacy'],['Why','Limitations'],['< Back']], 
@@ -281,18 +1706,11 @@ def bot_info_director(bot, update, user_data):
 
 @send_typing_action
 def delete_user_account(bot, update, user_data):
-    deleteAccountCursor = kapbotdb.cursor(buffered=True)
-    deleteUserVal = update.message.from_user.id
-
-    # First delete all notification records
-    deleteNotifSQL = "DELETE FROM NotificationSubscription WHERE TelegramID = " + str(update.message.from_user.id)
-    deleteAccountCursor.execute(deleteNotifSQL)
-    kapbotdb.commit()
+    # Delete all notification records, then the account record
+    storage.delete_user(update.message.from_user.id)
 
-    # Then delete account record
-    deleteAccountSQL = "DELETE FROM RegisteredUsers WHERE TelegramID = " + str(update.message.from_user.id)
-    deleteAccountCursor.execute(deleteAccountSQL)
-    kapbotdb.commit()
+    userCache.put(update.message.from_user.id, None)
+    notificationScheduler.invalidate()
 
     # Confirm deletion with user
     update.message.reply_text("Your account has been deleted, /start if you would like to start over with this bot.", reply_markup=ReplyKeyboardRemove())
@@ -302,18 +1720,13 @@ def delete_user_account(bot, update, user_data):
 @send_typing_action
 def save_studenttype_choice(bot, update, user_data):
     text = update.message.text
-    setStuTypeCursor = kapbotdb.cursor(buffered=True)
-    setStuTypeSQL = "UPDATE RegisteredUsers SET StudentType = %s WHERE TelegramID = %s"
 
     # Add student type of current user to database
-    if text == "FT":
-        setFTStuVal = ("FT", update.message.from_user.id)
-        setStuTypeCursor.execute(setStuTypeSQL, setFTStuVal)
-        kapbotdb.commit()
-    elif text == "PT":
-        setFTStuVal = ("PT", update.message.from_user.id)
-        setStuTypeCursor.execute(setStuTypeSQL, setFTStuVal)
-        kapbotdb.commit()
+    if text in ("FT", "PT"):
+        storage.set_student_type(update.message.from_user.id, text)
+
+    userCache.update(update.message.from_user.id, StudentType=text)
+    notificationScheduler.invalidate()
 
     update.message.reply_text("Your preferences has been saved, please send /start to restart our conversation.", reply_markup=ReplyKeyboardRemove())
 
@@ -322,22 +1735,17 @@ def save_studenttype_choice(bot, update, user_data):
 @send_typing_action
 def save_studenttype_choice_onboarding(bot, update, user_data):
     text = update.message.text
-    setStuTypeCursor = kapbotdb.cursor(buffered=True)
-    setStuTypeSQL = "UPDATE RegisteredUsers SET StudentType = %s WHERE TelegramID = %s"
 
     # Add student type of current user to database
-    if text == "FT":
-        setFTStuVal = ("FT", update.message.from_user.id)
-        setStuTypeCursor.execute(setStuTypeSQL, setFTStuVal)
-        kapbotdb.commit()
-    elif text == "PT":
-        setFTStuVal = ("PT", update.message.from_user.id)
-        setStuTypeCursor.execute(setStuTypeSQL, setFTStuVal)
-        kapbotdb.commit()
+    if text in ("FT", "PT"):
+        storage.set_student_type(update.message.from_user.id, text)
+
+    userCache.update(update.message.from_user.id, StudentType=text)
+    notificationScheduler.invalidate()
 
     # Ask the next onboarding question
-    update.message.reply_text("Next, enter the class code that you wish to be notified of "
-        "with no spaces.\n\n*For example:*\nMurdoch University unit codes look like *ICT380B*"
+    update.message.reply_text("Next, enter the class codes that you wish to be notified of, "
+        "you can send several at once separated by spaces or commas.\n\n*For example:*\nMurdoch University unit codes look like *ICT380B*"
         "\nUCD unit codes look like *BBSLSCM28*.", parse_mode=ParseMode.MARKDOWN)
     update.message.reply_text("Press begin when you are ready!",
         reply_markup=ReplyKeyboardMarkup([['Begin']],
@@ -347,54 +1755,109 @@ def save_studenttype_choice_onboarding(bot, update, user_data):
 
 @send_typing_action
 def add_classes(bot, update, user_data):
-    update.message.reply_text('Alright, please send me a unit code', reply_markup=ReplyKeyboardRemove())
+    update.message.reply_text('Alright, please send me one or more unit codes, separated by spaces or commas',
+        reply_markup=ReplyKeyboardRemove())
 
     return CLASS_CHOICE
 
 @send_typing_action
 def class_choice(bot, update, user_data):
     text = update.message.text
-    addClassResult = add_class_helper(text)
-
-    # Unit code provided was longer than 19 chars
-    if addClassResult == 2:
+    added, duplicates, tooLong, overLimit, unknown = [], [], [], [], []
+
+    userProfile = load_user(update.message.from_user.id)
+    subscriptions = set(normalize_class_code(x) for x in userProfile.subscriptions) if userProfile is not None else set()
+    universityType = userProfile.UniversityType if userProfile is not None else None
+
+    # Codes not found in the schedule last time, confirmed or dropped by the user
+    if text == "Skip":
+        user_data.pop('unknownClasses', None)
+        update.message.reply_text("Would you like to enter another class?",
+            reply_markup=ReplyKeyboardMarkup([['Yes', 'No']], one_time_keyboard=True, resize_keyboard=True))
+        return ADD_ANOTHER_CLASS
+    elif text == "Save anyway":
+        classCodes = user_data.pop('unknownClasses', [])
+        checkCodes = False
+    else:
+        user_data.pop('unknownClasses', None)
+        classCodes = [normalize_class_code(x) for x in split_class_codes(text)]
+        checkCodes = classCodeIndex.covers(universityType)
+
+    # Sort the codes in this message, then save all new ones in one go
+    for i, classCode in enumerate(classCodes):
+        if i >= maxClassesPerMessage:
+            overLimit.append(classCode)
+        elif add_class_helper(classCode) == 2:
+            tooLong.append(classCode)
+        elif classCode in subscriptions or classCode in added:
+            duplicates.append(classCode)
+        elif checkCodes and not classCodeIndex.contains(universityType, classCode):
+            unknown.append(classCode)
+        else:
+            added.append(classCode)
+
+    if added:
+        storage.add_subscriptions(update.message.from_user.id, added)
+
+        userCache.add_subscriptions(update.message.from_user.id, added)
+        notificationScheduler.invalidate()
+
+    # Nothing usable was sent
+    if not added and not duplicates and not unknown:
+        reasons = []
+        if tooLong:
+            reasons.append("The unit code you have entered is too long." if len(tooLong) == 1
+                else "The unit codes you have entered are too long.")
+        if overLimit:
+            reasons.append("Only the first " + str(maxClassesPerMessage) + " codes are taken per message.")
         update.message.reply_text(
-            "The unit code you have entered is too long, try again?",
+            " ".join(reasons) + " Try again?" if reasons
+            else "I could not find a unit code in that message, try again?",
             reply_markup=ReplyKeyboardMarkup([['Try again']],
             one_time_keyboard=True, resize_keyboard=True))
         return EDITING_CLASSES
 
-    elif addClassResult == 1:
-        # Remove spaces from the input
-        text = text.replace(' ', '')
-
-        # First check if the class has been added
-        classExistenceCursor = kapbotdb.cursor(buffered=True)
-        queryClassExistenceSQL = "SELECT ClassCode FROM NotificationSubscription WHERE TelegramID = %s AND ClassCode = %s"
-        queryClassExistenceVal = (update.message.from_user.id, text)
-        classExistenceCursor.execute(queryClassExistenceSQL, queryClassExistenceVal)
-
-        # Insert class to DB if it does not exist
-        if classExistenceCursor.rowcount == 0:
-            classInsertionCursor = kapbotdb.cursor(buffered=True)
-            insertSubsSQL = "INSERT INTO NotificationSubscription (TelegramID, ClassCode) VALUES (%s, %s)"
-            insertSubsVal = (update.message.from_user.id, text)
-            classInsertionCursor.execute(insertSubsSQL, insertSubsVal)
-            kapbotdb.commit()
-
-            update.message.reply_text("Your class " + text + " was successfully saved.\n\nWould you like to "
-                "enter another class?", 
-                reply_markup=ReplyKeyboardMarkup([['Yes', 'No']], one_time_keyboard=True, resize_keyboard=True))
-
-            return ADD_ANOTHER_CLASS
-
-        # Return error message if class already exists
-        if classExistenceCursor.rowcount > 0:
-            update.message.reply_text("🚳 You already have this class in your collection, therefore it was not added."
-            "\n\nWould you like to add another class?", reply_markup=ReplyKeyboardMarkup([['Yes', 'No']], 
+    summary = []
+    if added:
+        summary.append(("Your class " if len(added) == 1 else "Your classes ") + ", ".join(added) + " "
+            + ("was" if len(added) == 1 else "were") + " successfully saved.")
+    if duplicates:
+        summary.append("🚳 Already in your collection, therefore not added: " + ", ".join(duplicates))
+    if tooLong:
+        summary.append("Not added, too long: " + ", ".join(tooLong))
+    if overLimit:
+        summary.append("Not added, only the first " + str(maxClassesPerMessage) + " codes are taken per message: "
+            + ", ".join(overLimit))
+
+    # Offer the closest known codes as buttons, or to save the codes as typed
+    if unknown:
+        user_data['unknownClasses'] = unknown
+        suggestionButtons = []
+        for classCode in unknown:
+            suggestions = classCodeIndex.suggest(universityType, classCode)
+            summary.append("❓ " + classCode + " is not in the class schedule"
+                + (", did you mean " + " or ".join(suggestions) + "?" if suggestions else "."))
+            if suggestions:
+                suggestionButtons.append(suggestions)
+
+        update.message.reply_text("\n".join(summary) + "\n\nPick a suggestion, send the code again, or save it "
+            "anyway if the class has not been scheduled yet.",
+            reply_markup=ReplyKeyboardMarkup(suggestionButtons + [['Save anyway', 'Skip']],
             one_time_keyboard=True, resize_keyboard=True))
 
-            return ADD_ANOTHER_CLASS
+        return CLASS_CHOICE
+
+    update.message.reply_text("\n".join(summary) + "\n\nWould you like to enter another class?",
+        reply_markup=ReplyKeyboardMarkup([['Yes', 'No']], one_time_keyboard=True, resize_keyboard=True))
+
+    return ADD_ANOTHER_CLASS
+
+# Most unit codes accepted from one message
+maxClassesPerMessage = 20
+
+def split_class_codes(text):
+    """Split a message into unit codes, separated by spaces, commas, semicolons or newlines."""
+    return [x for x in re.split(r'[\s,;]+', text) if x]
 
 # This class helper for future expansion
 def add_class_helper(classCode):
@@ -412,18 +1875,16 @@ def remove_classes(bot, update, user_data):
 
         return RETURNING_SELECTION
 
-    # Get info on existing classes from DB
-    removeClassCursor = kapbotdb.cursor(buffered=True)
-    querySubscriptions = "SELECT ClassCode FROM NotificationSubscription WHERE TelegramID = " + str(update.message.from_user.id)
-    removeClassCursor.execute(querySubscriptions)
-    subsResult = removeClassCursor.fetchall()
+    # Get info on existing classes
+    userProfile = load_user(update.message.from_user.id)
+    subsResult = userProfile.subscriptions if userProfile is not None else ()
 
     # Provide users with buttons to delete their class
     classButtonArray = []
     
     # Populate button array
     for x in subsResult:
-        classButtonArray.append(x)
+        classButtonArray.append([x])
 
     # Add a remove all classes button
     classButtonArray.append(["Remove all classes"])
@@ -438,22 +1899,24 @@ def remove_classes(bot, update, user_data):
 @send_typing_action
 def process_class_deletion(bot, update, user_data):
     text = update.message.text
-    classRemovalCursor = kapbotdb.cursor(buffered=True)
 
     if text == "Remove all classes":
-        removeAllSubsSQL = "DELETE FROM NotificationSubscription WHERE TelegramID = " + str(update.message.from_user.id)
-        classRemovalCursor.execute(removeAllSubsSQL)
-        kapbotdb.commit()
+        storage.remove_subscriptions(update.message.from_user.id)
+
+        userCache.remove_subscription(update.message.from_user.id)
+        notificationScheduler.invalidate()
 
         update.message.reply_text("All your classes are gone.")
 
     else:
-        removeSubsSQL = "DELETE FROM NotificationSubscription WHERE TelegramID = %s AND ClassCode = %s"
-        setRemoveSubsVal = (update.message.from_user.id, text)
-        classRemovalCursor.execute(removeSubsSQL, setRemoveSubsVal)
-        kapbotdb.commit()
+        classCode = normalize_class_code(text)
+        if storage.remove_subscriptions(update.message.from_user.id, classCode) > 0:
+            userCache.remove_subscription(update.message.from_user.id, classCode)
+            notificationScheduler.invalidate()
 
-        update.message.reply_text("The class " + text + " was deleted successfully.")
+            update.message.reply_text("The class " + classCode + " was deleted successfully.")
+        else:
+            update.message.reply_text("The class " + classCode + " is not in your list, nothing was deleted.")
 
     update.message.reply_text("Whatcha gonna do with the classes?", 
         reply_markup=ReplyKeyboardMarkup([['Add class', 'Remove class'],['< Back']], 
@@ -486,151 +1949,787 @@ def error(bot, update, error):
     """Log Errors caused by Updates."""
     logger.warning('Update "%s" caused error "%s"', update, error)
 
-def sendNotifications(updater):
-    global notificationsThread
-#send notifications
-    while (True):
-        currentHour = time.strftime("%H", time.localtime())
-        
-        #Reset sent notifications at 1 am, sleep longer at night
-        if (int(currentHour) == 1):
-            resetNotifCountCursor = kapbotdb.cursor(buffered=True)
-            updater.bot.send_message(chat_id=config['TelegramAdmin']['adminAccountID'], text="Notification daemon is going to sleep")
-            resetNotificationCountSQL = "UPDATE NotificationSubscription SET DailyNotifCount = 0"
-            resetNotifCountCursor.execute(resetNotificationCountSQL)
-            kapbotdb.commit()
-
-            #Sleep till 7am
-            time.sleep(21600)
-            updater.bot.send_message(chat_id=config['TelegramAdmin']['adminAccountID'], text="Notification daemon has woken up")
-
-        #Update time incase sleep
-        currentHour = time.strftime("%H", time.localtime())
-        currentMinute = time.strftime("%M", time.localtime())
-        currentSecond = time.strftime("%S", time.localtime())
-
-        #Check for notifications to send by the half hour
-        if (int(currentMinute) > 0 and int(currentMinute) <= 30):
-            sleepDuration = abs(30 - int(currentMinute))
-            time.sleep(sleepDuration * 60)
-        elif (int(currentMinute) > 30 and int(currentMinute) <= 59):
-            sleepDuration = abs(60 - int(currentMinute))
-            time.sleep(sleepDuration * 60)
-
-        #Obtain notifications from DB
-        getScheduleCursor = kapbotdb.cursor(buffered=True)
-        getTodayScheduleSQL = """SELECT RegisteredUsers.TelegramID, RegisteredUsers.StudentType, RegisteredUsers.UniversityType, NotificationSubscription.ClassCode, ScrappedData.ClassLoc, ScrappedData.StartTime, ScrappedData.Date, ScrappedData.Duration, NotificationSubscription.DailyNotifCount
-        FROM NotificationSubscription 
-        LEFT JOIN ScrappedData ON NotificationSubscription.ClassCode = ScrappedData.ClassCode
-        LEFT JOIN RegisteredUsers ON RegisteredUsers.TelegramID = NotificationSubscription.TelegramID
-        WHERE RegisteredUsers.StudentType = ScrappedData.StudentType
-        AND NotificationSubscription.ClassCode = ScrappedData.ClassCode
-        AND ScrappedData.Date = CURDATE();"""
-        
-        getScheduleCursor.execute(getTodayScheduleSQL)
-        
-        notifData = getScheduleCursor.fetchall()
-
-        #Skip notif check if empty 
-        if len(notifData) == 0:
-            time.sleep(60)
-            continue;
-
-        #Update clock after sleep
-        currentHour = time.strftime("%H", time.localtime())
-        currentMinute = time.strftime("%M", time.localtime())
-        currentTime = time.strftime("%H:%M", time.localtime())
-
-        #Send notifications
+class TokenBucket(object):
+    """Thread-safe token bucket, acquire() blocks until a token is available.
+
+    Coroutines use reserve() directly and await the delay it returns.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token if one is available and return 0, otherwise return the seconds to wait."""
+        with self.lock:
+            now = time.monotonic()
+
+            # Paused by a flood wait
+            if now < self.updated:
+                return self.updated - now
+
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            delay = self.reserve()
+            if not delay:
+                return
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """Hand out no tokens for the next `seconds`."""
+        with self.lock:
+            self.tokens = 0
+            self.updated = max(self.updated, time.monotonic() + seconds)
+
+class DispatchBatch(object):
+    """Tracks completion of the messages handed to NotificationDispatcher.send_all."""
+
+    def __init__(self, size):
+        self.remaining = size
+        self.delivered = []
+        self.condition = threading.Condition()
+
+    def done(self, tag, delivered):
+        with self.condition:
+            if delivered:
+                self.delivered.append(tag)
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.condition.notify_all()
+
+    def wait(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.remaining == 0)
+
+class DispatchStats(object):
+    """Delivery counters and latency samples shared by the notification dispatchers."""
+
+    def __init__(self):
+        self.statsLock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.latencies = deque(maxlen=1000)
+        self.lastThroughput = 0.0
+
+    def record_sent(self, latency):
+        dispatchTotal.inc('sent')
+        with self.statsLock:
+            self.sent += 1
+            self.latencies.append(latency)
+
+    def record_failed(self):
+        dispatchTotal.inc('failed')
+        with self.statsLock:
+            self.failed += 1
+
+    def record_retry(self):
+        dispatchTotal.inc('flood_wait')
+        with self.statsLock:
+            self.retried += 1
+
+    def record_batch(self, deliveredCount, totalCount, batchDuration):
+        with self.statsLock:
+            self.lastThroughput = deliveredCount / batchDuration if batchDuration > 0 else 0.0
+
+        logger.info('Dispatched %d of %d notifications in %.2fs (%.1f msg/s)', deliveredCount, totalCount,
+            batchDuration, self.lastThroughput)
+
+    def queue_depth(self):
+        return 0
+
+    def stats(self):
+        with self.statsLock:
+            latencies = sorted(self.latencies)
+            return {
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'queueDepth': self.queue_depth(),
+                'throughput': self.lastThroughput,
+                'latencyP50': latencies[len(latencies) // 2] if latencies else 0.0,
+                'latencyP95': latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+                'latencyMax': latencies[-1] if latencies else 0.0,
+            }
+
+class NotificationDispatcher(DispatchStats):
+    """Sends messages from a pool of worker threads within Telegram's rate limits.
+
+    A token bucket caps the overall send rate, messages to the same chat are
+    spaced `perChatInterval` seconds apart and 429 flood waits pause every
+    worker for the `retry_after` the API asks for before the message is
+    retried.
+    """
+
+    def __init__(self, bot, workers=8, globalRate=30, perChatInterval=1, maxRetries=3):
+        DispatchStats.__init__(self)
+        self.bot = bot
+        self.perChatInterval = perChatInterval
+        self.maxRetries = maxRetries
+        self.jobs = queue.Queue()
+        self.bucket = TokenBucket(globalRate)
+
+        # Earliest time the next message may go to each chat
+        self.chatLock = threading.Lock()
+        self.chatNextSend = {}
+
+        for i in range(workers):
+            worker = threading.Thread(target=self._worker, name='notification-dispatcher-' + str(i))
+            worker.daemon = True
+            worker.start()
+
+    def send_all(self, messages):
+        """Send (chat id, text, tag) messages concurrently, returns the tags of the ones delivered."""
+        if not messages:
+            return []
+
+        batchStart = time.monotonic()
+        batch = DispatchBatch(len(messages))
+        for chatId, text, tag in messages:
+            self.jobs.put((chatId, text, tag, batchStart, 0, batch))
+        batch.wait()
+
+        self.record_batch(len(batch.delivered), len(messages), time.monotonic() - batchStart)
+
+        # Forget chats that are free to receive again
+        with self.chatLock:
+            now = time.monotonic()
+            for chatId in [chatId for chatId, nextSend in self.chatNextSend.items() if nextSend <= now]:
+                del self.chatNextSend[chatId]
+
+        return batch.delivered
+
+    def _worker(self):
+        while True:
+            chatId, text, tag, queuedAt, attempt, batch = self.jobs.get()
+
+            self.bucket.acquire()
+
+            # Reserve the next free slot for this chat
+            with self.chatLock:
+                now = time.monotonic()
+                sendAt = max(now, self.chatNextSend.get(chatId, 0))
+                self.chatNextSend[chatId] = sendAt + self.perChatInterval
+            if sendAt > now:
+                time.sleep(sendAt - now)
+
+            try:
+                self.bot.send_message(chat_id=chatId, text=text, parse_mode=ParseMode.MARKDOWN)
+            except RetryAfter as e:
+                self.bucket.pause(e.retry_after)
+                self.record_retry()
+
+                if attempt < self.maxRetries:
+                    self.jobs.put((chatId, text, tag, queuedAt, attempt + 1, batch))
+                else:
+                    logger.warning('Giving up on notification to %s after %d flood waits', chatId, attempt + 1)
+                    self.record_failed()
+                    batch.done(tag, False)
+            except Exception as e:
+                logger.warning('Could not send notification to %s: %s', chatId, e)
+                self.record_failed()
+                batch.done(tag, False)
+            else:
+                self.record_sent(time.monotonic() - queuedAt)
+                batch.done(tag, True)
+
+    def queue_depth(self):
+        return self.jobs.qsize()
+
+class NotificationScheduler(object):
+    """Priority queue of pending class notifications.
+
+    The queue holds (fire time, class start, subscription row) entries for
+    today and is only rebuilt from the database after invalidate() is called,
+    which happens when the schedule or a subscription changes, and when the
+    day rolls over. Between rebuilds the notification daemon sleeps until the
+    next entry is due.
+    """
+
+    def __init__(self, leadTime, rebuildDelay=10):
+        self.leadTime = leadTime
+        self.rebuildDelay = rebuildDelay
+        self.condition = threading.Condition()
+        self.dirty = True
+        self.lastRebuild = 0
+        self.builtFor = None
+        self.queue = []
+
+        # Called on invalidate(), lets the asyncio runtime wake its notifier
+        self.listeners = []
+
+    def invalidate(self):
+        """Ask for the queue to be rebuilt, wakes the notification daemon."""
+        with self.condition:
+            self.dirty = True
+            self.condition.notify_all()
+
+        for listener in self.listeners:
+            listener()
+
+    def needs_rebuild(self, now):
+        with self.condition:
+            return self.builtFor != now.date() or (self.dirty and time.monotonic() - self.lastRebuild >= self.rebuildDelay)
+
+    def rebuild(self, now):
+        rebuildStart = time.perf_counter()
+        with self.condition:
+            self.dirty = False
+            self.lastRebuild = time.monotonic()
+
+        #Obtain subscriptions not yet notified today from DB
+        subsData = storage.pending_subscriptions(now.date())
+
+        #Match them against today's classes
+        schedule = current_schedule()
+        notifData = []
+        for sub in subsData:
+            for entry in schedule.classes(normalize_class_code(sub[3]), sub[1]):
+                notifData.append((sub[0], sub[1], sub[2], sub[3], entry.ClassLoc, entry.StartTime, entry.Date, entry.Duration, sub[4]))
+
+        queue = []
         for x in notifData:
-            notifCount = x[8]
-
-            #Prevent spam, only one notification per day
-            # getSentCountCursor = kapbotdb.cursor(buffered=True)
-            # getSentCountSQL = "SELECT DailyNotifCount FROM NotificationSubscription WHERE TelegramID = %s AND ClassCode = %s"
-            # getSentCountVals = (x[0], x[3])
-            # getSentCountCursor.execute(getSentCountSQL, getSentCountVals)
-
-            # sentCountData = getSentCountCursor.fetchone()
-
-            # if sentCountData != 0:
-            #     continue
-            
-            if notifCount > 0:
-               continue
-
-            FMT = '%H:%M'
-            dbTimeVal = x[5]
-            trimmedTime = (datetime.datetime.min + dbTimeVal).time()
-            trimmedTime = trimmedTime.strftime(FMT)
-            trimmedTime = trimmedTime[:5]
-
-            tdelta = datetime.datetime.strptime(trimmedTime, FMT) - datetime.datetime.strptime(str(currentTime), FMT)
-            timeInSecs = tdelta.total_seconds()
-            timeInMins = timeInSecs / 60
-            timeInMinsNoDecimal = int(timeInMins)
-
-            #Notif debug
-            threadID = notificationsThread.ident
-
-            notifStringConstruct = "*" + x[3] + " @ " + x[4] + "*" + "\nHappening in ~" + str(timeInMinsNoDecimal) +" minutes\n" + x[7] + "\n*DEBUG MESG.*: This notification was sent by thread " + str(threadID) + "."
-
-            if (timeInMins < 75 and timeInMins >= 0):
-                updater.bot.send_message(chat_id=x[0], text=notifStringConstruct, parse_mode=ParseMode.MARKDOWN)
-
-                #Update notif count
-                notifCount += 1
-                updateNotifCountCursor = kapbotdb.cursor(buffered=True)
-                setNotifCountSQL = "UPDATE NotificationSubscription SET DailyNotifCount = %s WHERE TelegramID = %s AND ClassCode = %s"
-                setNotifCountValues = (notifCount, x[0], x[3])
-                updateNotifCountCursor.execute(setNotifCountSQL, setNotifCountValues)
-                kapbotdb.commit()
-                
-def update_schedule(updater):
-    # This daemon should only run once every two hours at the 15th minute
-    while (True):
-        currentHour = time.strftime("%H", time.localtime())
-        currentMinute = time.strftime("%M", time.localtime())
-        currentSecond = time.strftime("%S", time.localtime())
-
-        #Only check for updates on the 15th minute every even hour
-        sleepDuration = 0
-        if (int(currentHour) % 2 != 0):
-            sleepDuration += 60
-
-        if (int(currentMinute) < 15):
-            sleepDuration += abs(15 - int(currentMinute))
-            time.sleep(sleepDuration * 60)
-        else:
-            sleepDuration += abs(60 - int(currentMinute) + 15)
-            time.sleep(sleepDuration * 60)
-
-        currentHour = time.strftime("%H", time.localtime())
-        
-        #Sleep longer in the morning
-        if (int(currentHour) == 2):
-            time.sleep(4 * 60 * 60)
-
-        #First delete all rows in DB
-        deleteAllScheduleCursor = kapbotdb.cursor(buffered=True)
-        deleteAllRowsSQL = "DELETE FROM ScrappedData"
-        deleteAllScheduleCursor.execute(deleteAllRowsSQL)
-        kapbotdb.commit()
-
-        #Obtain data from source
-        url = "http://webapps.kaplan.com.sg/schedule/schedules2.json"
-        response = urllib.urlopen(url)
-        data = json.loads(response.read())
-
-        #Parse the json
-        insertParsedCursor = kapbotdb.cursor(buffered=True)
+            #Classes that have already started are not worth a notification
+            classStart = datetime.datetime.combine(x[6], datetime.time()) + x[5]
+            if classStart <= now:
+                continue
+
+            # Sequence number keeps entries with the same fire time ordered
+            heapq.heappush(queue, (classStart - self.leadTime, len(queue), classStart, x))
+
+        with self.condition:
+            self.queue = queue
+            self.builtFor = now.date()
+
+        notificationRebuildDuration.observe(time.perf_counter() - rebuildStart)
+
+        logger.info('Notification queue rebuilt with %d pending notifications', len(queue))
+
+    def pop_due(self, now):
+        """Remove and return the (class start, row) of every entry that is due."""
+        due = []
+        with self.condition:
+            while self.queue and self.queue[0][0] <= now:
+                fireTime, seq, classStart, x = heapq.heappop(self.queue)
+                due.append((classStart, x))
+
+        return due
+
+    def seconds_until_wake(self, now, retryAt=None):
+        """Seconds until the next entry is due, the day ends, a pending rebuild may run or `retryAt`."""
+        tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+        with self.condition:
+            wakeAt = tomorrow if retryAt is None else min(tomorrow, retryAt)
+            if self.queue:
+                wakeAt = min(wakeAt, self.queue[0][0])
+            timeout = (wakeAt - now).total_seconds()
+
+            if self.dirty:
+                timeout = min(timeout, self.rebuildDelay - (time.monotonic() - self.lastRebuild))
+
+        return max(timeout, 0)
+
+    def wait(self, now, retryAt=None):
+        """Sleep until the next entry is due, the day ends, `retryAt` or invalidate() is called."""
+        with self.condition:
+            timeout = self.seconds_until_wake(now, retryAt)
+            if not self.dirty:
+                self.condition.wait_for(lambda: self.dirty, timeout=timeout)
+                return
+
+        time.sleep(timeout)
+
+def build_notifications(dueNotifications):
+    """Turn due scheduler entries into (chat id, class code, text, class start) notifications.
+
+    The text leaves out the countdown to the class, render_notification()
+    adds it when the message is sent.
+    """
+    notifications = []
+    notifKeys = set()
+    for classStart, x in dueNotifications:
+        #Only one notification per class per day
+        if (x[0], x[3]) in notifKeys:
+            continue
+        notifKeys.add((x[0], x[3]))
+
+        notifStringConstruct = "*" + x[3] + " @ " + x[4] + "*" + "\n" + x[7]
+
+        notifications.append((x[0], x[3], notifStringConstruct, classStart))
+
+    return notifications
+
+def render_notification(text, classStart, now):
+    """Add the countdown to `classStart` as of `now` after the first line of a notification text."""
+    # Rows queued by an earlier version already carry their countdown
+    if "\nHappening in ~" in text:
+        return text
+
+    timeInMins = (classStart - now).total_seconds() / 60
+    timeInMinsNoDecimal = int(timeInMins)
+
+    heading, _, details = text.partition("\n")
+    return heading + "\nHappening in ~" + str(timeInMinsNoDecimal) + " minutes\n" + details
+
+class NotificationOutbox(object):
+    """Delivers notifications through the NotificationOutbox table.
+
+    Due notifications are claimed and written to the outbox as pending rows
+    in one transaction by queue(). take() and settle() then drain the rows
+    through a dispatcher, marking each one sent or scheduling a retry with
+    exponential backoff and jitter. Rows survive a restart, so the next
+    drain resumes with whatever was still pending. A notification is given
+    up after `maxAttempts` tries or once its class has started. The
+    countdown in a message is rendered when it is sent, so a retry states
+    the time left by then.
+    """
+
+    def __init__(self, retryBase=30, retryMax=600, maxAttempts=5, batchSize=500, keepDays=7):
+        self.retryBase = retryBase
+        self.retryMax = retryMax
+        self.maxAttempts = maxAttempts
+        self.batchSize = batchSize
+        self.keepDays = keepDays
+        self.prunedFor = None
+
+    def queue(self, dueNotifications, now):
+        """Write due scheduler entries to the outbox, returns the subscription keys claimed."""
+        notifications = build_notifications(dueNotifications)
+        claimedKeys = storage.enqueue_notifications(notifications, now)
+
+        notificationsTotal.inc('queued', amount=len(claimedKeys))
+        notificationsTotal.inc('skipped', amount=len(dueNotifications) - len(claimedKeys))
+        return claimedKeys
+
+    def take(self, now):
+        """Return (rows to send, whether more may be due) from the outbox, giving up on rows whose class has started."""
+        if self.prunedFor != now.date():
+            storage.prune_outbox(now.date() - datetime.timedelta(days=self.keepDays))
+            self.prunedFor = now.date()
+
+        outboxRows = storage.due_outbox(now, self.batchSize)
+        expiredIds = [row[0] for row in outboxRows if row[4] <= now]
+        if expiredIds:
+            storage.settle_outbox((), (), expiredIds, now)
+            notificationsTotal.inc('expired', amount=len(expiredIds))
+            logger.warning('Dropped %d notifications for classes that have already started', len(expiredIds))
+
+        return [row for row in outboxRows if row[4] > now], len(outboxRows) == self.batchSize
+
+    def messages(self, outboxRows, now):
+        """(chat id, text, OutboxID) messages for a dispatcher's send_all, counting down to each class from `now`."""
+        return [(row[1], render_notification(row[3], row[4], now), row[0]) for row in outboxRows]
+
+    def settle(self, outboxRows, deliveredIds, now):
+        """Record the outcome of sending `outboxRows`, retrying the undelivered ones later."""
+        deliveredIds = set(deliveredIds)
+        retries = []
+        failedIds = []
+        for outboxId, telegramId, classCode, text, classStart, attempts in outboxRows:
+            if outboxId in deliveredIds:
+                notificationDelay.observe(max((now - (classStart - notificationScheduler.leadTime)).total_seconds(), 0))
+                notificationLead.observe(max((classStart - now).total_seconds(), 0))
+                continue
+
+            retryAt = now + datetime.timedelta(seconds=random.uniform(0, min(self.retryMax, self.retryBase * 2 ** attempts)))
+            if attempts + 1 >= self.maxAttempts or retryAt >= classStart:
+                failedIds.append(outboxId)
+            else:
+                retries.append((outboxId, retryAt))
+
+        storage.settle_outbox(sorted(deliveredIds), retries, failedIds, now)
+
+        notificationsTotal.inc('sent', amount=len(deliveredIds))
+        notificationsTotal.inc('retried', amount=len(retries))
+        notificationsTotal.inc('failed', amount=len(failedIds))
+        if failedIds:
+            logger.warning('Giving up on %d notifications', len(failedIds))
+
+    def drain(self, dispatcher):
+        """Send every outbox row that is due, returns when the next pending row is due or None."""
+        while True:
+            outboxRows, more = self.take(datetime.datetime.now())
+            if outboxRows:
+                deliveredIds = dispatcher.send_all(self.messages(outboxRows, datetime.datetime.now()))
+                self.settle(outboxRows, deliveredIds, datetime.datetime.now())
+            if not more:
+                return storage.next_outbox_attempt()
+
+class LeaderElection(object):
+    """Elects the one replica that runs the crawler and notifier, through a lease row in DaemonLease.
+
+    Every replica tries to take the lease each `ttl` / 3 seconds. The leader
+    renews it and the others take over once it has gone `ttl` seconds without
+    renewal, so a failed leader is replaced within about 4/3 `ttl`. A leader
+    that cannot renew stops counting itself leader a renewal interval before
+    its lease runs out. Listeners are called whenever leadership changes.
+    When disabled the replica always leads and nothing is written.
+    """
+
+    def __init__(self, name, ttl, enabled=True):
+        self.name = name
+        self.ttl = ttl
+        self.renewInterval = ttl / 3
+        self.enabled = enabled
+        self.holder = '%s:%d:%s' % (socket.gethostname(), os.getpid(), os.urandom(4).hex())
+        self.condition = threading.Condition()
+        self.leader = not enabled
+        self.leaseDeadline = 0
+        self.stopEvent = threading.Event()
+        self.listeners = []
+
+    def start(self):
+        if self.enabled:
+            thread = threading.Thread(target=self.run, name='leader-election', daemon=True)
+            thread.start()
+
+    def is_leader(self):
+        with self.condition:
+            return self.leader and (not self.enabled or time.monotonic() < self.leaseDeadline)
+
+    def wait(self, timeout=None):
+        """Block until this replica leads or `timeout` passes, returns whether it leads."""
+        with self.condition:
+            self.condition.wait_for(self.is_leader, timeout)
+        return self.is_leader()
+
+    def run(self):
+        while not self.stopEvent.is_set():
+            attemptStart = time.monotonic()
+            try:
+                leader = storage.acquire_lease(self.name, self.holder, self.ttl)
+            except Exception as e:
+                logger.warning('Could not renew the daemon lease: %s', e)
+                leader = None
+
+            newTerm = False
+            with self.condition:
+                if leader:
+                    # Another replica may have held the lease while ours had lapsed
+                    newTerm = self.leader and attemptStart >= self.leaseDeadline
+                    self.leaseDeadline = attemptStart + self.ttl - self.renewInterval
+                    # Waiters parked while the lease had lapsed can run again
+                    self.condition.notify_all()
+                elif leader is None:
+                    # Keep leading on a failed renewal until the lease may have run out
+                    leader = self.leader and time.monotonic() < self.leaseDeadline
+            self.set_leader(leader, newTerm)
+
+            self.stopEvent.wait(self.renewInterval)
+
+    def set_leader(self, leader, newTerm=False):
+        """Record leadership and tell the listeners if it changed, or if `newTerm` says a lapsed lease was retaken."""
+        with self.condition:
+            if leader == self.leader and not newTerm:
+                return
+            self.leader = leader
+            self.condition.notify_all()
+
+        logger.info('This replica is %s the leader, %s runs the crawler and notifier',
+            'now' if leader else 'no longer', 'it' if leader else 'another replica')
+        for listener in self.listeners:
+            listener()
+
+    def stop(self):
+        """Stop renewing and give up the lease if held."""
+        self.stopEvent.set()
+        if self.enabled and self.leader:
+            self.set_leader(False)
+            try:
+                storage.release_lease(self.name, self.holder)
+            except Exception as e:
+                logger.warning('Could not release the daemon lease: %s', e)
 
-        for item in data:
-            classroom = item["classroom"]
-            date = item["days"][0]["date"]
+def sendNotifications(updater):
+    while (True):
+        # Replicas that do not lead leave notifications to the one that does
+        if not leaderElection.is_leader():
+            leaderElection.wait(leaderElection.renewInterval)
+            continue
+
+        now = datetime.datetime.now()
+
+        if notificationScheduler.needs_rebuild(now):
+            try:
+                notificationScheduler.rebuild(now)
+            except Exception as e:
+                logger.warning('Could not build notification queue: %s', e)
+                notificationScheduler.invalidate()
+
+        dueNotifications = notificationScheduler.pop_due(now)
+        if dueNotifications:
+            #Claim the whole cycle into the outbox up front so a crash cannot lose or repeat it
+            try:
+                notificationOutbox.queue(dueNotifications, now)
+            except Exception as e:
+                logger.warning('Could not queue notifications: %s', e)
+                notificationScheduler.invalidate()
+                continue
+
+        #Send what the outbox holds, including retries and rows left by a restart
+        try:
+            retryAt = notificationOutbox.drain(notificationDispatcher)
+        except Exception as e:
+            logger.warning('Could not drain notification outbox: %s', e)
+            retryAt = now + datetime.timedelta(seconds=notificationOutbox.retryBase)
+
+        if not dueNotifications:
+            notificationScheduler.wait(now, retryAt)
+
+# Pending notifications, rebuilt when the schedule or subscriptions change
+notificationScheduler = NotificationScheduler(
+    datetime.timedelta(minutes=config.getint('Notifications', 'leadMinutes', fallback=60)))
+
+# Decides which replica runs the daemons, woken notifiers rebuild on taking over
+leaderElection = LeaderElection('daemons', config.getfloat('Leader', 'leaseSeconds', fallback=15),
+    enabled=config.getboolean('Leader', 'enabled', fallback=False))
+leaderElection.listeners.append(notificationScheduler.invalidate)
+
+notificationOutbox = NotificationOutbox(
+    retryBase=config.getfloat('Notifications', 'retryBase', fallback=30),
+    retryMax=config.getfloat('Notifications', 'retryMax', fallback=600),
+    maxAttempts=config.getint('Notifications', 'maxAttempts', fallback=5),
+    batchSize=config.getint('Notifications', 'outboxBatch', fallback=500),
+    keepDays=config.getint('Notifications', 'outboxDays', fallback=7))
+
+# Thread or coroutine dispatcher, set up by main() for the runtime in use
+notificationDispatcher = None
+
+# Figures read from the live objects whenever /metrics is scraped
+metrics.gauge('kapbot_leader', 'Whether this replica runs the crawler and notifier.',
+    callback=lambda: 1 if leaderElection.is_leader() else 0)
+metrics.gauge('kapbot_notification_queue', 'Notifications waiting for their fire time today.',
+    callback=lambda: len(notificationScheduler.queue))
+metrics.gauge('kapbot_notification_dispatch_queue', 'Messages waiting for a notification dispatcher worker.',
+    callback=lambda: notificationDispatcher.queue_depth() if notificationDispatcher is not None else 0)
+metrics.gauge('kapbot_notification_dispatch_throughput', 'Messages per second delivered in the last dispatched batch.',
+    callback=lambda: notificationDispatcher.stats()['throughput'] if notificationDispatcher is not None else 0)
+metrics.gauge('kapbot_storage', 'Storage backend statistics such as connection pool usage.', ('stat',),
+    callback=lambda: dict(((name,), value) for name, value in storage.stats().items()))
+metrics.gauge('kapbot_cache', 'Response and user profile cache statistics.', ('cache', 'stat'),
+    callback=lambda: dict(((cacheName, name), value) for cacheName, cache in (('response', responseCache), ('user', userCache))
+        for name, value in cache.stats().items()))
+
+class FeedFetcher(object):
+    """Fetches the schedule feed over a persistent HTTP connection.
+
+    Requests are conditional (ETag / Last-Modified) and gzip encoded, have a
+    bounded timeout and are retried with exponential backoff and jitter.
+    file:// URLs are read from disk with the same not-modified semantics,
+    which is handy for running the crawler against a saved feed.
+    """
+
+    def __init__(self, url, timeout=30, retries=4, backoffBase=2, backoffMax=120):
+        self.url = urllib.parse.urlsplit(url)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoffBase = backoffBase
+        self.backoffMax = backoffMax
+        self.conn = None
+        self.etag = None
+        self.lastModified = None
+
+    @contextmanager
+    def open(self):
+        """Yield a binary stream of the feed body, or None if it has not changed since the last fetch."""
+        if self.url.scheme == 'file':
+            path = urllib.parse.unquote(self.url.path)
+            lastModified = email.utils.formatdate(os.path.getmtime(path), usegmt=True)
+            if lastModified == self.lastModified:
+                yield None
+                return
+
+            with open(path, 'rb') as feedFile:
+                yield feedFile
+            self.lastModified = lastModified
+            return
+
+        response = self._request()
+        if response is None:
+            yield None
+            return
+
+        try:
+            if response.getheader('Content-Encoding', '') == 'gzip':
+                yield gzip.GzipFile(fileobj=response)
+            else:
+                yield response
+
+            # Drain anything left so the connection can be reused
+            while response.read(65536):
+                pass
+        except Exception:
+            self.close()
+            raise
+
+    def fetch(self):
+        """Return the whole feed body, or None if it has not changed."""
+        with self.open() as feedStream:
+            return feedStream.read() if feedStream is not None else None
+
+    def _request(self):
+        attempt = 0
+        while True:
+            try:
+                return self._request_once()
+            except (OSError, http.client.HTTPException) as e:
+                self.close()
+                if attempt >= self.retries:
+                    raise
+
+                # Full jitter so restarted replicas do not retry in lockstep
+                backoff = random.uniform(0, min(self.backoffMax, self.backoffBase * 2 ** attempt))
+                logger.warning('Feed fetch failed (%s), retrying in %.1fs', e, backoff)
+                time.sleep(backoff)
+                attempt += 1
+
+    def _request_once(self):
+        if self.conn is None:
+            if self.url.scheme == 'https':
+                self.conn = http.client.HTTPSConnection(self.url.netloc, timeout=self.timeout)
+            else:
+                self.conn = http.client.HTTPConnection(self.url.netloc, timeout=self.timeout)
+
+        headers = {'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.lastModified:
+            headers['If-Modified-Since'] = self.lastModified
+
+        path = self.url.path or '/'
+        if self.url.query:
+            path += '?' + self.url.query
+
+        self.conn.request('GET', path, headers=headers)
+        response = self.conn.getresponse()
+
+        if response.status == 200:
+            self.etag = response.getheader('ETag')
+            self.lastModified = response.getheader('Last-Modified')
+            return response
+
+        # Nothing else is streamed, read the body now so the connection can be reused
+        response.read()
+
+        if response.status == 304:
+            return None
+        if response.status >= 500:
+            raise http.client.HTTPException('Feed server returned HTTP ' + str(response.status))
+        raise ValueError('Unexpected HTTP ' + str(response.status) + ' from feed server')
+
+    def reset(self):
+        """Forget the cached validators so the next fetch returns the full feed."""
+        self.etag = None
+        self.lastModified = None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+class HashingReader(object):
+    """Wraps a binary stream and hashes everything read through it."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.digest = hashlib.sha1()
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.digest.update(chunk)
+        return chunk
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+def iter_json_array(stream, chunkSize=65536):
+    """Yield the elements of a top-level JSON array from `stream` one at a time.
+
+    Only the element being decoded and about one read chunk are held in
+    memory, so the feed never has to be loaded as a whole.
+    """
+    decoder = json.JSONDecoder()
+    textDecoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    arrayStarted = False
+    streamEnded = False
+
+    while True:
+        # Skip whitespace and separators between elements
+        while pos < len(buffer) and (buffer[pos].isspace() or (arrayStarted and buffer[pos] == ',')):
+            pos += 1
+
+        # Keep at least a chunk buffered ahead so elements are not cut short
+        if not streamEnded and len(buffer) - pos < chunkSize:
+            chunk = stream.read(chunkSize)
+            streamEnded = not chunk
+            buffer = buffer[pos:] + textDecoder.decode(chunk, final=streamEnded)
+            pos = 0
+            continue
+
+        if pos == len(buffer):
+            raise ValueError('Schedule feed ended before the closing bracket')
+
+        if not arrayStarted:
+            if buffer[pos] != '[':
+                raise ValueError('Schedule feed is not a JSON array')
+            arrayStarted = True
+            pos += 1
+            continue
+
+        if buffer[pos] == ']':
+            return
+
+        try:
+            element, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if streamEnded:
+                raise
+            end = None
+
+        # Element is larger than what has been buffered so far, one that
+        # decodes up to the end of the buffer may be a number cut short
+        if end is None or (end == len(buffer) and not streamEnded):
+            chunk = stream.read(chunkSize)
+            streamEnded = not chunk
+            buffer = buffer[pos:] + textDecoder.decode(chunk, final=streamEnded)
+            pos = 0
+            continue
+
+        yield element
+        pos = end
+
+# Column order of rows produced by parse_schedule
+SCHEDULE_COLUMNS = ("StudentType", "UniversityType", "ClassCode", "ClassLoc", "StartTime", "Date", "Duration", "PGroupName", "dataIssueExists", "dataIssue")
+
+# Rows sent per multi-row INSERT during ingest
+INGEST_BATCH_SIZE = 500
+
+def parse_schedule(data):
+    """Yield ScrappedData rows for each class in the schedules2.json feed.
+
+    `data` can be any iterable of classroom items, such as iter_json_array
+    over the feed stream, so rows are produced as the feed is read.
+    """
+    for item in data:
+        classroom = item["classroom"]
+
+        for day in item["days"]:
+            date = day["date"]
 
             #Deeper json
-            for className in item["days"][0]["classes"]:
+            for className in day["classes"]:
                 cName = className["ClassName"]
                 cDur = className["Duration"]
                 cStartTime = className["startTime"]
@@ -646,7 +2745,7 @@ def update_schedule(updater):
                     ftpt = "PT"
                 elif cName[0:2] == "FT":
                     ftpt = "FT"
-                        
+
                 #Get the uni name
                 if cName[3:6] == "UCD":
                     uniName = "UCD"
@@ -655,19 +2754,14 @@ def update_schedule(updater):
 
                 #Get the unit name
                 if uniName == "UCD":
-                    unitName = cName[7:]
-                    unitName = unitName.replace(' ', '')
+                    unitName = normalize_class_code(cName[7:])
 
-                    insertDataSQL = "INSERT INTO ScrappedData (StudentType, UniversityType, ClassCode, ClassLoc, StartTime, Date, Duration) VALUES (%s, %s, %s, %s, %s, %s, %s)"
-                    insertDataSQLValues = (ftpt, uniName, unitName, classroom, cStartTime, date, cDur)
-                    insertParsedCursor.execute(insertDataSQL, insertDataSQLValues)
-                    kapbotdb.commit()
-                    #print('Commitment Type: ' + ftpt + '\n' + 'Uni Name: ' + uniName + '\n' + 'Unit: ' + unitName + '\n' + 'Class Loc: ' + classroom + '\n')
+                    yield (ftpt, uniName, unitName, classroom, cStartTime, date, cDur, None, None, None)
 
                 elif uniName == "MUR":
                     #MUR specific variables
                     unitNameUnspaced = cName[7:]
-                    unitName = unitNameUnspaced.replace(' ', '')
+                    unitName = normalize_class_code(unitNameUnspaced)
                     possibleGroupName = ''
                     dataIssue = ''
                     dataIssueExists = False
@@ -685,27 +2779,884 @@ def update_schedule(updater):
                         else:
                             dataIssueExists = False
 
-                    insertDataSQL = "INSERT INTO ScrappedData (StudentType, UniversityType, ClassCode, ClassLoc, StartTime, Date, Duration, PGroupName, dataIssueExists, dataIssue) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
-                    insertDataSQLValues = (ftpt, uniName, unitName, classroom, cStartTime, date, cDur, possibleGroupName, dataIssueExists, dataIssue)
-                    insertParsedCursor.execute(insertDataSQL, insertDataSQLValues)
-                    kapbotdb.commit()
+                    yield (ftpt, uniName, unitName, classroom, cStartTime, date, cDur, possibleGroupName, dataIssueExists, dataIssue)
 
                 #Get study room
                 if eventName == "Study Room":
-                    insertStudyRoomSQL = "INSERT INTO ScrappedData (ClassCode, ClassLoc, StartTime, Date, Duration) VALUES (%s, %s, %s, %s, %s)"
-                    studyRoomValues = (eventName, classroom, cStartTime, date, cDur)
-                    insertParsedCursor.execute(insertStudyRoomSQL, studyRoomValues)
-                    kapbotdb.commit()
+                    yield (None, None, eventName, classroom, cStartTime, date, cDur, None, None, None)
+
+# Columns identifying a class row across feed pulls, as indexes into a schedule row
+SCHEDULE_KEY_INDEXES = (2, 0, 3, 4, 5)
+SCHEDULE_VALUE_INDEXES = tuple(i for i in range(len(SCHEDULE_COLUMNS)) if i not in SCHEDULE_KEY_INDEXES)
+
+ScheduleDelta = namedtuple('ScheduleDelta', ['inserted', 'changed', 'removed'])
+
+def schedule_row_digest(row):
+    """Return a row's (ClassCode, StudentType, ClassLoc, StartTime, Date) key and a short digest of its other columns."""
+    rowKey = tuple(row[i] for i in SCHEDULE_KEY_INDEXES)
+    rowValues = tuple(row[i] for i in SCHEDULE_VALUE_INDEXES)
+    return rowKey, hashlib.blake2b(repr(rowValues).encode('utf-8'), digest_size=8).digest()
+
+def snapshot_rows(scheduleRows, snapshot):
+    """Yield rows whose key has not been seen yet, recording each row's digest in `snapshot`.
+
+    Only keys and digests are kept, so the rows themselves can be streamed
+    on into the database. Rows repeating an earlier key are dropped and
+    counted in the log once the feed is exhausted.
+    """
+    duplicates = 0
+    for row in scheduleRows:
+        rowKey, rowDigest = schedule_row_digest(row)
+        if rowKey not in snapshot:
+            snapshot[rowKey] = rowDigest
+            yield row
+        else:
+            duplicates += 1
+
+    if duplicates:
+        logger.warning('Dropped %d schedule rows repeating the key of an earlier row', duplicates)
+
+def schedule_snapshot(scheduleRows):
+    """Map each row's key to the digest of its other columns, the first row wins for a repeated key."""
+    snapshot = {}
+    for row in snapshot_rows(scheduleRows, snapshot):
+        pass
+
+    return snapshot
+
+def diff_schedule(oldSnapshot, scheduleRows):
+    """Stream `scheduleRows` against the snapshot of the last feed, returns (new snapshot, delta).
+
+    Only inserted and changed rows are kept whole, removed rows are given
+    by their keys.
+    """
+    snapshot = {}
+    inserted = []
+    changed = []
+
+    for row in snapshot_rows(scheduleRows, snapshot):
+        rowKey = tuple(row[i] for i in SCHEDULE_KEY_INDEXES)
+        oldDigest = oldSnapshot.get(rowKey)
+        if oldDigest is None:
+            inserted.append(row)
+        elif oldDigest != snapshot[rowKey]:
+            changed.append(row)
+
+    removed = [rowKey for rowKey in oldSnapshot if rowKey not in snapshot]
+
+    return snapshot, ScheduleDelta(inserted, changed, removed)
+
+ScheduleEntry = namedtuple('ScheduleEntry', SCHEDULE_COLUMNS)
+
+class ScheduleIndex(object):
+    """Read-only lookup tables over one day's ScrappedData rows.
+
+    A new index is built after every ingest and swapped in as a whole, so
+    readers never see a half-updated schedule.
+    """
+
+    __slots__ = ('date', 'entries', 'byClassCode', 'byClassAndType', 'studyRooms', 'classReplies')
+
+    def __init__(self, date, entries):
+        byClassCode = {}
+        byClassAndType = {}
+        for entry in entries:
+            # Codes that only differ in case are the same class
+            classCode = entry.ClassCode if entry.ClassCode == "Study Room" else normalize_class_code(entry.ClassCode)
+            byClassCode.setdefault(classCode, []).append(entry)
+            byClassAndType.setdefault((classCode, entry.StudentType), []).append(entry)
+
+        self.date = date
+        self.entries = tuple(entries)
+        self.byClassCode = MappingProxyType({key: tuple(value) for key, value in byClassCode.items()})
+        self.byClassAndType = MappingProxyType({key: tuple(value) for key, value in byClassAndType.items()})
+        self.studyRooms = self.byClassCode.get("Study Room", ())
+
+        # /queryclass answers are rendered once here, not per request
+        self.classReplies = MappingProxyType({key: render_class_entries(key, value)
+            for key, value in self.byClassCode.items() if key != "Study Room"})
+
+    def classes(self, classCode, studentType=None):
+        """Return today's entries for a class code, optionally for one student type only."""
+        if studentType is None:
+            return self.byClassCode.get(classCode, ())
+        return self.byClassAndType.get((classCode, studentType), ())
+
+def normalize_class_code(classCode):
+    """The form class codes are stored, indexed and compared in, upper case without spaces."""
+    return classCode.replace(' ', '').upper()
+
+def render_class_entries(classCode, entries):
+    """Render one class code's entries for /queryclass, earliest first."""
+    classString = "*" + escape_markdown(classCode) + "*"
+    for x in sorted(entries, key=lambda entry: (entry.StartTime, entry.ClassLoc)):
+        startMinutes = int(x.StartTime.total_seconds()) // 60
+        classString += "\n`%02d:%02d` " % divmod(startMinutes, 60) + escape_markdown(x.ClassLoc) + ", " + escape_markdown(x.Duration)
+        if x.StudentType:
+            classString += ", " + x.StudentType
+        if x.PGroupName:
+            classString += ", " + escape_markdown(x.PGroupName)
+        if x.dataIssueExists:
+            classString += "\n⚠️ _" + escape_markdown(x.dataIssue) + "_"
+
+    return classString
+
+# Today's schedule, replaced wholesale by load_schedule_index
+scheduleIndex = ScheduleIndex(None, ())
+scheduleIndexLock = threading.Lock()
+
+def load_schedule_index():
+    """Read today's schedule from the database and swap it in as the current index."""
+    global scheduleIndex
+
+    today = datetime.date.today()
+    scheduleResult = storage.load_schedule(today)
+
+    index = ScheduleIndex(today, [ScheduleEntry(*row) for row in scheduleResult])
+    scheduleIndex = index
+    scheduleEntries.set(len(index.entries))
+    logger.info('Loaded %d schedule entries for %s', len(index.entries), today)
+
+    return index
+
+def reload_schedule_index():
+    """Reload today's schedule written by another replica, clearing caches if it changed."""
+    with scheduleIndexLock:
+        oldIndex = scheduleIndex
+        index = load_schedule_index()
+    classCodeIndex.update(storage.class_codes())
+
+    if index.date != oldIndex.date or set(index.entries) != set(oldIndex.entries):
+        responseCache.invalidate()
+        notificationScheduler.invalidate()
+
+def current_schedule():
+    """Return the schedule index for today, loading it first if the day has changed."""
+    index = scheduleIndex
+    if index.date == datetime.date.today():
+        return index
+
+    with scheduleIndexLock:
+        index = scheduleIndex
+        if index.date != datetime.date.today():
+            index = load_schedule_index()
+
+    return index
+
+class ClassCodeIndex(object):
+    """Sorted unit codes seen in the schedule feed for each UniversityType.
+
+    Codes are only ever added, so a unit missing from this week's feed is
+    still known from an earlier one. Each update merges the new codes into
+    fresh tuples and swaps them in, lookups are bisects without a lock.
+    """
+
+    def __init__(self):
+        self.codes = MappingProxyType({})
+        self.lock = threading.Lock()
+
+    def update(self, classCodes):
+        """Add (UniversityType, ClassCode) pairs, returns how many codes were new."""
+        found = {}
+        for universityType, classCode in classCodes:
+            if universityType and classCode:
+                found.setdefault(universityType, set()).add(normalize_class_code(classCode))
+
+        addedCount = 0
+        with self.lock:
+            codes = dict(self.codes)
+            for universityType, foundCodes in found.items():
+                knownCodes = codes.get(universityType, ())
+                added = sorted(x for x in foundCodes if not self.contains(universityType, x))
+                if added:
+                    codes[universityType] = tuple(heapq.merge(knownCodes, added))
+                    addedCount += len(added)
+            self.codes = MappingProxyType(codes)
+
+        return addedCount
+
+    def covers(self, universityType):
+        """True once any code is known for the university, until then nothing can be checked."""
+        return bool(self.codes.get(universityType))
+
+    def contains(self, universityType, classCode):
+        knownCodes = self.codes.get(universityType, ())
+        position = bisect.bisect_left(knownCodes, classCode)
+        return position < len(knownCodes) and knownCodes[position] == classCode
+
+    def suggest(self, universityType, classCode, limit=3, candidates=50):
+        """Return up to `limit` known codes closest to `classCode`.
+
+        Candidates are the codes sharing the longest prefix with `classCode`,
+        so a typo near the end only compares against a handful of codes.
+        """
+        knownCodes = self.codes.get(universityType, ())
+        for prefixLength in range(len(classCode), 0, -1):
+            prefix = classCode[:prefixLength]
+            start = bisect.bisect_left(knownCodes, prefix)
+            end = bisect.bisect_left(knownCodes, prefix + '\uffff', start)
+            if start < end:
+                # Letters typed for look-alike digits, as in ICT38OB, cost nothing
+                target = classCode.translate(LOOKALIKE_DIGITS)
+                scored = sorted((-difflib.SequenceMatcher(None, target, x.translate(LOOKALIKE_DIGITS)).ratio(), x)
+                    for x in knownCodes[start:min(end, start + candidates)])
+                matches = [x for score, x in scored[:limit] if score <= -0.6]
+                if matches or end - start >= candidates:
+                    return matches
+
+        return []
+
+LOOKALIKE_DIGITS = str.maketrans('OIL', '011')
+
+# Unit codes for validating subscriptions, fed by every ingest
+classCodeIndex = ClassCodeIndex()
+
+class ScheduleCrawler(object):
+    """Pulls the schedule feed and brings ScrappedData and the schedule index up to date."""
+
+    def __init__(self):
+        self.incrementalRefresh = config.getboolean('ScheduleCrawler', 'incremental', fallback=True)
+        self.feedFetcher = FeedFetcher(
+            config.get('ScheduleCrawler', 'url', fallback="http://webapps.kaplan.com.sg/schedule/schedules2.json"),
+            timeout=config.getfloat('ScheduleCrawler', 'timeout', fallback=30),
+            retries=config.getint('ScheduleCrawler', 'retries', fallback=4))
+
+        # Last feed applied to the database, used to skip or diff the next pull
+        self.lastFeedHash = None
+        self.lastSnapshot = None
+
+        # Another replica may rewrite ScrappedData while this one does not lead
+        self.leaderTerm = 0
+        leaderElection.listeners.append(self.forget_feed)
+
+    def forget_feed(self):
+        """Forget the last feed applied, so the next refresh fetches and loads it in full."""
+        self.leaderTerm += 1
+        self.lastFeedHash = None
+        self.lastSnapshot = None
+        self.feedFetcher.reset()
+
+    def crawl(self):
+        """Refresh, then record the time in the database so a replica taking over can tell if a crawl was missed."""
+        if not self.refresh():
+            return
+        try:
+            storage.record_run('crawler')
+        except Exception as e:
+            logger.warning('Could not record the schedule crawl: %s', e)
+
+    def overdue(self):
+        """Whether no replica has crawled for a whole crawl interval."""
+        try:
+            secondsSinceCrawl = storage.seconds_since_run('crawler')
+        except Exception as e:
+            logger.warning('Could not look up the last schedule crawl: %s', e)
+            return False
+        return secondsSinceCrawl is None or secondsSinceCrawl >= crawlIntervalMinutes * 60
+
+    def refresh(self):
+        """Run one refresh, returns False if it failed."""
+        leaderTerm = self.leaderTerm
+
+        #Stream the feed from the source straight into the database
+        try:
+            with self.feedFetcher.open() as feedStream:
+                #Server says nothing changed since the last pull
+                if feedStream is None:
+                    logger.info('Schedule feed not modified, skipping ingest')
+                    scheduleRefreshes.inc('not_modified')
+                    return True
+
+                hashingStream = HashingReader(feedStream)
+                scheduleRows = parse_schedule(iter_json_array(hashingStream))
+
+                if self.incrementalRefresh and self.lastSnapshot is not None:
+                    snapshot, scheduleDelta = diff_schedule(self.lastSnapshot, scheduleRows)
+
+                    #Nothing to do if the feed is byte for byte the same as last time
+                    if hashingStream.hexdigest() == self.lastFeedHash:
+                        logger.info('Schedule feed unchanged, skipping ingest')
+                        scheduleRefreshes.inc('unchanged')
+                        return True
+
+                    storage.apply_schedule_delta(scheduleDelta)
+                    classCodeIndex.update((row[1], row[2]) for row in itertools.chain(scheduleDelta.inserted, scheduleDelta.changed))
+
+                else:
+                    # Full load, with repeated keys dropped the same way a diff drops them.
+                    # The digests are kept to diff the next feed against.
+                    snapshot = {}
+                    storage.replace_schedule(snapshot_rows(scheduleRows, snapshot))
+                    classCodeIndex.update(storage.class_codes())
+
+                # Leadership changed during the refresh, the table may be another replica's now
+                if self.incrementalRefresh and leaderTerm == self.leaderTerm:
+                    self.lastFeedHash = hashingStream.hexdigest()
+                    self.lastSnapshot = snapshot
+
+            with scheduleIndexLock:
+                load_schedule_index()
+            responseCache.invalidate()
+            notificationScheduler.invalidate()
+
+        except Exception as e:
+            # Make sure the next pull is not skipped as unmodified
+            logger.warning('Could not refresh schedule: %s', e)
+            self.feedFetcher.reset()
+            scheduleRefreshes.inc('error')
+            return False
+
+        scheduleRefreshes.inc('updated')
+        logger.info('Storage stats: %s', storage.stats())
+        return True
+
+# Minutes between scheduled crawls, a replica taking over crawls at once if the last one is older
+crawlIntervalMinutes = 120
+
+def minutes_until_next_crawl():
+    currentHour = time.strftime("%H", time.localtime())
+    currentMinute = time.strftime("%M", time.localtime())
+
+    #Only check for updates on the 15th minute every even hour
+    sleepDuration = 0
+    if (int(currentHour) % 2 != 0):
+        sleepDuration += 60
+
+    if (int(currentMinute) < 15):
+        sleepDuration += abs(15 - int(currentMinute))
+    else:
+        sleepDuration += abs(60 - int(currentMinute) + 15)
+
+    return sleepDuration
+
+def update_schedule(updater):
+    crawler = ScheduleCrawler()
+    reloadMinutes = config.getfloat('Leader', 'reloadMinutes', fallback=5)
+    leading = False
+
+    # This daemon should only run once every two hours at the 15th minute
+    while (True):
+        # Other replicas only pick up what the leader ingested
+        if not leaderElection.is_leader():
+            leading = False
+            try:
+                reload_schedule_index()
+            except Exception as e:
+                logger.warning('Could not reload schedule: %s', e)
+            time.sleep(reloadMinutes * 60)
+            continue
+
+        # Catch up on a crawl the previous leader missed before waiting for the next slot
+        if not leading:
+            leading = True
+            if crawler.overdue():
+                crawler.crawl()
+
+        time.sleep(minutes_until_next_crawl() * 60)
+
+        currentHour = time.strftime("%H", time.localtime())
+        
+        #Sleep longer in the morning
+        if (int(currentHour) == 2):
+            time.sleep(4 * 60 * 60)
+
+        if leaderElection.is_leader():
+            crawler.crawl()
+
+class AsyncBotClient(object):
+    """Minimal Bot API client on asyncio streams, keeps HTTP/1.1 connections alive between calls."""
+
+    def __init__(self, token, baseURL='https://api.telegram.org/bot', connections=8, timeout=30):
+        parsedURL = urllib.parse.urlsplit(baseURL)
+        self.host = parsedURL.hostname
+        self.port = parsedURL.port or (443 if parsedURL.scheme == 'https' else 80)
+        self.sslContext = ssl.create_default_context() if parsedURL.scheme == 'https' else None
+        self.pathPrefix = parsedURL.path + token + '/'
+        self.connections = connections
+        self.timeout = timeout
+
+        # Idle (reader, writer) pairs, the semaphore is created inside the running loop
+        self.idle = []
+        self.slots = None
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        params = {'chat_id': chat_id, 'text': text}
+        if parse_mode:
+            params['parse_mode'] = parse_mode
+        return await self.call('sendMessage', **params)
+
+    async def call(self, method, **params):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.connections)
+
+        body = json.dumps(params).encode('utf-8')
+        started = time.perf_counter()
+        try:
+            return await self._call(method, body)
+        except Exception as e:
+            telegramErrors.inc(method, type(e).__name__)
+            raise
+        finally:
+            telegramDuration.observe(time.perf_counter() - started, method)
+
+    async def _call(self, method, body):
+        async with self.slots:
+            while True:
+                reused = bool(self.idle)
+                reader, writer = self.idle.pop() if reused else await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port, ssl=self.sslContext), self.timeout)
+
+                try:
+                    headers, payload = await asyncio.wait_for(self._exchange(reader, writer, method, body), self.timeout)
+                except EOFError:
+                    writer.close()
+                    # The server closed the idle connection before reading the request, safe to resend
+                    if reused:
+                        continue
+                    raise NetworkError('Connection closed by server')
+                except asyncio.TimeoutError:
+                    writer.close()
+                    raise TimedOut()
+                except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                    writer.close()
+                    raise NetworkError(str(e))
+
+                if headers.get('connection', '').lower() == 'close':
+                    writer.close()
+                else:
+                    self.idle.append((reader, writer))
+                break
+
+        try:
+            response = json.loads(payload.decode('utf-8'))
+        except ValueError:
+            raise NetworkError('Invalid server response')
+
+        if not response.get('ok'):
+            retryAfter = response.get('parameters', {}).get('retry_after')
+            if retryAfter:
+                raise RetryAfter(retryAfter)
+            raise TelegramError(response.get('description', 'Unknown HTTP error'))
+
+        return response.get('result')
+
+    async def _exchange(self, reader, writer, method, body):
+        writer.write(('POST %s%s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+            % (self.pathPrefix, method, self.host, len(body))).encode('latin-1') + body)
+        await writer.drain()
+
+        statusLine = await reader.readline()
+        if not statusLine:
+            raise EOFError()
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                chunkSize = int((await reader.readline()).split(b';')[0], 16)
+                if chunkSize == 0:
+                    # Skip trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(chunkSize))
+                await reader.readexactly(2)
+            payload = b''.join(chunks)
+        elif 'content-length' in headers:
+            payload = await reader.readexactly(int(headers['content-length']))
+        else:
+            payload = await reader.read()
+            headers['connection'] = 'close'
+
+        return headers, payload
+
+    async def close(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            writer.close()
+
+class AsyncNotificationDispatcher(DispatchStats):
+    """Coroutine counterpart of NotificationDispatcher, one task per message instead of a thread per worker."""
+
+    def __init__(self, client, workers=8, globalRate=30, perChatInterval=1, maxRetries=3):
+        DispatchStats.__init__(self)
+        self.client = client
+        self.workers = workers
+        self.bucket = TokenBucket(globalRate, globalRate)
+        self.perChatInterval = perChatInterval
+        self.maxRetries = maxRetries
+
+        # Only touched from the event loop, no lock needed
+        self.chatNextSend = {}
+        self.pending = 0
+
+    async def send_all(self, messages):
+        """Send (chatId, text, tag) messages concurrently and return the tags that were delivered."""
+        batchStart = time.monotonic()
+        slots = asyncio.Semaphore(self.workers)
+        self.pending += len(messages)
+        results = await asyncio.gather(*(self._send(slots, chatId, text, tag) for chatId, text, tag in messages))
+        delivered = [tag for tag, sent in results if sent]
+
+        self.record_batch(len(delivered), len(messages), time.monotonic() - batchStart)
+
+        # Forget chats that are free to receive again
+        now = time.monotonic()
+        for chatId in [chatId for chatId, nextSend in self.chatNextSend.items() if nextSend <= now]:
+            del self.chatNextSend[chatId]
+
+        return delivered
+
+    async def _send(self, slots, chatId, text, tag):
+        queuedAt = time.monotonic()
+        async with slots:
+            self.pending -= 1
+            for attempt in range(self.maxRetries + 1):
+                delay = self.bucket.reserve()
+                while delay:
+                    await asyncio.sleep(delay)
+                    delay = self.bucket.reserve()
+
+                # Telegram allows about one message per second to the same chat
+                now = time.monotonic()
+                sendAt = max(now, self.chatNextSend.get(chatId, 0))
+                self.chatNextSend[chatId] = sendAt + self.perChatInterval
+                if sendAt > now:
+                    await asyncio.sleep(sendAt - now)
+
+                try:
+                    await self.client.send_message(chatId, text, parse_mode=ParseMode.MARKDOWN)
+                except RetryAfter as e:
+                    self.bucket.pause(e.retry_after)
+                    self.record_retry()
+                    continue
+                except Exception as e:
+                    logger.warning('Could not send notification to %s: %s', chatId, e)
+                    self.record_failed()
+                    return tag, False
+
+                self.record_sent(time.monotonic() - queuedAt)
+                return tag, True
+
+        logger.warning('Giving up on notification to %s after %d flood waits', chatId, self.maxRetries + 1)
+        self.record_failed()
+        return tag, False
+
+    def queue_depth(self):
+        return self.pending
+
+class AsyncDatabase(object):
+    """Runs blocking storage calls on an executor sized to the storage backend's concurrency."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=storage.concurrency)
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+async def notifier_loop(database, dispatcher):
+    loop = asyncio.get_running_loop()
+    wakeEvent = asyncio.Event()
+    wake = lambda: loop.call_soon_threadsafe(wakeEvent.set)
+    notificationScheduler.listeners.append(wake)
+
+    try:
+        while (True):
+            # Replicas that do not lead leave notifications to the one that does
+            if not leaderElection.is_leader():
+                wakeEvent.clear()
+                try:
+                    await asyncio.wait_for(wakeEvent.wait(), leaderElection.renewInterval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = datetime.datetime.now()
+
+            if notificationScheduler.needs_rebuild(now):
+                try:
+                    await database.run(notificationScheduler.rebuild, now)
+                except Exception as e:
+                    logger.warning('Could not build notification queue: %s', e)
+                    notificationScheduler.invalidate()
+
+            dueNotifications = notificationScheduler.pop_due(now)
+            if dueNotifications:
+                #Claim the whole cycle into the outbox up front so a crash cannot lose or repeat it
+                try:
+                    await database.run(notificationOutbox.queue, dueNotifications, now)
+                except Exception as e:
+                    logger.warning('Could not queue notifications: %s', e)
+                    notificationScheduler.invalidate()
+                    continue
+
+            #Send what the outbox holds, including retries and rows left by a restart
+            try:
+                more = True
+                while more:
+                    outboxRows, more = await database.run(notificationOutbox.take, datetime.datetime.now())
+                    if outboxRows:
+                        deliveredIds = await dispatcher.send_all(notificationOutbox.messages(outboxRows, datetime.datetime.now()))
+                        await database.run(notificationOutbox.settle, outboxRows, deliveredIds, datetime.datetime.now())
+                retryAt = await database.run(storage.next_outbox_attempt)
+            except Exception as e:
+                logger.warning('Could not drain notification outbox: %s', e)
+                retryAt = now + datetime.timedelta(seconds=notificationOutbox.retryBase)
+
+            if not dueNotifications:
+                wakeEvent.clear()
+                timeout = notificationScheduler.seconds_until_wake(now, retryAt)
+                if notificationScheduler.dirty:
+                    await asyncio.sleep(timeout)
+                else:
+                    try:
+                        await asyncio.wait_for(wakeEvent.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+    finally:
+        notificationScheduler.listeners.remove(wake)
+
+async def crawler_loop(database, crawler):
+    reloadMinutes = config.getfloat('Leader', 'reloadMinutes', fallback=5)
+    leading = False
+    while (True):
+        # Other replicas only pick up what the leader ingested
+        if not leaderElection.is_leader():
+            leading = False
+            try:
+                await database.run(reload_schedule_index)
+            except Exception as e:
+                logger.warning('Could not reload schedule: %s', e)
+            await asyncio.sleep(reloadMinutes * 60)
+            continue
+
+        # Catch up on a crawl the previous leader missed before waiting for the next slot
+        if not leading:
+            leading = True
+            if await database.run(crawler.overdue):
+                await database.run(crawler.crawl)
+
+        await asyncio.sleep(minutes_until_next_crawl() * 60)
+
+        #Sleep longer in the morning
+        if (int(time.strftime("%H", time.localtime())) == 2):
+            await asyncio.sleep(4 * 60 * 60)
+
+        # The crawl streams the feed into MySQL, keep it off the event loop
+        if leaderElection.is_leader():
+            await database.run(crawler.crawl)
+
+async def run_daemons_async(token):
+    """Run the notification and crawler daemons as coroutines on one event loop."""
+    global notificationDispatcher
+    notificationWorkers = config.getint('Notifications', 'workers', fallback=8)
+    database = AsyncDatabase(storage)
+    client = AsyncBotClient(token,
+        baseURL=config.get('TelegramBotToken', 'apiURL', fallback='https://api.telegram.org/bot'),
+        connections=notificationWorkers,
+        timeout=config.getfloat('Runtime', 'timeout', fallback=30))
+    notificationDispatcher = AsyncNotificationDispatcher(client,
+        workers=config.getint('Runtime', 'concurrency', fallback=100),
+        globalRate=config.getfloat('Notifications', 'globalRate', fallback=30),
+        perChatInterval=config.getfloat('Notifications', 'perChatInterval', fallback=1))
+
+    try:
+        await asyncio.gather(notifier_loop(database, notificationDispatcher), crawler_loop(database, ScheduleCrawler()))
+    finally:
+        await client.close()
+        database.close()
+
+class WebhookRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Accepts Telegram updates on the webhook path and serves /health."""
+
+    # Largest update body accepted, Telegram updates are far smaller
+    maxBodySize = 1024 * 1024
+
+    def do_POST(self):
+        webhook = self.server.webhook
+
+        if self.path != webhook.path:
+            self.send_error(404)
+            return
+
+        # Only Telegram knows the secret token set with setWebhook
+        secretToken = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secretToken.encode('utf-8'), webhook.secretToken.encode('utf-8')):
+            self.send_error(403)
+            return
+
+        # Check the declared size before reading anything
+        contentLength = self.headers.get('Content-Length', '').strip()
+        if not contentLength.isdigit():
+            self.send_error(400)
+            return
+        bodyLength = int(contentLength)
+        if bodyLength > self.maxBodySize:
+            self.send_error(413)
+            return
+
+        try:
+            update = Update.de_json(json.loads(self.rfile.read(bodyLength).decode('utf-8')), webhook.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            update = None
+        if update is None:
+            self.send_error(400)
+            return
+
+        # Telegram resends the update later if we are too busy for it now
+        if not webhook.submit(update):
+            self.send_error(503)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_error(404)
+            return
+
+        body = json.dumps(self.server.webhook.health()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Webhook %s - %s', self.address_string(), format % args)
+
+class WebhookServer(object):
+    """Serves Telegram webhook updates from a local HTTP listener.
+
+    Updates are handed to `workers` threads through bounded queues. Updates
+    from the same chat always go to the same worker, so a conversation is
+    processed in order while different chats are processed in parallel.
+    """
+
+    def __init__(self, dispatcher, listen, port, path, secretToken, workers=8, queueSize=1000):
+        # Without a secret anyone who finds the listener could post updates
+        if not re.match(r'^[A-Za-z0-9_-]{1,256}$', secretToken):
+            raise ValueError('[Webhook] secretToken must be 1-256 characters of A-Z, a-z, 0-9, _ and -')
+
+        self.dispatcher = dispatcher
+        self.bot = dispatcher.bot
+        self.path = path
+        self.secretToken = secretToken
+        self.queues = [queue.Queue(maxsize=queueSize) for _ in range(workers)]
+
+        self.httpd = http.server.ThreadingHTTPServer((listen, port), WebhookRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.webhook = self
+
+        self.statsLock = threading.Lock()
+        self.received = 0
+        self.rejected = 0
+        self.processed = 0
+
+    def start(self):
+        for workerQueue in self.queues:
+            worker = threading.Thread(target=self._worker, args=(workerQueue,))
+            worker.daemon = True
+            worker.start()
+
+        serverThread = threading.Thread(target=self.httpd.serve_forever)
+        serverThread.daemon = True
+        serverThread.start()
+
+        logger.info('Webhook listening on %s:%d%s', self.httpd.server_address[0], self.httpd.server_address[1], self.path)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def submit(self, update):
+        """Queue an update for processing, returns False if its worker's queue is full."""
+        chat = update.effective_chat
+        workerQueue = self.queues[(chat.id if chat is not None else update.update_id) % len(self.queues)]
+        try:
+            workerQueue.put_nowait(update)
+        except queue.Full:
+            with self.statsLock:
+                self.rejected += 1
+            return False
+
+        with self.statsLock:
+            self.received += 1
+        return True
+
+    def _worker(self, workerQueue):
+        while True:
+            update = workerQueue.get()
+            self.dispatcher.process_update(update)
+            with self.statsLock:
+                self.processed += 1
+
+    def health(self):
+        with self.statsLock:
+            return {
+                'status': 'ok',
+                'received': self.received,
+                'rejected': self.rejected,
+                'processed': self.processed,
+                'queueDepth': sum(workerQueue.qsize() for workerQueue in self.queues),
+            }
+
+class ConcurrentConversationHandler(ConversationHandler):
+    """ConversationHandler that several threads may pass updates to at once.
+
+    python-telegram-bot keeps the conversation and handler picked by
+    check_update() on the instance until handle_update() runs, so webhook
+    workers processing different chats at the same time could swap them.
+    Here they are kept per thread instead.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.local = threading.local()
+        ConversationHandler.__init__(self, *args, **kwargs)
+
+    @property
+    def current_conversation(self):
+        return getattr(self.local, 'conversation', None)
+
+    @current_conversation.setter
+    def current_conversation(self, conversation):
+        self.local.conversation = conversation
+
+    @property
+    def current_handler(self):
+        return getattr(self.local, 'handler', None)
+
+    @current_handler.setter
+    def current_handler(self, handler):
+        self.local.handler = handler
 
 def main():
+    notificationWorkers = config.getint('Notifications', 'workers', fallback=8)
+
     # Create the Updater and pass it your bot's token.
-    updater = Updater(config['TelegramBotToken']['token'])
+    # Leave enough HTTP connections for the notification workers as well, and time every Bot API call
+    updater = Updater(bot=Bot(config['TelegramBotToken']['token'],
+        base_url=config.get('TelegramBotToken', 'apiURL', fallback='https://api.telegram.org/bot'),
+        request=MeteredRequest(con_pool_size=notificationWorkers + 8)))
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
 
     # Add conversation handler with the states CHOOSING, TYPING_CHOICE and TYPING_REPLY
-    main_conv_handler = ConversationHandler(
+    main_conv_handler = ConcurrentConversationHandler(
         entry_points=[CommandHandler('start', start)],
 
         states={
@@ -803,44 +3754,119 @@ def main():
                             ],
         },
 
-        fallbacks=[RegexHandler('.*', unrecognized_input)],
+        fallbacks=[CommandHandler('queryclass', query_class, pass_args=True),
+                   RegexHandler('.*', unrecognized_input)],
         conversation_timeout=300
     )
 
-    # classquery_conv_handler = ConversationHandler(
-    #     entry_points=[CommandHandler('studyrooms', list_study_rooms)],
-
-    #     fallbacks=[RegexHandler('.*', unrecognized_input)],
-    #     conversation_timeout=1
-    # )
-
     dp.add_handler(main_conv_handler)
     dp.add_handler(CommandHandler('studyrooms', list_study_rooms))
-    # dp.add_handler(classquery_conv_handler)
+    dp.add_handler(CommandHandler('queryclass', query_class, pass_args=True))
     dp.add_handler(MessageHandler(Filters.text, bot_not_started))
 
     # log all errors
     dp.add_error_handler(error)
 
-    # Create new daemon to handle notification sending
-    global notificationsThread
-    notificationsThread = threading.Thread(target=sendNotifications, args=(updater,))
-    notificationsThread.daemon = True
-    notificationsThread.start()
-
-    # Create new daemon to handle course updating
-    crawlerThread = threading.Thread(target=update_schedule, args=(updater,))
-    crawlerThread.daemon = True
-    crawlerThread.start()
+    # Record latency and errors for every handler above
+    instrument_handlers(dp)
+    if config.getboolean('Metrics', 'enabled', fallback=False):
+        start_metrics_server(config.get('Metrics', 'listen', fallback='127.0.0.1'),
+            config.getint('Metrics', 'port', fallback=9108))
+
+    # Bring the database up to date before the daemons use it
+    storage.migrate()
+    if config.getboolean('Storage', 'checkQueryPlans', fallback=True):
+        for name, table, detail in check_query_plans(storage):
+            logger.warning('Query "%s" scans all of %s (%s), is an index missing?', name, table, detail)
+
+    # Load today's schedule so handlers can answer before the first crawl
+    load_schedule_index()
+    classCodeIndex.update(storage.class_codes())
+
+    # Only the elected replica runs the daemons started below
+    leaderElection.start()
+
+    global notificationDispatcher
+    # asyncio was the option's earlier name
+    if config.getboolean('Runtime', 'asyncDaemons', fallback=config.getboolean('Runtime', 'asyncio', fallback=False)):
+        # Run both daemons as coroutines on a single event loop thread, handlers stay on their threads
+        daemonsThread = threading.Thread(target=asyncio.run,
+            args=(run_daemons_async(config['TelegramBotToken']['token']),))
+        daemonsThread.daemon = True
+        daemonsThread.start()
+    else:
+        # Create new daemon to handle notification sending
+        notificationDispatcher = NotificationDispatcher(updater.bot,
+            workers=notificationWorkers,
+            globalRate=config.getfloat('Notifications', 'globalRate', fallback=30),
+            perChatInterval=config.getfloat('Notifications', 'perChatInterval', fallback=1))
+        notificationsThread = threading.Thread(target=sendNotifications, args=(updater,))
+        notificationsThread.daemon = True
+        notificationsThread.start()
+
+        # Create new daemon to handle course updating
+        crawlerThread = threading.Thread(target=update_schedule, args=(updater,))
+        crawlerThread.daemon = True
+        crawlerThread.start()
 
     # Start the Bot
-    updater.start_polling()
-
-    # Run the bot until you press Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+    if config.getboolean('Webhook', 'enabled', fallback=False):
+        run_webhook(updater)
+    else:
+        updater.start_polling()
+
+        # Run the bot until you press Ctrl-C or the process receives SIGINT,
+        # SIGTERM or SIGABRT. This should be used most of the time, since
+        # start_polling() is non-blocking and will stop the bot gracefully.
+        updater.idle()
+
+    # Let another replica take over the daemons straight away
+    leaderElection.stop()
+
+def run_webhook(updater):
+    webhookServer = WebhookServer(updater.dispatcher,
+        config.get('Webhook', 'listen', fallback='127.0.0.1'),
+        config.getint('Webhook', 'port', fallback=8443),
+        config.get('Webhook', 'path', fallback='/kapbot'),
+        config.get('Webhook', 'secretToken', fallback=''),
+        workers=config.getint('Webhook', 'workers', fallback=8),
+        queueSize=config.getint('Webhook', 'queueSize', fallback=1000))
+    webhookServer.start()
+    updater.job_queue.start()
+
+    # Tell Telegram where to deliver updates, unless only testing locally
+    webhookURL = config.get('Webhook', 'url', fallback='')
+    if webhookURL:
+        updater.bot.set_webhook(url=webhookURL, secret_token=webhookServer.secretToken)
+
+    # Run the bot until Ctrl-C or SIGTERM
+    stopEvent = threading.Event()
+    for stopSignal in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(stopSignal, lambda signum, frame: stopEvent.set())
+    while not stopEvent.wait(1):
+        pass
+
+    logger.info('Stopping webhook server')
+    webhookServer.stop()
+    updater.job_queue.stop()
+
+
+def check_queries():
+    """Migrate the database, then print the plan of every hot query. Exits with 1 if any scans a table in full."""
+    storage.migrate()
+    for name, statement, params, scannedTables in storage.hot_queries():
+        for table, fullScan, detail in storage.explain(statement, params):
+            print('%-26s %-26s %s%s' % (name, table, detail,
+                ' FULL SCAN' if fullScan and table not in scannedTables else ''))
+
+    sys.exit(1 if check_query_plans(storage) else 0)
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='KapBot Telegram bot')
+    parser.add_argument('--check-queries', action='store_true',
+        help='apply schema migrations, print the query plans of hot queries and exit')
+    if parser.parse_args().check_queries:
+        check_queries()
+    else:
+        main()
@@ -0,0 +1,533 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Conversation load test against a local stand-in for the Telegram Bot API
+"""
+Drives thousands of virtual users through kapbot's conversation flows and
+reports how quickly the bot replies and how many Bot API calls each flow
+costs.
+
+kapbot runs unmodified as a child process with a throwaway SQLite store and
+its Bot API URL pointed at a stand-in server in this process. The stand-in
+hands out updates through getUpdates, or posts them to the bot's webhook
+listener with --webhook, and records every sendMessage, sendChatAction and
+sendPhoto call. Each virtual user sends one flow's messages in turn and waits
+for the reply that ends each step:
+
+onboarding  /start, Continue, university, FT, Begin, a unit code, No
+classes     /start, Configure classes, add a unit, then remove it again
+studyrooms  /studyrooms
+queryclass  /queryclass with several unit codes
+botinfo     /start, Bot info and each of its pages
+
+Usage:
+python3 loadtest.py --users 2000
+python3 loadtest.py --users 500 --webhook --output results.json --baseline previous.json
+"""
+
+import argparse
+import asyncio
+import collections
+import configparser
+import datetime
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import benchmark
+
+# (message sent, lower case text the last reply to it contains) for each step
+FLOWS = {
+    'onboarding': (
+        ("/start", "press the continue button"),
+        ("Continue", "which university"),
+        ("Murdoch University", "full-time or part-time"),
+        ("FT", "press begin"),
+        ("Begin", "unit codes"),
+        ("LT300B", "save it anyway"),
+        ("Save anyway", "successfully saved"),
+        ("No", "send a /start command"),
+    ),
+    'classes': (
+        ("/start", "how can i help"),
+        ("Configure classes", "whatcha gonna do"),
+        ("Add class", "unit codes"),
+        ("LT200B, LT200C", "save it anyway"),
+        ("Save anyway", "successfully saved"),
+        ("No", "send a /start command"),
+        ("/start", "how can i help"),
+        ("Configure classes", "whatcha gonna do"),
+        ("Remove class", "delete one class"),
+        ("LT200B", "whatcha gonna do"),
+    ),
+    'studyrooms': (
+        ("/studyrooms", "study rooms"),
+    ),
+    'queryclass': (
+        ("/queryclass ICT380B, BUS101A LT100A", "data last updated"),
+    ),
+    'botinfo': (
+        ("/start", "how can i help"),
+        ("Bot info", "what would you like me to tell you"),
+        ("Some assurance about privacy", "what would you like me to tell you"),
+        ("Why", "what would you like me to tell you"),
+        ("Limitations", "what would you like me to tell you"),
+        ("< Back", "how can i help"),
+    ),
+}
+
+# Flows that need the user to have an account already
+EXISTING_USER_FLOWS = ('classes', 'botinfo')
+
+# Chat ids handed out per flow, so replies are easy to attribute
+FLOW_CHAT_IDS = {'onboarding': 200000000, 'classes': 300000000, 'studyrooms': 400000000, 'botinfo': 500000000,
+    'queryclass': 600000000}
+
+# Unit seeded for existing users, absent from the feed so no notification fires mid run
+SEEDED_UNIT = "LT100A"
+
+BOT_TOKEN = "123456:LOADTEST"
+
+REPLY_METHODS = ('sendMessage', 'sendPhoto')
+
+class FakeBotAPI(object):
+    """Stand-in for the Bot API on asyncio streams, records every call per chat.
+
+    Updates queued with send_update() are served to getUpdates long polls, or
+    posted to the URL given to setWebhook along with its secret token. Each
+    sendMessage and sendPhoto is put on the chat's reply queue.
+    """
+
+    def __init__(self, token):
+        self.token = token
+        self.updates = collections.deque()
+        self.updateIds = itertools.count(1)
+        self.messageIds = itertools.count(1)
+        self.updatesAdded = None
+        self.webhookURL = None
+        self.secretToken = None
+        self.replies = collections.defaultdict(asyncio.Queue)
+        self.chatCalls = collections.defaultdict(collections.Counter)
+        self.methodCalls = collections.Counter()
+        self.server = None
+        self.port = None
+
+    async def start(self, host='127.0.0.1'):
+        self.updatesAdded = asyncio.Event()
+        self.server = await asyncio.start_server(self.handle, host, 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        # Answer long polls still waiting so their connections can close
+        self.updatesAdded.set()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        # HTTP/1.1 with keep-alive, as python-telegram-bot pools its connections
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine:
+                    break
+
+                headers = {}
+                while True:
+                    headerLine = await reader.readline()
+                    if headerLine in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = headerLine.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                path = requestLine.decode('latin-1').split(' ')[1]
+                apiMethod = path.rsplit('/', 1)[-1]
+
+                if path.startswith('/bot' + self.token + '/'):
+                    result = await self.call(apiMethod, parse_params(headers.get('content-type', ''), body))
+                    payload = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+                    status = b'200 OK'
+                else:
+                    payload = json.dumps({'ok': False, 'error_code': 404, 'description': 'Not Found'}).encode('utf-8')
+                    status = b'404 Not Found'
+
+                writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: application/json\r\nContent-Length: '
+                    + str(len(payload)).encode('ascii') + b'\r\n\r\n' + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def call(self, apiMethod, params):
+        self.methodCalls[apiMethod] += 1
+
+        if apiMethod == 'getMe':
+            return {'id': int(self.token.split(':')[0]), 'is_bot': True, 'first_name': 'KapBot', 'username': 'kapbot_loadtest_bot'}
+
+        if apiMethod == 'getUpdates':
+            return await self.get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0),
+                int(params.get('limit') or 100))
+
+        if apiMethod == 'setWebhook':
+            self.webhookURL = params.get('url') or None
+            self.secretToken = params.get('secret_token')
+            return True
+
+        if apiMethod == 'deleteWebhook':
+            self.webhookURL = None
+            return True
+
+        chatId = params.get('chat_id')
+        if chatId is None:
+            return True
+
+        chatId = int(chatId)
+        self.chatCalls[chatId][apiMethod] += 1
+        if apiMethod not in REPLY_METHODS:
+            return True
+
+        text = params.get('text', '') if apiMethod == 'sendMessage' else '[photo]'
+        self.replies[chatId].put_nowait((time.monotonic(), text))
+
+        message = {'message_id': next(self.messageIds), 'date': int(time.time()),
+            'chat': {'id': chatId, 'type': 'private'}}
+        if apiMethod == 'sendMessage':
+            message['text'] = text
+        else:
+            message['photo'] = []
+        return message
+
+    async def get_updates(self, offset, timeout, limit):
+        # Updates before the offset have been confirmed by the bot
+        while self.updates and self.updates[0]['update_id'] < offset:
+            self.updates.popleft()
+
+        if not self.updates and timeout:
+            self.updatesAdded.clear()
+            try:
+                await asyncio.wait_for(self.updatesAdded.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        return list(itertools.islice(self.updates, limit))
+
+    async def send_update(self, chatId, text):
+        """Deliver a text message from user `chatId` to the bot."""
+        messageJSON = {
+            'message_id': next(self.messageIds),
+            'date': int(time.time()),
+            'chat': {'id': chatId, 'type': 'private', 'first_name': 'Load'},
+            'from': {'id': chatId, 'is_bot': False, 'first_name': 'Load'},
+            'text': text,
+        }
+        if text.startswith('/'):
+            messageJSON['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        update = {'update_id': next(self.updateIds), 'message': messageJSON}
+
+        if self.webhookURL:
+            await self.post_update(update)
+        else:
+            self.updates.append(update)
+            self.updatesAdded.set()
+
+    async def post_update(self, update):
+        # Telegram retries an update the webhook turned away, so do the same
+        webhookURL = urllib.parse.urlsplit(self.webhookURL)
+        body = json.dumps(update).encode('utf-8')
+        request = ('POST ' + (webhookURL.path or '/') + ' HTTP/1.1\r\nHost: ' + webhookURL.netloc
+            + '\r\nContent-Type: application/json\r\nContent-Length: ' + str(len(body))
+            + ('\r\nX-Telegram-Bot-Api-Secret-Token: ' + self.secretToken if self.secretToken else '')
+            + '\r\nConnection: close\r\n\r\n').encode('latin-1') + body
+        for attempt in range(10):
+            reader, writer = await asyncio.open_connection(webhookURL.hostname, webhookURL.port or 80)
+            try:
+                writer.write(request)
+                await writer.drain()
+                statusLine = await reader.readline()
+            finally:
+                writer.close()
+
+            if statusLine.split(b' ')[1:2] == [b'200']:
+                return
+            await asyncio.sleep(0.1 * 2 ** attempt)
+
+        raise RuntimeError('Webhook did not accept update ' + str(update['update_id']))
+
+def parse_params(contentType, body):
+    """Decode a Bot API request body sent as JSON, a form or multipart form data."""
+    if not body:
+        return {}
+
+    if contentType.startswith('application/json'):
+        return json.loads(body.decode('utf-8'))
+
+    if contentType.startswith('multipart/form-data'):
+        # Plain fields only, uploaded files such as the photo are skipped
+        return dict((name.decode('utf-8'), value.decode('utf-8')) for name, value in
+            re.findall(rb'name="([^"]+)"\r\n\r\n(.*?)\r\n--', body, re.DOTALL))
+
+    return dict((name, values[0]) for name, values in urllib.parse.parse_qs(body.decode('utf-8')).items())
+
+async def run_user(api, flowName, chatId, stepTimeout, thinkTime):
+    """Send one flow's messages as user `chatId`, returns (reply latencies, whether every step got its reply)."""
+    replies = api.replies[chatId]
+    latencies = []
+    for text, expectedReply in FLOWS[flowName]:
+        sentAt = time.monotonic()
+        deadline = sentAt + stepTimeout
+        await api.send_update(chatId, text)
+
+        # Earlier replies of the same step are skipped until the one that ends it
+        while True:
+            try:
+                repliedAt, replyText = await asyncio.wait_for(replies.get(), max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                return latencies, False
+
+            if expectedReply in replyText.lower():
+                latencies.append(repliedAt - sentAt)
+                break
+
+        if thinkTime:
+            await asyncio.sleep(random.uniform(0, 2 * thinkTime))
+
+    return latencies, True
+
+def percentile(sortedValues, percent):
+    """Nearest rank percentile of an already sorted list."""
+    if not sortedValues:
+        return None
+    rank = max(int(round(percent / 100.0 * len(sortedValues) + 0.5)) - 1, 0)
+    return sortedValues[min(rank, len(sortedValues) - 1)]
+
+def latency_summary(latencies):
+    """p50/p95/p99/max reply latency in milliseconds."""
+    latencies = sorted(latencies)
+    summary = dict(('p%dMs' % percent, percentile(latencies, percent)) for percent in (50, 95, 99))
+    summary['maxMs'] = latencies[-1] if latencies else None
+    return dict((name, round(value * 1000, 2) if value is not None else None) for name, value in summary.items())
+
+def assign_flows(users, flowNames):
+    """Return (flow, chat id) pairs for `users` virtual users spread evenly over the flows."""
+    assignments = []
+    flowCounters = dict((flowName, itertools.count(FLOW_CHAT_IDS[flowName])) for flowName in flowNames)
+    for i in range(users):
+        flowName = flowNames[i % len(flowNames)]
+        assignments.append((flowName, next(flowCounters[flowName])))
+
+    return assignments
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def prepare_store(workDir, assignments, args):
+    """Create the SQLite store with today's schedule and the accounts of existing-user flows, returns the config path."""
+    kapbot = benchmark.load_kapbot(workDir)
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    units = benchmark.generate_units(args.units, random.Random(args.seed))
+    feed = benchmark.generate_feed(args.classrooms, args.classes, units, seed=args.seed)
+    feedPath = os.path.join(workDir, 'schedules2.json')
+    with open(feedPath, 'w') as feedFile:
+        json.dump(feed, feedFile)
+    kapbot.storage.replace_schedule(kapbot.parse_schedule(feed))
+
+    benchmark.seed_subscriptions(kapbot.storage, [(chatId, "FT", "MUR", SEEDED_UNIT, None)
+        for flowName, chatId in assignments if flowName in EXISTING_USER_FLOWS])
+
+    return feedPath
+
+def write_bot_config(workDir, apiPort, feedPath, webhook):
+    """Point the config written by benchmark.load_kapbot at the stand-in API and the generated feed."""
+    configPath = os.path.join(workDir, 'config.ini')
+    botConfig = configparser.ConfigParser()
+    botConfig.read(configPath)
+    botConfig['TelegramBotToken'] = {'token': BOT_TOKEN, 'apiURL': 'http://127.0.0.1:%d/bot' % apiPort}
+    botConfig['ScheduleCrawler']['url'] = 'file://' + urllib.parse.quote(feedPath)
+    botConfig['Metrics']['enabled'] = 'no'
+    botConfig['Leader']['enabled'] = 'no'
+
+    if webhook:
+        webhookPort = free_port()
+        botConfig['Webhook'].update({'enabled': 'yes', 'listen': '127.0.0.1', 'port': str(webhookPort),
+            'path': '/kapbot', 'url': 'http://127.0.0.1:%d/kapbot' % webhookPort})
+    else:
+        botConfig['Webhook']['enabled'] = 'no'
+
+    with open(configPath, 'w') as configFile:
+        botConfig.write(configFile)
+
+    return configPath
+
+async def wait_until_ready(api, botProcess, webhook, timeout=60):
+    """Wait for the bot to start polling, or to register its webhook."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if botProcess.poll() is not None:
+            raise RuntimeError('kapbot exited with status %d during startup' % botProcess.returncode)
+        if (api.webhookURL if webhook else api.methodCalls['getUpdates']):
+            return
+        await asyncio.sleep(0.1)
+
+    raise RuntimeError('kapbot did not start within %d seconds' % timeout)
+
+async def run_load(args, workDir):
+    flowNames = args.flows.split(',')
+    for flowName in flowNames:
+        if flowName not in FLOWS:
+            raise SystemExit('Unknown flow: ' + flowName)
+
+    assignments = assign_flows(args.users, flowNames)
+    feedPath = prepare_store(workDir, assignments, args)
+
+    api = FakeBotAPI(BOT_TOKEN)
+    await api.start()
+    configPath = write_bot_config(workDir, api.port, feedPath, args.webhook)
+
+    logPath = os.path.join(workDir, 'kapbot.log')
+    repoDir = os.path.dirname(os.path.abspath(__file__))
+    with open(logPath, 'w') as logFile:
+        botProcess = subprocess.Popen([sys.executable, os.path.join(repoDir, 'kapbot.py')], cwd=repoDir,
+            env=dict(os.environ, KAPBOT_CONFIG=configPath),
+            stdout=None if args.verbose else logFile, stderr=subprocess.STDOUT if not args.verbose else None)
+        try:
+            await wait_until_ready(api, botProcess, args.webhook)
+
+            # Start users spread over the ramp, at most `concurrency` mid flow at once
+            slots = asyncio.Semaphore(args.concurrency or args.users)
+            async def start_user(i, flowName, chatId):
+                await asyncio.sleep(args.ramp * i / max(args.users, 1))
+                async with slots:
+                    return flowName, chatId, await run_user(api, flowName, chatId, args.step_timeout, args.think_time)
+
+            runStart = time.monotonic()
+            outcomes = await asyncio.gather(*(start_user(i, flowName, chatId) for i, (flowName, chatId) in enumerate(assignments)))
+            runDuration = time.monotonic() - runStart
+
+            # Let chat actions still on their way arrive before counting calls
+            await asyncio.sleep(args.settle)
+        finally:
+            botProcess.send_signal(signal.SIGTERM)
+            try:
+                botProcess.wait(15)
+            except subprocess.TimeoutExpired:
+                botProcess.kill()
+                botProcess.wait()
+            await api.close()
+
+    return summarise(api, outcomes, flowNames, runDuration), logPath
+
+def summarise(api, outcomes, flowNames, runDuration):
+    results = {}
+    allLatencies = []
+    for flowName in flowNames:
+        flowOutcomes = [(chatId, latencies, completed) for outcomeFlow, chatId, (latencies, completed) in outcomes
+            if outcomeFlow == flowName]
+        if not flowOutcomes:
+            continue
+
+        latencies = [latency for chatId, userLatencies, completed in flowOutcomes for latency in userLatencies]
+        allLatencies.extend(latencies)
+
+        calls = collections.Counter()
+        for chatId, userLatencies, completed in flowOutcomes:
+            calls.update(api.chatCalls[chatId])
+
+        results[flowName] = {
+            'runs': len(flowOutcomes),
+            'completed': sum(1 for chatId, userLatencies, completed in flowOutcomes if completed),
+            'steps': len(FLOWS[flowName]),
+            'apiCallsPerRun': round(sum(calls.values()) / len(flowOutcomes), 2),
+            'apiCallsByMethod': dict((apiMethod, round(count / len(flowOutcomes), 2))
+                for apiMethod, count in sorted(calls.items())),
+        }
+        results[flowName].update(latency_summary(latencies))
+
+    stepCount = sum(len(latencies) for flowName, chatId, (latencies, completed) in outcomes)
+    results['overall'] = {
+        'users': len(outcomes),
+        'completed': sum(1 for flowName, chatId, (latencies, completed) in outcomes if completed),
+        'seconds': round(runDuration, 3),
+        'repliesPerSec': round(stepCount / runDuration, 1) if runDuration else None,
+        'getUpdatesCalls': api.methodCalls['getUpdates'],
+    }
+    results['overall'].update(latency_summary(allLatencies))
+    return results
+
+def print_table(results):
+    print('%-12s %6s %9s %9s %9s %9s %10s' % ('flow', 'runs', 'completed', 'p50 ms', 'p95 ms', 'p99 ms', 'API calls'))
+    for flowName, flowResults in results.items():
+        if flowName == 'overall':
+            continue
+        print('%-12s %6d %9d %9s %9s %9s %10s' % (flowName, flowResults['runs'], flowResults['completed'],
+            flowResults['p50Ms'], flowResults['p95Ms'], flowResults['p99Ms'], flowResults['apiCallsPerRun']))
+
+    overall = results['overall']
+    print('%-12s %6d %9d %9s %9s %9s   %.1f replies/s' % ('overall', overall['users'], overall['completed'],
+        overall['p50Ms'], overall['p95Ms'], overall['p99Ms'], overall['repliesPerSec'] or 0))
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test kapbot's conversations against a local stand-in Bot API.")
+    parser.add_argument('--users', type=int, default=1000, help='virtual users, spread evenly over the flows')
+    parser.add_argument('--flows', default=','.join(FLOWS), help='comma separated flows to run, from: ' + ', '.join(FLOWS))
+    parser.add_argument('--concurrency', type=int, default=0, help='most users mid flow at once, 0 for all of them')
+    parser.add_argument('--ramp', type=float, default=5, help='seconds over which users start')
+    parser.add_argument('--think-time', type=float, default=0, help='average seconds a user waits between steps')
+    parser.add_argument('--step-timeout', type=float, default=30, help='seconds to wait for a reply before a flow fails')
+    parser.add_argument('--settle', type=float, default=1, help='seconds to keep counting API calls after the last reply')
+    parser.add_argument('--webhook', action='store_true', help='deliver updates to the webhook listener instead of getUpdates')
+    parser.add_argument('--classrooms', type=int, default=50, help='classrooms in the synthetic feed')
+    parser.add_argument('--classes', type=int, default=1000, help="classes in today's synthetic feed")
+    parser.add_argument('--units', type=int, default=200, help='distinct unit codes in the feed')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', metavar='PATH', default='loadtest-results.json', help='where to save the results')
+    parser.add_argument('--baseline', metavar='PATH', help='previous results to compare against')
+    parser.add_argument('--verbose', action='store_true', help="show kapbot's own log output")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as workDir:
+        try:
+            results, logPath = asyncio.run(run_load(args, workDir))
+        except RuntimeError as e:
+            logPath = os.path.join(workDir, 'kapbot.log')
+            if os.path.exists(logPath):
+                with open(logPath) as logFile:
+                    sys.stderr.write(''.join(logFile.readlines()[-20:]))
+            raise SystemExit(str(e))
+
+    report = {
+        'version': benchmark.git_version(),
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': dict((name, value) for name, value in vars(args).items()
+            if name not in ('output', 'baseline', 'verbose')),
+        'results': results,
+    }
+
+    with open(args.output, 'w') as outputFile:
+        json.dump(report, outputFile, indent=2)
+
+    print_table(results)
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            benchmark.compare(report, json.load(baselineFile))
+
+if __name__ == '__main__':
+    main()
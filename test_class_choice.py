@@ -0,0 +1,63 @@
+"""Adding classes from a message of one or more unit codes."""
+
+import pytest
+
+import kapbot
+
+@pytest.fixture
+def user(storage):
+    storage.add_user(1, 'MUR', 'FT')
+
+def subscriptions(storage):
+    return sorted(row[3] for row in storage.load_user(1) if row[3] is not None)
+
+@pytest.mark.parametrize('text', ['ict380b BUS100A mas200b', 'ICT380B,BUS100A, MAS200B', 'ICT380B\nBUS100A\n\nMAS200B',
+    ' ICT380B ; BUS100A,\n MAS200B, '])
+def test_codes_are_split_on_spaces_commas_and_newlines(storage, send, user, text):
+    state, replies = send(kapbot.class_choice, text)
+
+    assert state == kapbot.ADD_ANOTHER_CLASS
+    assert replies[0].startswith("Your classes ICT380B, BUS100A, MAS200B were successfully saved.")
+    assert subscriptions(storage) == ['BUS100A', 'ICT380B', 'MAS200B']
+
+def test_one_code(storage, send, user):
+    state, replies = send(kapbot.class_choice, 'ict380b')
+
+    assert replies[0] == "Your class ICT380B was successfully saved.\n\nWould you like to enter another class?"
+    assert subscriptions(storage) == ['ICT380B']
+
+def test_codes_already_subscribed_or_repeated_are_not_added(storage, send, user):
+    storage.add_subscriptions(1, ['ICT380B'])
+
+    state, replies = send(kapbot.class_choice, 'ICT380B bus100a BUS100A')
+
+    assert replies[0].split("\n")[:2] == ["Your class BUS100A was successfully saved.",
+        "🚳 Already in your collection, therefore not added: ICT380B, BUS100A"]
+    assert subscriptions(storage) == ['BUS100A', 'ICT380B']
+
+def test_only_the_first_codes_of_a_message_are_taken(storage, send, user):
+    classCodes = ['C%02d' % i for i in range(kapbot.maxClassesPerMessage + 2)]
+
+    state, replies = send(kapbot.class_choice, ' '.join(classCodes))
+
+    assert "Not added, only the first 20 codes are taken per message: C20, C21" in replies[0].split("\n")
+    assert subscriptions(storage) == classCodes[:kapbot.maxClassesPerMessage]
+
+def test_codes_that_are_too_long_are_not_added(storage, send, user):
+    state, replies = send(kapbot.class_choice, 'ICT380B ' + 'X' * 19)
+
+    assert replies[0].split("\n")[:2] == ["Your class ICT380B was successfully saved.", "Not added, too long: " + 'X' * 19]
+    assert subscriptions(storage) == ['ICT380B']
+
+@pytest.mark.parametrize('text, reply', [
+    ('X' * 19, "The unit code you have entered is too long. Try again?"),
+    ('X' * 19 + ', ' + 'Y' * 19, "The unit codes you have entered are too long. Try again?"),
+    (' '.join(['X' * 19] * 21), "The unit codes you have entered are too long. Only the first 20 codes are taken per message. Try again?"),
+    (' ,\n', "I could not find a unit code in that message, try again?"),
+])
+def test_messages_with_nothing_usable(storage, send, user, text, reply):
+    state, replies = send(kapbot.class_choice, text)
+
+    assert state == kapbot.EDITING_CLASSES
+    assert replies == [reply]
+    assert subscriptions(storage) == []
@@ -0,0 +1,73 @@
+"""Checking unit codes against the schedule and suggesting close matches."""
+
+import pytest
+
+import kapbot
+
+@pytest.fixture
+def index():
+    classCodeIndex = kapbot.ClassCodeIndex()
+    classCodeIndex.update([('MUR', 'ICT380B'), ('MUR', 'ICT381A'), ('MUR', 'ict 380c'), ('MUR', 'BUS100A'),
+        ('MUR', 'MAS101B'), ('UCD', 'BBSLSCM28'), (None, 'Study Room')])
+    return classCodeIndex
+
+def test_codes_are_kept_per_university_in_one_case(index):
+    assert index.codes == {'MUR': ('BUS100A', 'ICT380B', 'ICT380C', 'ICT381A', 'MAS101B'), 'UCD': ('BBSLSCM28',)}
+    assert index.contains('MUR', 'ICT380C')
+    assert not index.contains('UCD', 'ICT380B')
+    assert index.covers('UCD') and not index.covers('ND')
+
+def test_codes_are_only_ever_added(index):
+    assert index.update([('MUR', 'ICT380B'), ('MUR', 'CSP200A')]) == 1
+
+    assert index.contains('MUR', 'CSP200A') and index.contains('MUR', 'ICT380B')
+
+@pytest.mark.parametrize('classCode, suggestions', [
+    # Letter O typed for the digit 0
+    ('ICT38OB', ['ICT380B', 'ICT380C', 'ICT381A']),
+    ('BUS1OOA', ['BUS100A']),
+    # Letter I or L typed for the digit 1
+    ('MASI01B', ['MAS101B']),
+    ('MASL01B', ['MAS101B']),
+    ('MAS1O1B', ['MAS101B']),
+    # Other typos are ranked by similarity
+    ('ICTE80B', ['ICT380B', 'ICT380C']),
+    ('ZZZ999', []),
+])
+def test_suggestions_for_typos(index, classCode, suggestions):
+    assert index.suggest('MUR', classCode) == suggestions
+
+def test_suggestions_only_come_from_the_users_university(index):
+    assert index.suggest('UCD', 'ICT38OB') == []
+    assert index.suggest('UCD', 'BBSLSCM2B') == ['BBSLSCM28']
+
+def test_unknown_codes_are_offered_suggestions_then_saved_or_skipped(storage, send):
+    storage.add_user(1, 'MUR', 'FT')
+    kapbot.classCodeIndex.update([('MUR', 'ICT380B'), ('MUR', 'BUS100A')])
+    userData = {}
+
+    state, replies = send(kapbot.class_choice, 'ict38ob BUS100A XYZ999', userData)
+
+    assert state == kapbot.CLASS_CHOICE
+    assert replies[0].split("\n")[:3] == ["Your class BUS100A was successfully saved.",
+        "❓ ICT38OB is not in the class schedule, did you mean ICT380B?",
+        "❓ XYZ999 is not in the class schedule."]
+    assert userData['unknownClasses'] == ['ICT38OB', 'XYZ999']
+
+    state, replies = send(kapbot.class_choice, 'Save anyway', userData)
+
+    assert state == kapbot.ADD_ANOTHER_CLASS
+    assert replies[0].startswith("Your classes ICT38OB, XYZ999 were successfully saved.")
+    assert sorted(row[3] for row in storage.load_user(1)) == ['BUS100A', 'ICT38OB', 'XYZ999']
+
+def test_skipping_unknown_codes_saves_nothing(storage, send):
+    storage.add_user(1, 'MUR', 'FT')
+    kapbot.classCodeIndex.update([('MUR', 'ICT380B')])
+    userData = {}
+
+    send(kapbot.class_choice, 'ICT38OB', userData)
+    state, replies = send(kapbot.class_choice, 'Skip', userData)
+
+    assert state == kapbot.ADD_ANOTHER_CLASS
+    assert 'unknownClasses' not in userData
+    assert [row[3] for row in storage.load_user(1)] == [None]
@@ -0,0 +1,36 @@
+"""Removing classes from a user's list."""
+
+import kapbot
+
+def subscribe(storage, *classCodes):
+    storage.add_user(1, 'MUR', 'FT')
+    storage.add_subscriptions(1, list(classCodes))
+    # Cache the profile the way /start does
+    return kapbot.load_user(1)
+
+def test_deleting_a_class_typed_in_lower_case(storage, send):
+    subscribe(storage, 'ICT380B', 'BUS100A')
+
+    state, replies = send(kapbot.process_class_deletion, 'ict380b')
+
+    assert state == kapbot.EXISTING_CLASS_DIRECTOR
+    assert replies[0] == "The class ICT380B was deleted successfully."
+    assert [row[3] for row in storage.load_user(1)] == ['BUS100A']
+    assert kapbot.load_user(1).subscriptions == ('BUS100A',)
+
+def test_deleting_a_class_not_in_the_list(storage, send):
+    subscribe(storage, 'ICT380B')
+
+    state, replies = send(kapbot.process_class_deletion, 'BUS100A')
+
+    assert replies[0] == "The class BUS100A is not in your list, nothing was deleted."
+    assert kapbot.load_user(1).subscriptions == ('ICT380B',)
+
+def test_deleting_all_classes(storage, send):
+    subscribe(storage, 'ICT380B', 'BUS100A')
+
+    state, replies = send(kapbot.process_class_deletion, 'Remove all classes')
+
+    assert replies[0] == "All your classes are gone."
+    assert [row[3] for row in storage.load_user(1)] == [None]
+    assert kapbot.load_user(1).subscriptions == ()
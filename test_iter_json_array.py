@@ -0,0 +1,69 @@
+"""Streaming the elements of the schedule feed's top-level JSON array."""
+
+import io
+import json
+
+import pytest
+
+import kapbot
+
+FEED = [
+    {"classroom": "Room 001", "days": [{"date": "2026-10-19", "classes": [
+        {"ClassName": "FT MUR ICT 380B", "Duration": "3 hours", "startTime": "10:00", "eventName": "ICT380B - Group A"},
+        {"ClassName": "Study Room", "Duration": "2 hours", "startTime": "14:00", "eventName": "Study Room"},
+    ]}]},
+    {"classroom": "Salle été \U0001f63a", "days": []},
+    {"classroom": "Tricky ], [ { \"quoted\" } \\ ,", "days": [{"date": "2026-10-20", "classes": []}]},
+    [1, 2.5, -3e2, True, False, None],
+    12345,
+    "a string with ] and ,",
+    {},
+]
+
+FEED_BYTES = json.dumps(FEED, ensure_ascii=False, indent=1).encode('utf-8')
+
+class ShortReader(object):
+    """Returns at most `limit` bytes per read, whatever size is asked for."""
+
+    def __init__(self, data, limit):
+        self.stream = io.BytesIO(data)
+        self.limit = limit
+        self.bytesRead = 0
+
+    def read(self, size=-1):
+        chunk = self.stream.read(min(size, self.limit) if size >= 0 else self.limit)
+        self.bytesRead += len(chunk)
+        return chunk
+
+@pytest.mark.parametrize('chunkSize', [1, 2, 3, 5, 7, 64, 65536])
+def test_elements_match_json_loads_for_any_chunk_size(chunkSize):
+    assert list(kapbot.iter_json_array(io.BytesIO(FEED_BYTES), chunkSize)) == FEED
+
+@pytest.mark.parametrize('limit', [1, 4, 13])
+def test_short_reads(limit):
+    assert list(kapbot.iter_json_array(ShortReader(FEED_BYTES, limit), 16)) == FEED
+
+@pytest.mark.parametrize('chunkSize', [1, 2, 3])
+def test_numbers_are_not_cut_at_a_chunk_boundary(chunkSize):
+    assert list(kapbot.iter_json_array(io.BytesIO(b'[12345, 678,9]'), chunkSize)) == [12345, 678, 9]
+
+@pytest.mark.parametrize('data, expected', [(b'[]', []), (b'  \n[ \n ]\n ', []), (b'\n[\n1 ,\n 2\n]\n', [1, 2])])
+def test_whitespace_and_empty_arrays(data, expected):
+    assert list(kapbot.iter_json_array(io.BytesIO(data), 2)) == expected
+
+@pytest.mark.parametrize('data', [b'', b'[', b'[{"classroom": "Room 001"}, {"class', b'[1, 2'])
+def test_truncated_feed_raises(data):
+    with pytest.raises(ValueError):
+        list(kapbot.iter_json_array(io.BytesIO(data), 4))
+
+def test_feed_that_is_not_an_array_raises():
+    with pytest.raises(ValueError):
+        list(kapbot.iter_json_array(io.BytesIO(b'{"classroom": "Room 001"}'), 4))
+
+def test_elements_are_yielded_before_the_whole_feed_is_read():
+    data = json.dumps([{"classroom": "Room " + str(i), "days": []} for i in range(1000)]).encode('utf-8')
+    reader = ShortReader(data, 1 << 20)
+
+    elements = kapbot.iter_json_array(reader, 256)
+    assert next(elements) == {"classroom": "Room 0", "days": []}
+    assert reader.bytesRead < len(data) // 10
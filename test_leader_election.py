@@ -0,0 +1,215 @@
+"""Lease based leader election between replicas sharing one database."""
+
+import datetime
+import json
+import threading
+import time
+
+import pytest
+
+import kapbot
+
+TTL = 0.6
+
+def scripted_lease(*outcomes):
+    """acquire_lease stand-in giving each outcome in turn, then the last one for good. Callables are called."""
+    outcomes = list(outcomes)
+
+    def acquire_lease(name, holder, ttl):
+        outcome = outcomes.pop(0) if len(outcomes) > 1 else outcomes[0]
+        return outcome() if callable(outcome) else outcome
+
+    return acquire_lease
+
+def database_down():
+    raise RuntimeError('database down')
+
+def late_renewal():
+    # Returns after the lease held so far has lapsed, but in time for the one it takes
+    time.sleep(TTL / 2)
+    return True
+
+def lapsing_renewal():
+    # Returns only after the lease it takes has lapsed too
+    time.sleep(TTL * 1.5)
+    return True
+
+@pytest.fixture
+def election(storage):
+    """Start a LeaderElection with storage.acquire_lease replaced by the given outcomes."""
+    started = []
+
+    def start(*outcomes):
+        storage.acquire_lease = scripted_lease(*outcomes)
+        leaderElection = kapbot.LeaderElection('daemons', TTL)
+        leaderElection.changes = []
+        leaderElection.listeners.append(lambda: leaderElection.changes.append(leaderElection.leader))
+        leaderElection.start()
+        started.append(leaderElection)
+        return leaderElection
+
+    yield start
+    for leaderElection in started:
+        leaderElection.stop()
+
+def wait_until(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def test_lease_is_held_by_one_replica_until_it_expires(storage):
+    assert storage.acquire_lease('daemons', 'a', TTL)
+    assert not storage.acquire_lease('daemons', 'b', TTL)
+    assert storage.acquire_lease('daemons', 'a', TTL)
+
+    time.sleep(TTL * 1.5)
+    assert storage.acquire_lease('daemons', 'b', TTL)
+    assert not storage.acquire_lease('daemons', 'a', TTL)
+
+def test_released_lease_can_be_taken_at_once(storage):
+    assert storage.acquire_lease('daemons', 'a', 60)
+    storage.release_lease('daemons', 'b')
+    assert not storage.acquire_lease('daemons', 'b', 60)
+
+    storage.release_lease('daemons', 'a')
+    assert storage.acquire_lease('daemons', 'b', 60)
+
+def test_replica_leads_once_it_holds_the_lease(election):
+    leaderElection = election(True)
+
+    assert leaderElection.wait(2)
+    assert wait_until(lambda: leaderElection.changes == [True])
+
+def test_replica_follows_while_another_holds_the_lease(election):
+    leaderElection = election(False)
+
+    assert not leaderElection.wait(TTL)
+    assert leaderElection.changes == []
+
+def test_failed_renewal_keeps_leading_until_the_lease_may_have_run_out(election):
+    leaderElection = election(True, database_down)
+    assert leaderElection.wait(2)
+
+    assert wait_until(lambda: leaderElection.changes == [True, False])
+    assert not leaderElection.is_leader()
+
+def test_losing_the_lease_to_another_replica_stops_leading(election):
+    leaderElection = election(True, False)
+    assert leaderElection.wait(2)
+
+    assert wait_until(lambda: leaderElection.changes == [True, False])
+    assert not leaderElection.is_leader()
+
+def test_waiter_wakes_when_a_lapsed_lease_is_renewed(election):
+    # The renewals after the late one stall, only the late one can wake the waiter
+    stalled = threading.Event()
+    leaderElection = election(True, late_renewal, lambda: stalled.wait(5) and False)
+    try:
+        assert leaderElection.wait(2)
+
+        # The renewal is still running when the lease lapses, the leader flag never flips
+        assert wait_until(lambda: not leaderElection.is_leader())
+        waiter = threading.Thread(target=leaderElection.wait, daemon=True)
+        waiter.start()
+
+        waiter.join(2)
+        assert not waiter.is_alive()
+        assert leaderElection.is_leader()
+        assert leaderElection.changes == [True]
+    finally:
+        stalled.set()
+
+def test_retaking_a_lapsed_lease_tells_the_listeners(election):
+    leaderElection = election(True, lapsing_renewal, True)
+    assert leaderElection.wait(2)
+
+    assert wait_until(lambda: leaderElection.changes == [True, True])
+
+def write_feed(path, classrooms):
+    date = datetime.date.today().isoformat()
+    with open(path, 'w') as feedFile:
+        json.dump([{"classroom": classroom, "days": [{"date": date, "classes": [{"ClassName": "FT MUR ICT 380B",
+            "Duration": "3 hours", "startTime": "10:00", "eventName": "ICT380B - Group A"}]}]} for classroom in classrooms],
+            feedFile)
+
+def test_crawler_reloads_in_full_after_leadership_changes_hands(storage, tmp_path, monkeypatch):
+    leaderElection = kapbot.LeaderElection('daemons', TTL, enabled=False)
+    monkeypatch.setattr(kapbot, 'leaderElection', leaderElection)
+    feedPath = str(tmp_path / 'schedules2.json')
+
+    def crawler():
+        scheduleCrawler = kapbot.ScheduleCrawler()
+        scheduleCrawler.feedFetcher = kapbot.FeedFetcher('file://' + feedPath)
+        return scheduleCrawler
+
+    replicaA = crawler()
+    replicaB = crawler()
+
+    write_feed(feedPath, ['Room 001'])
+    assert replicaA.refresh()
+
+    # B leads and rewrites the schedule, then A takes over again
+    leaderElection.set_leader(False)
+    write_feed(feedPath, ['Room 001', 'Room 002'])
+    assert replicaB.refresh()
+    leaderElection.set_leader(True)
+
+    write_feed(feedPath, ['Room 002', 'Room 003'])
+    assert replicaA.refresh()
+
+    assert sorted(storage.query("SELECT ClassLoc FROM ScrappedData")) == [('Room 002',), ('Room 003',)]
+
+class Slept(Exception):
+    pass
+
+@pytest.fixture
+def daemon(storage, monkeypatch):
+    """Run update_schedule up to its first sleep, returns the calls it made on the way."""
+    calls = []
+
+    def sleep(seconds):
+        calls.append('sleep')
+        raise Slept()
+
+    monkeypatch.setattr(kapbot.time, 'sleep', sleep)
+    monkeypatch.setattr(kapbot, 'reload_schedule_index', lambda: calls.append('reload'))
+    monkeypatch.setattr(kapbot.ScheduleCrawler, 'refresh', lambda self: calls.append('refresh') or True)
+
+    def run(leader):
+        leaderElection = kapbot.LeaderElection('daemons', TTL, enabled=False)
+        leaderElection.leader = leader
+        monkeypatch.setattr(kapbot, 'leaderElection', leaderElection)
+        with pytest.raises(Slept):
+            kapbot.update_schedule(None)
+        return calls
+
+    return run
+
+def test_daemon_runs_are_timed_on_the_database_clock(storage):
+    assert storage.seconds_since_run('crawler') is None
+
+    storage.record_run('crawler')
+    time.sleep(0.1)
+
+    assert 0.05 <= storage.seconds_since_run('crawler') < 5
+
+def test_follower_reloads_the_schedule_before_sleeping(daemon):
+    assert daemon(False) == ['reload', 'sleep']
+
+@pytest.mark.parametrize('lastCrawlAge', [None, kapbot.crawlIntervalMinutes * 60 + 1])
+def test_new_leader_crawls_at_once_when_the_last_crawl_is_overdue(storage, daemon, lastCrawlAge):
+    if lastCrawlAge is not None:
+        storage.record_run('crawler')
+        with storage.transaction() as cursor:
+            cursor.execute("UPDATE DaemonRun SET LastRunAt = LastRunAt - ?", (lastCrawlAge,))
+
+    assert daemon(True) == ['refresh', 'sleep']
+    assert storage.seconds_since_run('crawler') < 5
+
+def test_new_leader_waits_for_the_next_slot_after_a_recent_crawl(storage, daemon):
+    storage.record_run('crawler')
+
+    assert daemon(True) == ['sleep']
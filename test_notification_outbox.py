@@ -0,0 +1,114 @@
+"""Delivering class notifications through the NotificationOutbox table."""
+
+import datetime
+
+import pytest
+
+import kapbot
+
+NOW = datetime.datetime(2026, 10, 19, 9, 0)
+
+def due_entry(telegramId=1, classCode='ICT380B', classStart=NOW + datetime.timedelta(minutes=30)):
+    # (class start, row) as the scheduler pops it, the row as NotificationScheduler.rebuild() builds it
+    return classStart, (telegramId, 'FT', 'MUR', classCode, 'Room 001', datetime.timedelta(hours=9, minutes=30),
+        classStart.date(), '3 hours', None)
+
+@pytest.fixture
+def outbox(storage):
+    storage.add_user(1, 'MUR', 'FT')
+    storage.add_user(2, 'MUR', 'FT')
+    storage.add_subscriptions(1, ['ICT380B', 'BUS100A'])
+    storage.add_subscriptions(2, ['ICT380B'])
+    return kapbot.NotificationOutbox(retryBase=30, retryMax=600, maxAttempts=3)
+
+def test_countdown_is_rendered_when_the_message_is_sent(outbox):
+    outbox.queue([due_entry()], NOW)
+
+    outboxRows, more = outbox.take(NOW)
+    assert [text for chatId, text, outboxId in outbox.messages(outboxRows, NOW)] == [
+        "*ICT380B @ Room 001*\nHappening in ~30 minutes\n3 hours"]
+    outbox.settle(outboxRows, [], NOW)
+
+    # The retry states the time left when it is sent, not when it was queued
+    retryTime = NOW + datetime.timedelta(minutes=10)
+    outboxRows, more = outbox.take(retryTime)
+    assert [text for chatId, text, outboxId in outbox.messages(outboxRows, retryTime)] == [
+        "*ICT380B @ Room 001*\nHappening in ~20 minutes\n3 hours"]
+
+def outbox_rows(storage):
+    return storage.query("SELECT TelegramID, ClassCode, Status, Attempts, NextAttemptAt FROM NotificationOutbox ORDER BY OutboxID")
+
+def test_notifications_are_claimed_once_per_day(storage, outbox):
+    assert outbox.queue([due_entry(1), due_entry(2), due_entry(1)], NOW) == {(1, 'ICT380B'), (2, 'ICT380B')}
+
+    # Already claimed today, or no longer subscribed
+    assert outbox.queue([due_entry(1), due_entry(2, 'BUS100A')], NOW) == set()
+    assert [row[:3] for row in outbox_rows(storage)] == [(1, 'ICT380B', 'pending'), (2, 'ICT380B', 'pending')]
+
+    tomorrow = NOW + datetime.timedelta(days=1)
+    assert outbox.queue([due_entry(1, classStart=tomorrow + datetime.timedelta(minutes=30))], tomorrow) == {(1, 'ICT380B')}
+
+def test_sent_notifications_are_not_taken_again(storage, outbox):
+    outbox.queue([due_entry(1), due_entry(2)], NOW)
+
+    outboxRows, more = outbox.take(NOW)
+    outbox.settle(outboxRows, [outboxRows[0][0]], NOW)
+
+    assert [row[:4] for row in outbox_rows(storage)] == [(1, 'ICT380B', 'sent', 1), (2, 'ICT380B', 'pending', 1)]
+    assert outbox.take(NOW) == ([], False)
+
+def test_retries_back_off_exponentially(storage, outbox, monkeypatch):
+    # Jitter picks the longest wait
+    monkeypatch.setattr(kapbot.random, 'uniform', lambda low, high: high)
+    outbox.queue([due_entry(classStart=NOW + datetime.timedelta(hours=2))], NOW)
+
+    now = NOW
+    for attempts, backoff in [(1, 30), (2, 60)]:
+        outboxRows, more = outbox.take(now)
+        outbox.settle(outboxRows, [], now)
+
+        retryAt = now + datetime.timedelta(seconds=backoff)
+        assert outbox_rows(storage) == [(1, 'ICT380B', 'pending', attempts, kapbot.sql_datetime(retryAt))]
+        assert outbox.take(retryAt - datetime.timedelta(seconds=1)) == ([], False)
+        now = retryAt
+
+def test_backoff_is_capped(storage, outbox, monkeypatch):
+    monkeypatch.setattr(kapbot.random, 'uniform', lambda low, high: high)
+    outbox.maxAttempts = 10
+    outbox.queue([due_entry(classStart=NOW + datetime.timedelta(hours=2))], NOW)
+
+    now = NOW
+    for attempts in range(6):
+        outboxRows, more = outbox.take(now)
+        outbox.settle(outboxRows, [], now)
+        now = storage.next_outbox_attempt()
+
+    assert now - NOW == datetime.timedelta(seconds=30 + 60 + 120 + 240 + 480 + 600)
+
+def test_gives_up_after_max_attempts(storage, outbox):
+    outbox.queue([due_entry(classStart=NOW + datetime.timedelta(hours=2))], NOW)
+
+    now = NOW
+    for attempts in range(outbox.maxAttempts):
+        outboxRows, more = outbox.take(now)
+        assert len(outboxRows) == 1
+        outbox.settle(outboxRows, [], now)
+        now += datetime.timedelta(minutes=10)
+
+    assert [row[2:4] for row in outbox_rows(storage)] == [('failed', 3)]
+    assert outbox.take(now) == ([], False)
+
+def test_gives_up_when_the_retry_would_come_after_the_class_starts(storage, outbox, monkeypatch):
+    monkeypatch.setattr(kapbot.random, 'uniform', lambda low, high: high)
+    outbox.queue([due_entry(classStart=NOW + datetime.timedelta(seconds=20))], NOW)
+
+    outboxRows, more = outbox.take(NOW)
+    outbox.settle(outboxRows, [], NOW)
+
+    assert [row[2:4] for row in outbox_rows(storage)] == [('failed', 1)]
+
+def test_classes_that_have_started_are_dropped_unsent(storage, outbox):
+    outbox.queue([due_entry(classStart=NOW + datetime.timedelta(minutes=5))], NOW)
+
+    assert outbox.take(NOW + datetime.timedelta(minutes=5)) == ([], False)
+    assert [row[2:4] for row in outbox_rows(storage)] == [('failed', 1)]
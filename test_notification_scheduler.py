@@ -0,0 +1,87 @@
+"""Queueing today's class notifications by the time they are due."""
+
+import datetime
+
+import pytest
+
+import kapbot
+
+TODAY = datetime.date.today()
+
+def at(hour, minute=0):
+    return datetime.datetime.combine(TODAY, datetime.time(hour, minute))
+
+def schedule_row(ClassCode, StartTime, StudentType='FT'):
+    return (StudentType, 'MUR', ClassCode, 'Room 001', StartTime, TODAY.isoformat(), '3 hours', None, False, '')
+
+@pytest.fixture
+def scheduler(storage):
+    storage.replace_schedule([schedule_row('ICT380B', '10:00'), schedule_row('BUS100A', '09:30'),
+        schedule_row('MAS200B', '11:00')])
+    kapbot.load_schedule_index()
+
+    storage.add_user(1, 'MUR', 'FT')
+    storage.add_user(2, 'MUR', 'FT')
+    storage.add_user(3, 'MUR', 'PT')
+    storage.add_subscriptions(1, ['ICT380B', 'BUS100A'])
+    storage.add_subscriptions(2, ['MAS200B', 'ICT380B'])
+    # Only full time classes are scheduled
+    storage.add_subscriptions(3, ['ICT380B'])
+
+    notificationScheduler = kapbot.NotificationScheduler(datetime.timedelta(minutes=60), rebuildDelay=0)
+    notificationScheduler.rebuild(at(8))
+    return notificationScheduler
+
+def popped(notificationScheduler, now):
+    return [(classStart, x[0], x[3]) for classStart, x in notificationScheduler.pop_due(now)]
+
+def test_entries_pop_once_due_earliest_first(scheduler):
+    assert popped(scheduler, at(8, 29)) == []
+
+    due = popped(scheduler, at(9))
+    assert [x[0] for x in due] == [at(9, 30), at(10), at(10)]
+    assert sorted(due) == [(at(9, 30), 1, 'BUS100A'), (at(10), 1, 'ICT380B'), (at(10), 2, 'ICT380B')]
+    assert popped(scheduler, at(9, 59)) == []
+    assert popped(scheduler, at(12)) == [(at(11), 2, 'MAS200B')]
+    assert popped(scheduler, at(23)) == []
+
+def test_wakes_when_the_next_entry_is_due(scheduler):
+    assert scheduler.seconds_until_wake(at(8)) == 30 * 60
+
+    popped(scheduler, at(8, 30))
+    assert scheduler.seconds_until_wake(at(8, 30)) == 30 * 60
+
+def test_classes_that_have_started_are_left_out(scheduler):
+    scheduler.rebuild(at(9, 45))
+
+    assert sorted(popped(scheduler, at(12))) == [(at(10), 1, 'ICT380B'), (at(10), 2, 'ICT380B'), (at(11), 2, 'MAS200B')]
+
+def test_invalidate_rebuilds_from_the_database(storage, scheduler):
+    assert not scheduler.needs_rebuild(at(8))
+
+    storage.add_subscriptions(3, ['MAS200B'])
+    storage.add_user(4, 'MUR', 'FT')
+    storage.add_subscriptions(4, ['MAS200B'])
+    scheduler.invalidate()
+    assert scheduler.needs_rebuild(at(8))
+
+    scheduler.rebuild(at(8))
+    assert not scheduler.needs_rebuild(at(8))
+    assert sorted((x[1], x[2]) for x in popped(scheduler, at(12))) == [
+        (1, 'BUS100A'), (1, 'ICT380B'), (2, 'ICT380B'), (2, 'MAS200B'), (4, 'MAS200B')]
+
+def test_subscriptions_notified_today_are_left_out_after_a_rebuild(storage, scheduler):
+    storage.enqueue_notifications([(1, 'ICT380B', 'text', at(10))], at(9))
+    scheduler.invalidate()
+
+    scheduler.rebuild(at(9))
+    assert sorted((x[1], x[2]) for x in popped(scheduler, at(12))) == [(1, 'BUS100A'), (2, 'ICT380B'), (2, 'MAS200B')]
+
+def test_rebuilds_wait_for_the_rebuild_delay_and_the_next_day(storage):
+    notificationScheduler = kapbot.NotificationScheduler(datetime.timedelta(minutes=60), rebuildDelay=60)
+    assert notificationScheduler.needs_rebuild(at(8))
+    notificationScheduler.rebuild(at(8))
+
+    notificationScheduler.invalidate()
+    assert not notificationScheduler.needs_rebuild(at(8))
+    assert notificationScheduler.needs_rebuild(at(8) + datetime.timedelta(days=1))
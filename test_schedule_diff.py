@@ -0,0 +1,96 @@
+"""Diffing schedule feeds on the (ClassCode, StudentType, ClassLoc, StartTime, Date) key."""
+
+import datetime
+import json
+import logging
+
+import pytest
+
+import kapbot
+
+def schedule_row(ClassCode='ICT380B', StudentType='FT', ClassLoc='Room 001', StartTime='10:00', Date='2026-10-19',
+        Duration='3 hours', UniversityType='MUR', PGroupName='Group A'):
+    return (StudentType, UniversityType, ClassCode, ClassLoc, StartTime, Date, Duration, PGroupName, False, '')
+
+def study_room(ClassLoc='Room 009', Duration='2 hours'):
+    return (None, None, 'Study Room', ClassLoc, '09:00', '2026-10-19', Duration, None, None, None)
+
+def diff(oldRows, newRows):
+    return kapbot.diff_schedule(kapbot.schedule_snapshot(oldRows), iter(newRows))
+
+def row_key(row):
+    return tuple(row[i] for i in kapbot.SCHEDULE_KEY_INDEXES)
+
+def test_same_feed_gives_an_empty_delta():
+    rows = [schedule_row(), schedule_row(ClassCode='BUS100A'), study_room()]
+
+    snapshot, delta = diff(rows, rows)
+
+    assert delta == kapbot.ScheduleDelta([], [], [])
+    assert snapshot == kapbot.schedule_snapshot(rows)
+
+@pytest.mark.parametrize('changes', [{'Duration': '2 hours'}, {'PGroupName': 'Group B'}, {'UniversityType': 'UCD'}])
+def test_other_columns_changing_is_an_update(changes):
+    newRow = schedule_row(**changes)
+
+    snapshot, delta = diff([schedule_row()], [newRow])
+
+    assert delta == kapbot.ScheduleDelta([], [newRow], [])
+
+@pytest.mark.parametrize('changes', [{'ClassCode': 'ICT381A'}, {'StudentType': 'PT'}, {'ClassLoc': 'Room 002'},
+    {'StartTime': '13:30'}, {'Date': '2026-10-20'}])
+def test_key_columns_changing_is_an_insert_and_a_removal(changes):
+    oldRow = schedule_row()
+    newRow = schedule_row(**changes)
+
+    snapshot, delta = diff([oldRow], [newRow])
+
+    assert delta == kapbot.ScheduleDelta([newRow], [], [row_key(oldRow)])
+
+def test_repeated_key_keeps_the_first_row():
+    first = schedule_row()
+    repeat = schedule_row(Duration='2 hours')
+
+    snapshot, delta = diff([], [first, repeat])
+
+    assert delta.inserted == [first]
+    assert snapshot == kapbot.schedule_snapshot([first])
+
+def test_new_snapshot_diffs_the_next_feed():
+    firstFeed = [schedule_row(), schedule_row(ClassCode='BUS100A')]
+    secondFeed = [schedule_row(Duration='2 hours'), schedule_row(ClassCode='MAS200B')]
+    thirdFeed = [schedule_row(Duration='2 hours')]
+
+    snapshot, delta = diff(firstFeed, secondFeed)
+    snapshot, delta = kapbot.diff_schedule(snapshot, iter(thirdFeed))
+
+    assert delta == kapbot.ScheduleDelta([], [], [row_key(schedule_row(ClassCode='MAS200B'))])
+
+def test_delta_brings_the_table_to_the_new_feed(storage):
+    oldFeed = [schedule_row(), schedule_row(ClassCode='BUS100A'), study_room(), study_room(ClassLoc='Room 010')]
+    newFeed = [schedule_row(Duration='2 hours'), schedule_row(ClassCode='MAS200B'), study_room(Duration='1 hour')]
+    storage.replace_schedule(oldFeed)
+
+    snapshot, delta = diff(oldFeed, newFeed)
+    storage.apply_schedule_delta(delta)
+
+    assert sorted(storage.query("SELECT ClassCode, ClassLoc, Duration FROM ScrappedData")) == sorted(
+        (row[2], row[3], row[6]) for row in newFeed)
+
+def feed_class(Duration='3 hours'):
+    return {"ClassName": "FT MUR ICT 380B", "Duration": Duration, "startTime": "10:00", "eventName": "ICT380B - Group A"}
+
+@pytest.mark.parametrize('incremental', [True, False])
+def test_repeated_keys_are_dropped_with_or_without_incremental_refresh(storage, tmp_path, caplog, incremental):
+    feedPath = tmp_path / 'schedules2.json'
+    feedPath.write_text(json.dumps([{"classroom": "Room 001", "days": [{"date": datetime.date.today().isoformat(),
+        "classes": [feed_class(), feed_class(Duration='2 hours'), feed_class()]}]}]))
+    scheduleCrawler = kapbot.ScheduleCrawler()
+    scheduleCrawler.incrementalRefresh = incremental
+    scheduleCrawler.feedFetcher = kapbot.FeedFetcher('file://' + str(feedPath))
+
+    with caplog.at_level(logging.WARNING):
+        assert scheduleCrawler.refresh()
+
+    assert storage.query("SELECT ClassCode, Duration FROM ScrappedData") == [('ICT380B', '3 hours')]
+    assert 'Dropped 2 schedule rows repeating the key of an earlier row' in caplog.messages